@@ -1,4 +1,5 @@
 
+from pycket             import values
 from pycket.ast_visitor import ASTVisitor
 from pycket.env         import SymList
 from pycket.interpreter import (
@@ -10,15 +11,18 @@ from pycket.interpreter import (
     Cell,
     CellRef,
     DefineValues,
+    Gensym,
     If,
     Lambda,
     Let,
     Letrec,
     LexicalVar,
+    Loop,
     Module,
     ModuleVar,
     Quote,
     QuoteSyntax,
+    Recur,
     Require,
     SetBang,
     SequencedBodyAST,
@@ -26,6 +30,8 @@ from pycket.interpreter import (
     ToplevelVar,
     VariableReference,
     WithContinuationMark,
+    make_lambda,
+    make_let,
     variable_set,
 )
 
@@ -36,6 +42,332 @@ def compute_body_frees(node):
         frees = frees.union(b.free_vars())
     return frees
 
+class RenameVisitor(ASTVisitor):
+    """ Renames the references to and assignments of one variable. """
+
+    def __init__(self, sym, new_sym):
+        self.sym = sym
+        self.new_sym = new_sym
+
+    def visit_lexical_var(self, ast):
+        assert isinstance(ast, LexicalVar)
+        if ast.sym is self.sym:
+            return LexicalVar(self.new_sym)
+        return ast
+
+    def visit_cell_ref(self, ast):
+        assert isinstance(ast, CellRef)
+        if ast.sym is self.sym:
+            return CellRef(self.new_sym)
+        return ast
+
+def loop_lambda(loop):
+    assert isinstance(loop, Loop)
+    caselam = loop.rator
+    assert isinstance(caselam, CaseLambda)
+    lam = caselam.lams[0]
+    lam.force_body()
+    return lam
+
+def is_captured(body, sym):
+    """ Whether a lambda in |body| closes over |sym|, a variable reference
+    takes its location, or |body| binds |sym| again. The procedure of a loop
+    does not count, as it only runs in the loop, which can pass |sym| along
+    as one more loop variable (see |rebind_loop|). """
+    todo = body[:]
+    while todo:
+        ast = todo.pop()
+        if isinstance(ast, Loop):
+            lam = loop_lambda(ast)
+            if sym in lam.args.elems:
+                return True
+            todo.extend(ast.rands)
+            todo.extend(lam.body)
+            continue
+        if isinstance(ast, CaseLambda):
+            if ast.free_vars().haskey(sym):
+                return True
+            continue
+        if isinstance(ast, VariableReference):
+            var = ast.var
+            if ((isinstance(var, LexicalVar) or isinstance(var, CellRef)) and
+                    var.sym is sym):
+                return True
+        elif isinstance(ast, Let) or isinstance(ast, Letrec):
+            if sym in ast.args.elems:
+                return True
+        todo.extend(ast.direct_children())
+    return False
+
+def cannot_capture(ast):
+    """ Whether evaluating |ast| certainly does not capture a continuation.
+    Primitives that return a single value without access to the
+    continuation are called with simple arguments only after normalization. """
+    if ast.simple:
+        return True
+    if not isinstance(ast, App) or not isinstance(ast.rator, ModuleVar):
+        return False
+    rator = ast.rator
+    if not rator.is_primitive():
+        return False
+    w_prim = rator._lookup_primitive()
+    if not isinstance(w_prim, values.W_Prim) or w_prim.result_arity is None:
+        return False
+    for rand in ast.rands:
+        if not rand.simple:
+            return False
+    return True
+
+def cannot_capture_in(body):
+    """ Whether evaluating |body| certainly does not capture a continuation,
+    apart from the calls that start the next iteration of a loop. """
+    todo = body[:]
+    while todo:
+        ast = todo.pop()
+        if isinstance(ast, Lambda):
+            ast.force_body()
+        elif (isinstance(ast, App) and not isinstance(ast, Loop) and
+                not isinstance(ast, Recur) and not cannot_capture(ast)):
+            return False
+        todo.extend(ast.direct_children())
+    return True
+
+def loop_exit(ast, acc, bound):
+    """ The exit |ast| of a loop changed to also return the value of |acc|,
+    instead of its own if that is not |bound|. """
+    if not bound:
+        return Begin.make([ast, LexicalVar(acc)])
+    values_sym = values.W_Symbol.make("values")
+    rator = ModuleVar(values_sym, "#%kernel", values_sym)
+    if ast.simple:
+        return App.make(rator, [ast, LexicalVar(acc)])
+    exit_sym = Gensym.gensym("exit")
+    return make_let([[exit_sym]], [ast],
+                    [App.make(rator, [LexicalVar(exit_sym), LexicalVar(acc)])])
+
+def thread_loop_var(ast, lp, acc, exit_value, bound):
+    """ The tail expression |ast| of the body of the loop |lp| with |acc|
+    passed to the next iteration as the last argument of each Recur, and
+    with the value of |acc| returned by the exits of the loop if
+    |exit_value| (see |loop_exit|). """
+    if isinstance(ast, Recur):
+        rator = ast.rator
+        if isinstance(rator, LexicalVar) and rator.sym is lp:
+            return Recur(rator, ast.rands + [LexicalVar(acc)])
+        return ast
+    if isinstance(ast, Loop):
+        # the body of a loop entered in tail position is in tail position
+        caselam = ast.rator
+        assert isinstance(caselam, CaseLambda)
+        lam = loop_lambda(ast)
+        body = lam.body[:]
+        body[-1] = thread_loop_var(body[-1], lp, acc, exit_value, bound)
+        lam = make_lambda(lam.formals, lam.rest, body,
+                          sourceinfo=lam.sourceinfo)
+        caselam = CaseLambda([lam], recursive_sym=caselam.recursive_sym,
+                             arity=caselam._arity)
+        return Loop(caselam, ast.rands)
+    if isinstance(ast, If):
+        return If(ast.tst, thread_loop_var(ast.thn, lp, acc, exit_value, bound),
+                  thread_loop_var(ast.els, lp, acc, exit_value, bound))
+    if isinstance(ast, Let) or isinstance(ast, Letrec) or isinstance(ast, Begin):
+        body = ast.body[:]
+        body[-1] = thread_loop_var(body[-1], lp, acc, exit_value, bound)
+        if isinstance(ast, Let):
+            return Let(ast.args, ast.counts, ast.rhss, body)
+        if isinstance(ast, Letrec):
+            return Letrec(ast.args, ast.counts, ast.rhss, body)
+        return Begin(body)
+    if isinstance(ast, WithContinuationMark):
+        return WithContinuationMark(ast.key, ast.value,
+            thread_loop_var(ast.body, lp, acc, exit_value, bound))
+    if exit_value:
+        return loop_exit(ast, acc, bound)
+    return ast
+
+def rebind_loop(loop, var, rest, sym):
+    """
+    The Loop |loop| that assigns |sym|, with its value bound to the variable
+    |var| unless that is None, followed by the |rest| of the body. |sym| is
+    passed along as one more loop variable instead, and the value it has
+    when the loop exits is bound to a fresh variable for the rest. Returns
+    None if the loop may capture a continuation, since the value of a loop
+    variable is not shared between the iterations.
+    """
+    lam = loop_lambda(loop)
+    if sym in lam.args.elems or not cannot_capture_in(lam.body):
+        return None
+    caselam = loop.rator
+    assert isinstance(caselam, CaseLambda)
+    lp = caselam.recursive_sym
+    exit_value = free_vars_of(rest).haskey(sym)
+    acc = Gensym.gensym(sym.utf8value)
+    renamer = RenameVisitor(sym, acc)
+    body = [b.visit(renamer) for b in lam.body]
+    body[-1] = thread_loop_var(body[-1], lp, acc, exit_value, var is not None)
+    body = rebind_assignments(body, acc)
+    if body is None:
+        return None
+    lam = make_lambda(lam.formals + [acc], None, body,
+                      sourceinfo=lam.sourceinfo)
+    loop = Loop(CaseLambda([lam], recursive_sym=lp),
+                loop.rands + [LexicalVar(sym)])
+    if not exit_value:
+        if var is not None:
+            return [make_let([[var]], [loop], rest)]
+        return [loop] + rest
+    new_sym = Gensym.gensym(sym.utf8value)
+    renamer = RenameVisitor(sym, new_sym)
+    rest = rebind_assignments([r.visit(renamer) for r in rest], new_sym)
+    if rest is None:
+        return None
+    if var is not None:
+        return [make_let([[var, new_sym]], [loop], rest)]
+    return [make_let([[new_sym]], [loop], rest)]
+
+def rebind_assignments(body, sym):
+    """
+    Turns the assignments of the variable |sym| in the normalized |body| of
+    its binding form into bindings of fresh variables that scope over the
+    rest of the body. Returns the new body, or None if an assignment is not
+    followed by its whole remaining scope, or if a continuation may be
+    captured before it, since reentering that continuation after the
+    assignment has to see the assigned value. |sym| must not be captured.
+    """
+    var = LexicalVar(sym)
+    result = []
+    i = 0
+    while i < len(body):
+        b = body[i]
+        rest = body[i + 1:]
+        if var not in b.mutated_vars():
+            if not cannot_capture(b) and var in mutated_vars_of(rest):
+                return None
+            result.append(b)
+            i += 1
+            continue
+        if isinstance(b, SetBang):
+            if (not isinstance(b.var, CellRef) or b.var.sym is not sym or
+                    var in b.rhs.mutated_vars()):
+                return None
+            if not rest:
+                result.append(b.rhs)
+                result.append(Quote(values.w_void))
+                return result
+            # a normalized assignment usually assigns a temporary, which can
+            # take the place of the variable directly
+            rhs = b.rhs
+            reuse = (isinstance(rhs, LexicalVar) and
+                     LexicalVar(rhs.sym) not in mutated_vars_of(rest))
+            if reuse:
+                new_sym = rhs.sym
+            else:
+                new_sym = Gensym.gensym(sym.utf8value)
+            renamer = RenameVisitor(sym, new_sym)
+            rest = rebind_assignments([r.visit(renamer) for r in rest], new_sym)
+            if rest is None:
+                return None
+            if reuse:
+                result.extend(rest)
+            else:
+                result.append(make_let([[new_sym]], [rhs], rest))
+            return result
+        if isinstance(b, Loop):
+            rest = rebind_loop(b, None, rest, sym)
+            if rest is None:
+                return None
+            result.extend(rest)
+            return result
+        if rest:
+            # the rest of the body moves into the scope of the assignment
+            if isinstance(b, Begin):
+                body = result + b.body + rest
+                result = []
+                i = 0
+                continue
+            if isinstance(b, Let):
+                frees = free_vars_of(rest)
+                for v in b.args.elems:
+                    if frees.haskey(v):
+                        return None
+                body = result + [make_let(b._rebuild_args(), b.rhss,
+                                          b.body + rest)]
+                result = []
+                i = 0
+                continue
+            if isinstance(b, If) and var not in b.tst.mutated_vars():
+                if not free_vars_of(rest).haskey(sym):
+                    thn = rebind_assignments([b.thn], sym)
+                    els = rebind_assignments([b.els], sym)
+                    if thn is None or els is None:
+                        return None
+                    result.append(If(b.tst, Begin.make(thn), Begin.make(els)))
+                    result.extend(rest)
+                    return result
+                # the value of the variable after the if joins the values
+                # it has at the end of the branches
+                if (var in mutated_vars_of(rest) and
+                        not cannot_capture_in([b.thn, b.els])):
+                    return None
+                thn = rebind_assignments([b.thn, LexicalVar(sym)], sym)
+                els = rebind_assignments([b.els, LexicalVar(sym)], sym)
+                if thn is None or els is None:
+                    return None
+                new_sym = Gensym.gensym(sym.utf8value)
+                renamer = RenameVisitor(sym, new_sym)
+                rest = rebind_assignments([r.visit(renamer) for r in rest],
+                                          new_sym)
+                if rest is None:
+                    return None
+                joined = If(b.tst, Begin.make(thn), Begin.make(els))
+                result.append(make_let([[new_sym]], [joined], rest))
+                return result
+            return None
+        if isinstance(b, Let):
+            rhs = b.rhss[0]
+            if (len(b.rhss) == 1 and b.counts[0] == 1 and
+                    isinstance(rhs, Loop) and var in rhs.mutated_vars()):
+                body = rebind_loop(rhs, b.args.elems[0], b.body, sym)
+                if body is None:
+                    return None
+                result.extend(body)
+                return result
+            for rhs in b.rhss:
+                if not cannot_capture(rhs):
+                    return None
+            new_body = rebind_assignments(b.body, sym)
+            if new_body is None:
+                return None
+            result.append(make_let(b._rebuild_args(), b.rhss, new_body))
+            return result
+        if isinstance(b, Begin):
+            new_body = rebind_assignments(b.body, sym)
+            if new_body is None:
+                return None
+            result.append(Begin.make(new_body))
+            return result
+        if isinstance(b, If) and var not in b.tst.mutated_vars():
+            thn = rebind_assignments([b.thn], sym)
+            els = rebind_assignments([b.els], sym)
+            if thn is None or els is None:
+                return None
+            result.append(If(b.tst, Begin.make(thn), Begin.make(els)))
+            return result
+        return None
+    return result
+
+def mutated_vars_of(body):
+    muts = variable_set()
+    for b in body:
+        muts.update(b.mutated_vars())
+    return muts
+
+def free_vars_of(body):
+    frees = SymbolSet.EMPTY
+    for b in body:
+        frees = frees.union(b.free_vars())
+    return frees
+
 class AssignConvertVisitor(ASTVisitor):
     """
     This visitor performs assignment conversion of the Pycket AST, which is
@@ -43,6 +375,11 @@ class AssignConvertVisitor(ASTVisitor):
 
     This pass also performs something akin to liveness analysis, trying to reduce
     the sizes of environment frames by removing cells unreferenced by an expression.
+
+    Assigned variables that no lambda captures do not get cells: each of
+    their assignments binds a fresh variable for the rest of the scope
+    instead, and loops pass them along as loop variables, if that does not
+    change what the program computes (see |rebind_assignments|).
     """
 
     @staticmethod
@@ -88,8 +425,40 @@ class AssignConvertVisitor(ASTVisitor):
         rands = [r.visit(self, vars, env_structure) for r in ast.rands]
         return App.make(rator, rands, env_structure)
 
+    def visit_loop(self, ast, vars, env_structure):
+        assert isinstance(ast, Loop)
+        rator = ast.rator.visit(self, vars, env_structure)
+        rands = [r.visit(self, vars, env_structure) for r in ast.rands]
+        return Loop(rator, rands, env_structure)
+
+    def visit_recur(self, ast, vars, env_structure):
+        assert isinstance(ast, Recur)
+        rator = ast.rator.visit(self, vars, env_structure)
+        rands = [r.visit(self, vars, env_structure) for r in ast.rands]
+        return Recur(rator, rands, env_structure)
+
+    @staticmethod
+    def rebind_uncaptured(ast, syms):
+        """ The body of the binding form |ast| with the assignments of those
+        of the variables |syms| that are not captured turned into bindings,
+        so that they do not need cells. """
+        muts = AssignConvertVisitor.body_muts(ast)
+        body = ast.body
+        for sym in syms:
+            if LexicalVar(sym) not in muts or is_captured(body, sym):
+                continue
+            new_body = rebind_assignments(body, sym)
+            if new_body is not None:
+                body = new_body
+        return body
+
     def visit_lambda(self, ast, vars, env_structure):
         assert isinstance(ast, Lambda)
+        ast.force_body()
+        body = self.rebind_uncaptured(ast, ast.args.elems)
+        if body is not ast.body:
+            ast = make_lambda(ast.formals, ast.rest, body,
+                              sourceinfo=ast.sourceinfo)
         local_muts = self.body_muts(ast)
         need_cell_flags = [False] * len(ast.args.elems)
         new_vars = vars.copy()
@@ -135,6 +504,10 @@ class AssignConvertVisitor(ASTVisitor):
 
     def visit_let(self, ast, vars, env_structure):
         assert isinstance(ast, Let)
+        body = self.rebind_uncaptured(ast, ast.args.elems)
+        if body is not ast.body:
+            ast = make_let(ast._rebuild_args(), ast.rhss, body)
+            assert isinstance(ast, Let)
         sub_env_structure = SymList(ast.args.elems, env_structure)
         local_muts = self.body_muts(ast)
         new_vars = vars.copy()
@@ -0,0 +1,1176 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compact binary serialization of fully converted module ASTs.
+#
+# The JSON produced by the expander has to be parsed, converted by
+# |JsonLoader.to_module|, A-normalized and assignment converted on every
+# start. The binary format stores the result of all of these steps, so that
+# loading a module is a single pass over a byte string which builds the
+# final AST nodes directly.
+#
+# Layout of a file:
+#
+#   magic, format version, flags
+#   inlined from    -- files of other modules whose code was inlined, which
+#                      make the cache stale when they change
+#   symbol table    -- every symbol used by the module, with its interning kind
+#   string table    -- module paths, source files, strings in quoted data
+#   symlist table   -- environment structures
+#   module AST      -- a preorder encoding of the AST, one tag byte per node
+#
+# Environment structures (SymLists) are shared between AST nodes and the
+# interpreter relies on their identity, so nodes refer to them by their index
+# in the table.
+#
+# The body of every lambda is prefixed with its length in bytes. This allows
+# the reader to skip it and to only decode it when the lambda is called for
+# the first time (see |Lambda.lazy_body|).
+#
+# An image holds all the modules of a program with shared tables:
+#
+#   image magic, format version, flags
+#   symbol, string and symlist tables
+#   number of modules, then for every module its name and its length
+#   prefixed AST, the main module first
+
+from pycket                   import values, values_string, values_regex
+from pycket                   import vector
+from pycket.arity             import Arity
+from pycket.ast_visitor       import ASTVisitor
+from pycket.env               import SymList
+from pycket.error             import SchemeException
+from pycket.interpreter       import (
+    LazyBody,
+    App,
+    Begin,
+    Begin0,
+    BeginForSyntax,
+    CaseLambda,
+    Cell,
+    CellRef,
+    DefineValues,
+    If,
+    Lambda,
+    Let,
+    Letrec,
+    LexicalVar,
+    Loop,
+    Module,
+    ModuleVar,
+    Quote,
+    QuoteSyntax,
+    Recur,
+    Require,
+    SequencedBodyAST,
+    SetBang,
+    ToplevelVar,
+    VariableReference,
+    WithContinuationMark,
+)
+
+from rpython.rlib.longlong2float import longlong2float, float2longlong
+from rpython.rlib.rarithmetic    import r_longlong, r_ulonglong, intmask
+from rpython.rlib.rbigint        import rbigint
+from rpython.rlib.rstring        import StringBuilder
+
+MAGIC = "PYCKETAST"
+IMAGE_MAGIC = "PYCKETIMG"
+
+# Bump whenever the encoding of any node changes.
+FORMAT_VERSION = 4
+
+# Flags recording the configuration the AST was converted under. A cached AST
+# is only valid if it was produced with the same flags.
+FLAG_BYTECODE_EXPAND = 1 << 0
+FLAG_PRUNE_ENV       = 1 << 1
+
+class SerializationError(SchemeException):
+    pass
+
+class DeserializationError(SchemeException):
+    pass
+
+def current_flags(bytecode_expand):
+    from pycket import config
+    flags = 0
+    if bytecode_expand:
+        flags |= FLAG_BYTECODE_EXPAND
+    if config.prune_env:
+        flags |= FLAG_PRUNE_ENV
+    return flags
+
+# Symbol kinds
+SYM_INTERNED   = 0
+SYM_UNREADABLE = 1
+SYM_UNINTERNED = 2
+
+# AST node tags
+TAG_NONE                 = 0
+TAG_MODULE               = 1
+TAG_REQUIRE              = 2
+TAG_QUOTE                = 3
+TAG_QUOTE_SYNTAX         = 4
+TAG_VARIABLE_REFERENCE   = 5
+TAG_WCM                  = 6
+TAG_APP                  = 7
+TAG_BEGIN0               = 8
+TAG_BEGIN                = 9
+TAG_BEGIN_FOR_SYNTAX     = 10
+TAG_CELL_REF             = 11
+TAG_LEXICAL_VAR          = 12
+TAG_MODULE_VAR           = 13
+TAG_TOPLEVEL_VAR         = 14
+TAG_SET_BANG             = 15
+TAG_IF                   = 16
+TAG_CASE_LAMBDA          = 17
+TAG_LAMBDA               = 18
+TAG_LETREC               = 19
+TAG_LET                  = 20
+TAG_DEFINE_VALUES        = 21
+TAG_CELL                 = 22
+TAG_LOOP                 = 23
+TAG_RECUR                = 24
+
+# Value tags for quoted data
+VAL_FALSE        = 0
+VAL_TRUE         = 1
+VAL_VOID         = 2
+VAL_NULL         = 3
+VAL_FIXNUM       = 4
+VAL_FLONUM       = 5
+VAL_BIGNUM       = 6
+VAL_RATIONAL     = 7
+VAL_COMPLEX      = 8
+VAL_SYMBOL       = 9
+VAL_KEYWORD      = 10
+VAL_STRING       = 11
+VAL_CHAR         = 12
+VAL_PATH         = 13
+VAL_BYTES        = 14
+VAL_BOX          = 15
+VAL_VECTOR       = 16
+VAL_CONS         = 17
+VAL_REGEXP       = 18
+VAL_PREGEXP      = 19
+VAL_BYTE_REGEXP  = 20
+VAL_BYTE_PREGEXP = 21
+
+class ByteWriter(object):
+    """ Low-level encoder for unsigned/signed variable length integers,
+    strings and floats. """
+
+    def __init__(self):
+        self.builder = StringBuilder()
+
+    def write_byte(self, b):
+        assert 0 <= b < 256
+        self.builder.append(chr(b))
+
+    def write_uint(self, n):
+        assert n >= 0
+        while n >= 0x80:
+            self.builder.append(chr((n & 0x7f) | 0x80))
+            n >>= 7
+        self.builder.append(chr(n))
+
+    def write_int(self, n):
+        if n < 0:
+            self.write_uint(((-n) << 1) | 1)
+        else:
+            self.write_uint(n << 1)
+
+    def write_bool(self, b):
+        self.write_byte(1 if b else 0)
+
+    def write_raw_string(self, s):
+        self.write_uint(len(s))
+        self.builder.append(s)
+
+    def write_float(self, f):
+        bits = r_ulonglong(float2longlong(f))
+        for i in range(8):
+            self.builder.append(chr(intmask((bits >> (i * 8)) & 0xff)))
+
+    def build(self):
+        return self.builder.build()
+
+class ByteReader(object):
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def _check(self, n):
+        if self.pos + n > len(self.data):
+            raise DeserializationError("truncated binary AST")
+
+    def read_byte(self):
+        self._check(1)
+        b = ord(self.data[self.pos])
+        self.pos += 1
+        return b
+
+    def read_uint(self):
+        result = 0
+        shift = 0
+        while True:
+            b = self.read_byte()
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                return result
+            shift += 7
+
+    def read_int(self):
+        n = self.read_uint()
+        if n & 1:
+            return -(n >> 1)
+        return n >> 1
+
+    def read_bool(self):
+        return self.read_byte() != 0
+
+    def read_raw_string(self):
+        n = self.read_uint()
+        self._check(n)
+        start = self.pos
+        stop = start + n
+        assert stop >= 0
+        self.pos = stop
+        return self.data[start:stop]
+
+    def read_float(self):
+        self._check(8)
+        bits = r_ulonglong(0)
+        for i in range(8):
+            bits |= r_ulonglong(ord(self.data[self.pos + i])) << (i * 8)
+        self.pos += 8
+        return longlong2float(r_longlong(bits))
+
+class ASTWriter(ASTVisitor):
+    """
+    Serializes a converted module. The visit methods write the node to the
+    output stream and return the node unchanged.
+    """
+
+    def __init__(self):
+        self.out = ByteWriter()
+        self.symbols = []
+        self.symbol_index = {}
+        self.strings = []
+        self.string_index = {}
+        self.symlists = []
+        self.symlist_index = {}
+
+    # ____________________________________________________________
+    # tables
+
+    def sym_index(self, sym):
+        assert isinstance(sym, values.W_Symbol)
+        index = self.symbol_index.get(sym, -1)
+        if index == -1:
+            index = len(self.symbols)
+            self.symbols.append(sym)
+            self.symbol_index[sym] = index
+        return index
+
+    def write_sym(self, sym):
+        self.out.write_uint(self.sym_index(sym))
+
+    def write_opt_sym(self, sym):
+        if sym is None:
+            self.out.write_uint(0)
+        else:
+            self.out.write_uint(1)
+            self.write_sym(sym)
+
+    def write_syms(self, syms):
+        self.out.write_uint(len(syms))
+        for sym in syms:
+            self.write_sym(sym)
+
+    def write_str(self, s):
+        if s is None:
+            self.out.write_uint(0)
+            return
+        index = self.string_index.get(s, -1)
+        if index == -1:
+            index = len(self.strings)
+            self.strings.append(s)
+            self.string_index[s] = index
+        self.out.write_uint(index + 1)
+
+    def write_strs(self, strs):
+        if strs is None:
+            self.out.write_bool(False)
+            return
+        self.out.write_bool(True)
+        self.out.write_uint(len(strs))
+        for s in strs:
+            self.write_str(s)
+
+    def write_ints(self, ints):
+        if ints is None:
+            self.out.write_bool(False)
+            return
+        self.out.write_bool(True)
+        self.out.write_uint(len(ints))
+        for i in ints:
+            self.out.write_int(i)
+
+    def write_bools(self, bools):
+        if bools is None:
+            self.out.write_bool(False)
+            return
+        self.out.write_bool(True)
+        self.out.write_uint(len(bools))
+        for b in bools:
+            self.out.write_bool(b)
+
+    def symlist_ref(self, symlist):
+        """ Returns 0 for None, otherwise the index of symlist in the symlist
+        table plus one. The tail of a symlist always has a smaller index. """
+        if symlist is None:
+            return 0
+        index = self.symlist_index.get(symlist, -1)
+        if index == -1:
+            self.symlist_ref(symlist.prev)
+            for sym in symlist.elems:
+                self.sym_index(sym)
+            index = len(self.symlists)
+            self.symlists.append(symlist)
+            self.symlist_index[symlist] = index
+        return index + 1
+
+    def write_symlist(self, symlist):
+        self.out.write_uint(self.symlist_ref(symlist))
+
+    def write_body(self, body):
+        self.out.write_uint(len(body))
+        for b in body:
+            b.visit(self)
+
+    def write_opt_ast(self, ast):
+        if ast is None:
+            self.out.write_byte(TAG_NONE)
+        else:
+            ast.visit(self)
+
+    def write_body_pruning(self, ast):
+        assert isinstance(ast, SequencedBodyAST)
+        self.write_symlist(ast._sequenced_env_structure)
+        self.write_ints(ast._sequenced_remove_num_envs)
+
+    def write_value(self, w_val):
+        out = self.out
+        if w_val is values.w_false:
+            out.write_byte(VAL_FALSE)
+        elif w_val is values.w_true:
+            out.write_byte(VAL_TRUE)
+        elif w_val is values.w_void:
+            out.write_byte(VAL_VOID)
+        elif w_val is values.w_null:
+            out.write_byte(VAL_NULL)
+        elif isinstance(w_val, values.W_Fixnum):
+            out.write_byte(VAL_FIXNUM)
+            out.write_int(w_val.value)
+        elif isinstance(w_val, values.W_Flonum):
+            out.write_byte(VAL_FLONUM)
+            out.write_float(w_val.value)
+        elif isinstance(w_val, values.W_Bignum):
+            out.write_byte(VAL_BIGNUM)
+            self.write_str(w_val.value.str())
+        elif isinstance(w_val, values.W_Rational):
+            out.write_byte(VAL_RATIONAL)
+            self.write_str(w_val._numerator.str())
+            self.write_str(w_val._denominator.str())
+        elif isinstance(w_val, values.W_Complex):
+            out.write_byte(VAL_COMPLEX)
+            self.write_value(w_val.real)
+            self.write_value(w_val.imag)
+        elif isinstance(w_val, values.W_Symbol):
+            out.write_byte(VAL_SYMBOL)
+            self.write_sym(w_val)
+        elif isinstance(w_val, values.W_Keyword):
+            out.write_byte(VAL_KEYWORD)
+            self.write_str(w_val.value)
+        elif isinstance(w_val, values_string.W_String):
+            if not w_val.immutable():
+                raise SerializationError("cannot serialize mutable string")
+            out.write_byte(VAL_STRING)
+            self.write_str(w_val.as_str_utf8())
+        elif isinstance(w_val, values.W_Character):
+            out.write_byte(VAL_CHAR)
+            out.write_uint(ord(w_val.value))
+        elif isinstance(w_val, values.W_Path):
+            out.write_byte(VAL_PATH)
+            self.write_str(w_val.path)
+        elif isinstance(w_val, values.W_ImmutableBytes):
+            out.write_byte(VAL_BYTES)
+            out.write_raw_string("".join(w_val.value))
+        elif isinstance(w_val, values.W_IBox):
+            out.write_byte(VAL_BOX)
+            self.write_value(w_val.value)
+        elif isinstance(w_val, vector.W_Vector) and w_val.immutable():
+            out.write_byte(VAL_VECTOR)
+            out.write_uint(w_val.length())
+            for i in range(w_val.length()):
+                self.write_value(w_val.ref(i))
+        elif isinstance(w_val, values.W_Cons):
+            out.write_byte(VAL_CONS)
+            self.write_value(w_val.car())
+            self.write_value(w_val.cdr())
+        elif isinstance(w_val, values_regex.W_Regexp):
+            out.write_byte(VAL_REGEXP)
+            self.write_str(w_val.source)
+        elif isinstance(w_val, values_regex.W_PRegexp):
+            out.write_byte(VAL_PREGEXP)
+            self.write_str(w_val.source)
+        elif isinstance(w_val, values_regex.W_ByteRegexp):
+            out.write_byte(VAL_BYTE_REGEXP)
+            self.write_str(w_val.source)
+        elif isinstance(w_val, values_regex.W_BytePRegexp):
+            out.write_byte(VAL_BYTE_PREGEXP)
+            self.write_str(w_val.source)
+        else:
+            raise SerializationError("cannot serialize quoted value %s" % w_val.tostring())
+
+    def write_srcloc(self, info):
+        out = self.out
+        if info is None:
+            out.write_bool(False)
+            return
+        out.write_bool(True)
+        out.write_int(info.position)
+        out.write_int(info.line)
+        out.write_int(info.column)
+        out.write_int(info.span)
+        self.write_str(info.sourcefile)
+
+    # ____________________________________________________________
+    # AST nodes
+
+    def visit_module(self, ast):
+        assert isinstance(ast, Module)
+        self.out.write_byte(TAG_MODULE)
+        self.write_str(ast.name)
+        keys = ast.config.keys()
+        self.out.write_uint(len(keys))
+        for key in keys:
+            self.write_str(key)
+            self.write_str(ast.config[key])
+        self.write_opt_ast(ast.lang)
+        self.write_body(ast.rebuild_body())
+        return ast
+
+    def visit_require(self, ast):
+        assert isinstance(ast, Require)
+        self.out.write_byte(TAG_REQUIRE)
+        self.write_str(ast.fname)
+        self.out.write_bool(ast.loader is not None)
+        self.write_strs(ast.path)
+        return ast
+
+    def visit_quote(self, ast):
+        assert isinstance(ast, Quote)
+        self.out.write_byte(TAG_QUOTE)
+        self.write_value(ast.w_val)
+        return ast
+
+    def visit_quote_syntax(self, ast):
+        assert isinstance(ast, QuoteSyntax)
+        self.out.write_byte(TAG_QUOTE_SYNTAX)
+        self.write_value(ast.w_val)
+        return ast
+
+    def visit_variable_reference(self, ast):
+        assert isinstance(ast, VariableReference)
+        self.out.write_byte(TAG_VARIABLE_REFERENCE)
+        self.write_opt_ast(ast.var)
+        self.write_str(ast.path)
+        self.out.write_bool(ast.is_mut)
+        return ast
+
+    def visit_with_continuation_mark(self, ast):
+        assert isinstance(ast, WithContinuationMark)
+        self.out.write_byte(TAG_WCM)
+        ast.key.visit(self)
+        ast.value.visit(self)
+        ast.body.visit(self)
+        return ast
+
+    def visit_app(self, ast):
+        assert isinstance(ast, App)
+        self.out.write_byte(TAG_APP)
+        self.write_symlist(ast.env_structure)
+        ast.rator.visit(self)
+        self.write_body(ast.rands)
+        return ast
+
+    def visit_loop(self, ast):
+        assert isinstance(ast, Loop)
+        self.out.write_byte(TAG_LOOP)
+        self.write_symlist(ast.env_structure)
+        ast.rator.visit(self)
+        self.write_body(ast.rands)
+        return ast
+
+    def visit_recur(self, ast):
+        assert isinstance(ast, Recur)
+        self.out.write_byte(TAG_RECUR)
+        self.write_symlist(ast.env_structure)
+        ast.rator.visit(self)
+        self.write_body(ast.rands)
+        return ast
+
+    def visit_begin0(self, ast):
+        assert isinstance(ast, Begin0)
+        self.out.write_byte(TAG_BEGIN0)
+        ast.first.visit(self)
+        self.write_body(ast.body)
+        self.write_body_pruning(ast)
+        return ast
+
+    def visit_begin(self, ast):
+        assert isinstance(ast, Begin)
+        self.out.write_byte(TAG_BEGIN)
+        self.write_body(ast.body)
+        self.write_body_pruning(ast)
+        return ast
+
+    def visit_begin_for_syntax(self, ast):
+        assert isinstance(ast, BeginForSyntax)
+        self.out.write_byte(TAG_BEGIN_FOR_SYNTAX)
+        self.write_body(ast.body)
+        return ast
+
+    def visit_cell_ref(self, ast):
+        assert isinstance(ast, CellRef)
+        self.out.write_byte(TAG_CELL_REF)
+        self.write_sym(ast.sym)
+        self.write_symlist(ast.env_structure)
+        return ast
+
+    def visit_lexical_var(self, ast):
+        assert isinstance(ast, LexicalVar)
+        self.out.write_byte(TAG_LEXICAL_VAR)
+        self.write_sym(ast.sym)
+        self.write_symlist(ast.env_structure)
+        return ast
+
+    def visit_module_var(self, ast):
+        assert isinstance(ast, ModuleVar)
+        self.out.write_byte(TAG_MODULE_VAR)
+        self.write_sym(ast.sym)
+        self.write_str(ast.srcmod)
+        self.write_sym(ast.srcsym)
+        self.write_strs(ast.path)
+        return ast
+
+    def visit_toplevel_var(self, ast):
+        assert isinstance(ast, ToplevelVar)
+        self.out.write_byte(TAG_TOPLEVEL_VAR)
+        self.write_sym(ast.sym)
+        self.write_symlist(ast.env_structure)
+        return ast
+
+    def visit_set_bang(self, ast):
+        assert isinstance(ast, SetBang)
+        self.out.write_byte(TAG_SET_BANG)
+        ast.var.visit(self)
+        ast.rhs.visit(self)
+        return ast
+
+    def visit_if(self, ast):
+        assert isinstance(ast, If)
+        self.out.write_byte(TAG_IF)
+        ast.tst.visit(self)
+        ast.thn.visit(self)
+        ast.els.visit(self)
+        return ast
+
+    def visit_case_lambda(self, ast):
+        assert isinstance(ast, CaseLambda)
+        self.out.write_byte(TAG_CASE_LAMBDA)
+        self.write_opt_sym(ast.recursive_sym)
+        arity = ast._arity
+        self.write_ints(arity.arity_list)
+        self.out.write_int(arity.at_least)
+        self.write_body(ast.lams)
+        return ast
+
+    def visit_lambda(self, ast):
+        assert isinstance(ast, Lambda)
+        self.out.write_byte(TAG_LAMBDA)
+        self.write_syms(ast.formals)
+        self.write_opt_sym(ast.rest)
+        self.write_symlist(ast.args)
+        self.write_symlist(ast.frees)
+        self.write_symlist(ast.enclosing_env_structure)
+        self.write_symlist(ast.env_structure)
+        self.write_srcloc(ast.sourceinfo)
+        self.write_bools(ast._mutable_var_flags)
+        self.write_body_pruning(ast)
+        ast.force_body()
+        out = self.out
+        self.out = ByteWriter()
+        self.write_body(ast.body)
+        body = self.out.build()
+        self.out = out
+        out.write_raw_string(body)
+        return ast
+
+    def visit_letrec(self, ast):
+        assert isinstance(ast, Letrec)
+        self.out.write_byte(TAG_LETREC)
+        self.write_symlist(ast.args)
+        self.write_ints(ast.counts)
+        self.write_body(ast.rhss)
+        self.write_body(ast.body)
+        self.write_body_pruning(ast)
+        return ast
+
+    def visit_let(self, ast):
+        assert isinstance(ast, Let)
+        self.out.write_byte(TAG_LET)
+        self.write_symlist(ast.args)
+        self.write_ints(ast.counts)
+        self.write_ints(ast.remove_num_envs)
+        self.write_bools(ast._mutable_var_flags)
+        self.write_body(ast.rhss)
+        self.write_body(ast.body)
+        self.write_body_pruning(ast)
+        return ast
+
+    def visit_define_values(self, ast):
+        assert isinstance(ast, DefineValues)
+        self.out.write_byte(TAG_DEFINE_VALUES)
+        self.write_syms(ast.names)
+        self.write_syms(ast.display_names)
+        ast.rhs.visit(self)
+        return ast
+
+    def visit_cell(self, ast):
+        assert isinstance(ast, Cell)
+        self.out.write_byte(TAG_CELL)
+        self.write_bools(ast.need_cell_flags)
+        ast.expr.visit(self)
+        return ast
+
+    # ____________________________________________________________
+
+    def serialize(self, module, flags):
+        assert isinstance(module, Module)
+        module.visit(self)
+        tree = self.out.build()
+        header = self.write_header(MAGIC, flags, module.inlined_from)
+        header.builder.append(tree)
+        return header.build()
+
+    def serialize_image(self, names, modules, flags):
+        assert len(names) == len(modules)
+        trees = [None] * len(modules)
+        for i in range(len(modules)):
+            module = modules[i]
+            assert isinstance(module, Module)
+            self.out = ByteWriter()
+            module.visit(self)
+            trees[i] = self.out.build()
+        # the modules inlined from are part of the image
+        out = self.write_header(IMAGE_MAGIC, flags, [])
+        out.write_uint(len(names))
+        for i in range(len(names)):
+            out.write_raw_string(names[i])
+            out.write_raw_string(trees[i])
+        return out.build()
+
+    def write_header(self, magic, flags, inlined_from):
+        header = ByteWriter()
+        header.builder.append(magic)
+        header.write_uint(FORMAT_VERSION)
+        header.write_uint(flags)
+        header.write_uint(len(inlined_from))
+        for name in inlined_from:
+            header.write_raw_string(name)
+        header.write_uint(len(self.symbols))
+        for sym in self.symbols:
+            if sym.unreadable:
+                kind = SYM_UNREADABLE
+            elif sym.is_interned():
+                kind = SYM_INTERNED
+            else:
+                kind = SYM_UNINTERNED
+            header.write_byte(kind)
+            header.write_raw_string(sym.utf8value)
+        header.write_uint(len(self.strings))
+        for s in self.strings:
+            header.write_raw_string(s)
+        header.write_uint(len(self.symlists))
+        for symlist in self.symlists:
+            header.write_uint(len(symlist.elems))
+            for sym in symlist.elems:
+                header.write_uint(self.symbol_index[sym])
+            header.write_uint(self.symlist_index[symlist.prev] + 1
+                              if symlist.prev is not None else 0)
+        return header
+
+class SerializedBody(LazyBody):
+    """ A lambda body which is decoded from the serialized module when the
+    lambda is first called. """
+
+    _immutable_fields_ = ["reader", "pos"]
+
+    def __init__(self, reader, pos):
+        self.reader = reader
+        self.pos = pos
+
+    def load(self):
+        return self.reader.fork(self.pos).read_body()
+
+class ASTReader(ByteReader):
+    """
+    Reconstructs a module serialized by |ASTWriter|. Requires are bound to the
+    given loader, which is consulted lazily when the module is instantiated.
+    If lazy is set, lambda bodies are only decoded when they are first needed.
+    """
+
+    def __init__(self, data, loader, lazy=False):
+        ByteReader.__init__(self, data)
+        self.loader = loader
+        self.lazy = lazy
+        self.inlined_from = []
+        self.symbols = []
+        self.strings = []
+        self.symlists = []
+
+    def fork(self, pos):
+        reader = ASTReader(self.data, self.loader, self.lazy)
+        reader.symbols = self.symbols
+        reader.strings = self.strings
+        reader.symlists = self.symlists
+        reader.pos = pos
+        return reader
+
+    def read_header(self, flags, magic=MAGIC):
+        if not self.data.startswith(magic):
+            raise DeserializationError("not a binary AST file")
+        self.pos = len(magic)
+        if self.read_uint() != FORMAT_VERSION:
+            raise DeserializationError("binary AST format version mismatch")
+        if self.read_uint() != flags:
+            raise DeserializationError("binary AST was built with different flags")
+        num_inlined = self.read_uint()
+        inlined_from = [None] * num_inlined
+        for i in range(num_inlined):
+            inlined_from[i] = self.read_raw_string()
+        self.inlined_from = inlined_from
+        num_symbols = self.read_uint()
+        symbols = [None] * num_symbols
+        for i in range(num_symbols):
+            kind = self.read_byte()
+            name = self.read_raw_string()
+            if kind == SYM_INTERNED:
+                symbols[i] = values.W_Symbol.make(name)
+            elif kind == SYM_UNREADABLE:
+                symbols[i] = values.W_Symbol.make_unreadable(name)
+            else:
+                symbols[i] = values.W_Symbol(name)
+        self.symbols = symbols
+        num_strings = self.read_uint()
+        strings = [None] * num_strings
+        for i in range(num_strings):
+            strings[i] = self.read_raw_string()
+        self.strings = strings
+        num_symlists = self.read_uint()
+        symlists = [None] * num_symlists
+        for i in range(num_symlists):
+            n = self.read_uint()
+            elems = [None] * n
+            for j in range(n):
+                elems[j] = self.read_sym()
+            prev = None
+            prev_ref = self.read_uint()
+            if prev_ref:
+                if prev_ref > i:
+                    raise DeserializationError("bad environment structure table")
+                prev = symlists[prev_ref - 1]
+            symlists[i] = SymList(elems, prev)
+        self.symlists = symlists
+
+    # ____________________________________________________________
+    # tables
+
+    def read_sym(self):
+        index = self.read_uint()
+        if index >= len(self.symbols):
+            raise DeserializationError("symbol index out of range")
+        return self.symbols[index]
+
+    def read_opt_sym(self):
+        if self.read_uint() == 0:
+            return None
+        return self.read_sym()
+
+    def read_syms(self):
+        n = self.read_uint()
+        return [self.read_sym() for i in range(n)]
+
+    def read_str(self):
+        index = self.read_uint()
+        if index == 0:
+            return None
+        index -= 1
+        if index >= len(self.strings):
+            raise DeserializationError("string index out of range")
+        return self.strings[index]
+
+    def read_nonnull_str(self):
+        s = self.read_str()
+        if s is None:
+            raise DeserializationError("unexpected missing string")
+        return s
+
+    def read_strs(self):
+        if not self.read_bool():
+            return None
+        n = self.read_uint()
+        return [self.read_nonnull_str() for i in range(n)]
+
+    def read_ints(self):
+        if not self.read_bool():
+            return None
+        n = self.read_uint()
+        return [self.read_int() for i in range(n)]
+
+    def read_nonnull_ints(self):
+        ints = self.read_ints()
+        if ints is None:
+            raise DeserializationError("unexpected missing integer list")
+        return ints
+
+    def read_bools(self):
+        if not self.read_bool():
+            return None
+        n = self.read_uint()
+        return [self.read_bool() for i in range(n)]
+
+    def read_symlist(self):
+        ref = self.read_uint()
+        if ref == 0:
+            return None
+        if ref > len(self.symlists):
+            raise DeserializationError("environment structure index out of range")
+        return self.symlists[ref - 1]
+
+    def read_body(self):
+        n = self.read_uint()
+        return [self.read_ast() for i in range(n)]
+
+    def read_opt_ast(self):
+        if self.data[self.pos] == chr(TAG_NONE):
+            self.pos += 1
+            return None
+        return self.read_ast()
+
+    def read_body_pruning(self, ast):
+        assert isinstance(ast, SequencedBodyAST)
+        env_structure = self.read_symlist()
+        remove_num_envs = self.read_ints()
+        if remove_num_envs is not None:
+            ast.init_body_pruning(env_structure, remove_num_envs)
+
+    def read_value(self):
+        tag = self.read_byte()
+        if tag == VAL_FALSE:
+            return values.w_false
+        if tag == VAL_TRUE:
+            return values.w_true
+        if tag == VAL_VOID:
+            return values.w_void
+        if tag == VAL_NULL:
+            return values.w_null
+        if tag == VAL_FIXNUM:
+            return values.W_Fixnum.make(self.read_int())
+        if tag == VAL_FLONUM:
+            return values.W_Flonum(self.read_float())
+        if tag == VAL_BIGNUM:
+            return values.W_Bignum(rbigint.fromdecimalstr(self.read_nonnull_str()))
+        if tag == VAL_RATIONAL:
+            num = rbigint.fromdecimalstr(self.read_nonnull_str())
+            den = rbigint.fromdecimalstr(self.read_nonnull_str())
+            return values.W_Rational.frombigint(num, den)
+        if tag == VAL_COMPLEX:
+            real = self.read_value()
+            imag = self.read_value()
+            assert isinstance(real, values.W_Real)
+            assert isinstance(imag, values.W_Real)
+            return values.W_Complex(real, imag)
+        if tag == VAL_SYMBOL:
+            return self.read_sym()
+        if tag == VAL_KEYWORD:
+            return values.W_Keyword.make(self.read_nonnull_str())
+        if tag == VAL_STRING:
+            return values_string.W_String.make(self.read_nonnull_str())
+        if tag == VAL_CHAR:
+            return values.W_Character(unichr(self.read_uint()))
+        if tag == VAL_PATH:
+            return values.W_Path(self.read_nonnull_str())
+        if tag == VAL_BYTES:
+            s = self.read_raw_string()
+            return values.W_ImmutableBytes([c for c in s])
+        if tag == VAL_BOX:
+            return values.W_IBox(self.read_value())
+        if tag == VAL_VECTOR:
+            n = self.read_uint()
+            elems = [self.read_value() for i in range(n)]
+            return vector.W_Vector.fromelements(elems, immutable=True)
+        if tag == VAL_CONS:
+            car = self.read_value()
+            cdr = self.read_value()
+            return values.W_Cons.make(car, cdr)
+        if tag == VAL_REGEXP:
+            return values_regex.W_Regexp(self.read_nonnull_str())
+        if tag == VAL_PREGEXP:
+            return values_regex.W_PRegexp(self.read_nonnull_str())
+        if tag == VAL_BYTE_REGEXP:
+            return values_regex.W_ByteRegexp(self.read_nonnull_str())
+        if tag == VAL_BYTE_PREGEXP:
+            return values_regex.W_BytePRegexp(self.read_nonnull_str())
+        raise DeserializationError("bad value tag %d" % tag)
+
+    def read_srcloc(self):
+        from pycket.expand import SourceInfo
+        if not self.read_bool():
+            return None
+        position = self.read_int()
+        line = self.read_int()
+        column = self.read_int()
+        span = self.read_int()
+        sourcefile = self.read_str()
+        return SourceInfo(position, line, column, span, sourcefile)
+
+    # ____________________________________________________________
+    # AST nodes
+
+    def read_ast(self):
+        tag = self.read_byte()
+        if tag == TAG_MODULE:
+            name = self.read_nonnull_str()
+            config = {}
+            for i in range(self.read_uint()):
+                key = self.read_nonnull_str()
+                config[key] = self.read_nonnull_str()
+            lang = self.read_opt_ast()
+            body = self.read_body()
+            return Module(name, body, config, lang=lang)
+        if tag == TAG_REQUIRE:
+            fname = self.read_str()
+            has_loader = self.read_bool()
+            path = self.read_strs()
+            loader = self.loader if has_loader else None
+            return Require(fname, loader, path=path)
+        if tag == TAG_QUOTE:
+            return Quote(self.read_value())
+        if tag == TAG_QUOTE_SYNTAX:
+            return QuoteSyntax(self.read_value())
+        if tag == TAG_VARIABLE_REFERENCE:
+            var = self.read_opt_ast()
+            path = self.read_str()
+            is_mut = self.read_bool()
+            return VariableReference(var, path, is_mut)
+        if tag == TAG_WCM:
+            key = self.read_ast()
+            value = self.read_ast()
+            body = self.read_ast()
+            return WithContinuationMark(key, value, body)
+        if tag == TAG_APP:
+            env_structure = self.read_symlist()
+            rator = self.read_ast()
+            rands = self.read_body()
+            return App.make(rator, rands, env_structure)
+        if tag == TAG_LOOP:
+            env_structure = self.read_symlist()
+            rator = self.read_ast()
+            rands = self.read_body()
+            return Loop(rator, rands, env_structure)
+        if tag == TAG_RECUR:
+            env_structure = self.read_symlist()
+            rator = self.read_ast()
+            rands = self.read_body()
+            return Recur(rator, rands, env_structure)
+        if tag == TAG_BEGIN0:
+            first = self.read_ast()
+            body = self.read_body()
+            result = Begin0(first, body)
+            self.read_body_pruning(result)
+            return result
+        if tag == TAG_BEGIN:
+            result = Begin(self.read_body())
+            self.read_body_pruning(result)
+            return result
+        if tag == TAG_BEGIN_FOR_SYNTAX:
+            return BeginForSyntax(self.read_body())
+        if tag == TAG_CELL_REF:
+            sym = self.read_sym()
+            return CellRef(sym, self.read_symlist())
+        if tag == TAG_LEXICAL_VAR:
+            sym = self.read_sym()
+            return LexicalVar(sym, self.read_symlist())
+        if tag == TAG_MODULE_VAR:
+            sym = self.read_sym()
+            srcmod = self.read_str()
+            srcsym = self.read_sym()
+            path = self.read_strs()
+            return ModuleVar(sym, srcmod, srcsym, path)
+        if tag == TAG_TOPLEVEL_VAR:
+            sym = self.read_sym()
+            return ToplevelVar(sym, self.read_symlist())
+        if tag == TAG_SET_BANG:
+            var = self.read_ast()
+            rhs = self.read_ast()
+            return SetBang(var, rhs)
+        if tag == TAG_IF:
+            tst = self.read_ast()
+            thn = self.read_ast()
+            els = self.read_ast()
+            return If.make(tst, thn, els)
+        if tag == TAG_CASE_LAMBDA:
+            recursive_sym = self.read_opt_sym()
+            arity_list = self.read_nonnull_ints()
+            at_least = self.read_int()
+            lams = self.read_body()
+            return CaseLambda(lams, recursive_sym=recursive_sym,
+                              arity=Arity(arity_list, at_least))
+        if tag == TAG_LAMBDA:
+            formals = self.read_syms()
+            rest = self.read_opt_sym()
+            args = self.read_symlist()
+            frees = self.read_symlist()
+            enclosing_env_structure = self.read_symlist()
+            env_structure = self.read_symlist()
+            sourceinfo = self.read_srcloc()
+            flags = self.read_bools()
+            pruning_env_structure = self.read_symlist()
+            pruning_remove_num_envs = self.read_ints()
+            size = self.read_uint()
+            end = self.pos + size
+            if end > len(self.data):
+                raise DeserializationError("truncated binary AST")
+            if self.lazy:
+                body = None
+                lazy_body = SerializedBody(self, self.pos)
+                self.pos = end
+            else:
+                body = self.read_body()
+                lazy_body = None
+                if self.pos != end:
+                    raise DeserializationError("bad lambda body size")
+            result = Lambda(formals, rest, args, frees, body,
+                            sourceinfo=sourceinfo,
+                            enclosing_env_structure=enclosing_env_structure,
+                            env_structure=env_structure,
+                            lazy_body=lazy_body)
+            if pruning_remove_num_envs is not None:
+                result.init_body_pruning(pruning_env_structure,
+                                         pruning_remove_num_envs)
+            if flags is not None:
+                result.init_mutable_var_flags(flags)
+            return result
+        if tag == TAG_LETREC:
+            args = self.read_symlist()
+            counts = self.read_nonnull_ints()
+            rhss = self.read_body()
+            body = self.read_body()
+            result = Letrec(args, counts, rhss, body)
+            self.read_body_pruning(result)
+            return result
+        if tag == TAG_LET:
+            args = self.read_symlist()
+            counts = self.read_nonnull_ints()
+            remove_num_envs = self.read_ints()
+            flags = self.read_bools()
+            rhss = self.read_body()
+            body = self.read_body()
+            result = Let.make(args, counts, rhss, body, remove_num_envs)
+            self.read_body_pruning(result)
+            if flags is not None:
+                result.init_mutable_var_flags(flags)
+            return result
+        if tag == TAG_DEFINE_VALUES:
+            names = self.read_syms()
+            display_names = self.read_syms()
+            rhs = self.read_ast()
+            return DefineValues(names, rhs, display_names)
+        if tag == TAG_CELL:
+            flags = self.read_bools()
+            expr = self.read_ast()
+            return Cell(expr, flags)
+        raise DeserializationError("bad AST tag %d" % tag)
+
+    def deserialize(self, flags):
+        self.read_header(flags)
+        module = self.read_ast()
+        if not isinstance(module, Module):
+            raise DeserializationError("binary AST does not contain a module")
+        if self.pos != len(self.data):
+            raise DeserializationError("trailing data after binary AST")
+        module.inlined_from = self.inlined_from
+        return module
+
+    def read_image_index(self, flags):
+        """ Reads the header of an image, and returns the names of its
+        modules and the positions of their ASTs. """
+        self.read_header(flags, IMAGE_MAGIC)
+        count = self.read_uint()
+        if count == 0:
+            raise DeserializationError("image without a main module")
+        names = [None] * count
+        positions = [0] * count
+        for i in range(count):
+            names[i] = self.read_raw_string()
+            size = self.read_uint()
+            self._check(size)
+            positions[i] = self.pos
+            self.pos += size
+        if self.pos != len(self.data):
+            raise DeserializationError("trailing data after image")
+        return names, positions
+
+    def read_module_at(self, pos):
+        module = self.fork(pos).read_ast()
+        if not isinstance(module, Module):
+            raise DeserializationError("malformed module in image")
+        return module
+
+class ImageIndex(object):
+    """ The modules of an image, each decoded when it is first loaded. """
+
+    def __init__(self, data, loader, flags, lazy=False):
+        self.reader = ASTReader(data, loader, lazy)
+        self.names, positions = self.reader.read_image_index(flags)
+        self.positions = {}
+        for i in range(len(self.names)):
+            self.positions[self.names[i]] = positions[i]
+
+    def load(self, name):
+        """ Returns the module |name| of the image, or None. """
+        pos = self.positions.get(name, -1)
+        if pos < 0:
+            return None
+        return self.reader.read_module_at(pos)
+
+def serialize_module(module, flags):
+    return ASTWriter().serialize(module, flags)
+
+def deserialize_module(data, loader, flags, lazy=False):
+    return ASTReader(data, loader, lazy).deserialize(flags)
+
+def serialize_image(names, modules, flags):
+    """ Serializes the modules of a program, named by |names|, into one
+    image. The main module comes first. """
+    return ASTWriter().serialize_image(names, modules, flags)
+
+def deserialize_image(data, loader, flags, lazy=False):
+    """ Returns the names and the modules stored in an image. """
+    index = ImageIndex(data, loader, flags, lazy)
+    return index.names, [index.load(name) for name in index.names]
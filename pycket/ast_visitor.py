@@ -13,10 +13,12 @@ from pycket.interpreter import (
     Let,
     Letrec,
     LexicalVar,
+    Loop,
     Module,
     ModuleVar,
     Quote,
     QuoteSyntax,
+    Recur,
     Require,
     SetBang,
     ToplevelVar,
@@ -72,6 +74,20 @@ class ASTVisitor(object):
         rands = [a.visit(self, *args) for a in ast.rands]
         return App.make(rator, rands, ast.env_structure)
 
+    @specialize.argtype(0)
+    def visit_loop(self, ast, *args):
+        assert isinstance(ast, Loop)
+        rator = ast.rator.visit(self, *args)
+        rands = [a.visit(self, *args) for a in ast.rands]
+        return Loop(rator, rands, ast.env_structure)
+
+    @specialize.argtype(0)
+    def visit_recur(self, ast, *args):
+        assert isinstance(ast, Recur)
+        rator = ast.rator.visit(self, *args)
+        rands = [a.visit(self, *args) for a in ast.rands]
+        return Recur(rator, rands, ast.env_structure)
+
     @specialize.argtype(0)
     def visit_begin0(self, ast, *args):
         assert isinstance(ast, Begin0)
@@ -135,6 +151,7 @@ class ASTVisitor(object):
     def visit_lambda(self, ast, *args):
         from pycket.interpreter import make_lambda
         assert isinstance(ast, Lambda)
+        ast.force_body()
         body = [b.visit(self, *args) for b in ast.body]
         return make_lambda(ast.formals, ast.rest, body, sourceinfo=ast.sourceinfo)
 
@@ -24,6 +24,19 @@ class W_ProtoObject(object):
     def get_all_values(self):
         raise NotImplementedError("not a real value!")
 
+@objectmodel.always_inline
+def fixed_args_list(argc, w_arg1, w_arg2, w_arg3, w_arg4):
+    if argc == 0:
+        return []
+    if argc == 1:
+        return [w_arg1]
+    if argc == 2:
+        return [w_arg1, w_arg2]
+    if argc == 3:
+        return [w_arg1, w_arg2, w_arg3]
+    assert argc == 4
+    return [w_arg1, w_arg2, w_arg3, w_arg4]
+
 class W_Object(W_ProtoObject):
     __metaclass__ = extendabletype
     _attrs_ = []
@@ -51,6 +64,14 @@ class W_Object(W_ProtoObject):
     def call_with_extra_info(self, args, env, cont, calling_app):
         return self.call(args, env, cont)
 
+    def call_fixed(self, argc, w_arg1, w_arg2, w_arg3, w_arg4, env, cont,
+                   calling_app):
+        """ Calls with the first |argc| of the given arguments. Procedures
+        that can bind them without building the argument list override
+        this. """
+        args = fixed_args_list(argc, w_arg1, w_arg2, w_arg3, w_arg4)
+        return self.call_with_extra_info(args, env, cont, calling_app)
+
     def enable_jitting(self):
         pass # need to override in callables that are based on an AST
 
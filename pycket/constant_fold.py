@@ -0,0 +1,319 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Constant folding of assignment converted module ASTs.
+#
+# The pass evaluates applications of pure primitives to quoted operands,
+# replaces references to constant let bindings and module-level constants by
+# their values, and drops the branch of an if whose test became constant.
+#
+# It runs after assignment conversion, so every node already carries its
+# environment structure. Variables that are mutated are read through CellRefs
+# and defined through Cells at that point, so a LexicalVar or a definition
+# with a quoted right hand side is known to be immutable. Bindings are never
+# removed, since that would change the shape of the environments; they simply
+# become dead.
+#
+from pycket                   import values
+from pycket.ast_visitor       import ASTVisitor
+from pycket.error             import SchemeException
+from pycket.interpreter       import (
+    App,
+    Begin,
+    Begin0,
+    CaseLambda,
+    DefineValues,
+    If,
+    Lambda,
+    Let,
+    Letrec,
+    LexicalVar,
+    Module,
+    ModuleVar,
+    Quote,
+    SetBang,
+)
+
+# Primitives that return the same immutable result for the same arguments and
+# have no effects. They are folded through their direct one and two argument
+# entry points (see |expose|).
+FOLDABLE_PRIMITIVES = [
+    "not", "eq?", "eqv?", "equal?", "null?", "pair?", "symbol?", "string?",
+    "boolean?", "char?", "number?", "integer?", "fixnum?", "flonum?",
+    "exact?", "inexact?", "zero?", "positive?", "negative?", "odd?", "even?",
+    "add1", "sub1", "abs", "quotient", "remainder", "modulo",
+    "exact->inexact", "inexact->exact", "char->integer",
+    "car", "cdr", "caar", "cadr", "cdar", "cddr",
+    "fx+", "fx-", "fx*", "fx=", "fx<", "fx>", "fx<=", "fx>=",
+    "fl+", "fl-", "fl*", "fl/", "fl=", "fl<", "fl>", "fl<=", "fl>=",
+]
+
+# Variadic arithmetic, folded pairwise from the left
+ARITHMETIC_PRIMITIVES = [
+    "+", "-", "*", "max", "min", "bitwise-and", "bitwise-ior", "bitwise-xor",
+    "=", "<", ">", "<=", ">=",
+]
+COMPARISON_PRIMITIVES = ["=", "<", ">", "<=", ">="]
+
+_foldable = {}
+for _name in FOLDABLE_PRIMITIVES:
+    _foldable[_name] = None
+_arithmetic = {}
+for _name in ARITHMETIC_PRIMITIVES:
+    _arithmetic[_name] = None
+_comparison = {}
+for _name in COMPARISON_PRIMITIVES:
+    _comparison[_name] = None
+
+def _arith(name, w_a, w_b):
+    if name == "+":
+        return w_a.arith_add(w_b)
+    if name == "-":
+        return w_a.arith_sub(w_b)
+    if name == "*":
+        return w_a.arith_mul(w_b)
+    if name == "max":
+        return w_a.arith_max(w_b)
+    if name == "min":
+        return w_a.arith_min(w_b)
+    if name == "bitwise-and":
+        return w_a.arith_and(w_b)
+    if name == "bitwise-ior":
+        return w_a.arith_or(w_b)
+    if name == "bitwise-xor":
+        return w_a.arith_xor(w_b)
+    assert False
+
+def _compare(name, w_a, w_b):
+    if name == "=":
+        return w_a.arith_eq(w_b)
+    if name == "<":
+        return w_a.arith_lt(w_b)
+    if name == ">":
+        return w_a.arith_gt(w_b)
+    if name == "<=":
+        return w_a.arith_le(w_b)
+    if name == ">=":
+        return w_a.arith_ge(w_b)
+    assert False
+
+def _fold_arithmetic(name, args_w):
+    for w_arg in args_w:
+        if not isinstance(w_arg, values.W_Number):
+            return None
+    if len(args_w) < 2:
+        return None
+    if name in _comparison:
+        for i in range(len(args_w) - 1):
+            if not _compare(name, args_w[i], args_w[i + 1]):
+                return values.w_false
+        return values.w_true
+    w_result = args_w[0]
+    for i in range(1, len(args_w)):
+        w_result = _arith(name, w_result, args_w[i])
+    return w_result
+
+def fold_primitive_app(rator, rands):
+    """ Returns the Quote of the result of applying the primitive |rator| to
+    the quoted |rands|, or None if that is not known at compile time. """
+    if not isinstance(rator, ModuleVar) or not rator.is_primitive():
+        return None
+    args_w = [None] * len(rands)
+    for i, rand in enumerate(rands):
+        if not isinstance(rand, Quote):
+            return None
+        args_w[i] = rand.w_val
+    name = rator.srcsym.utf8value
+    try:
+        w_prim = rator._lookup_primitive()
+    except SchemeException:
+        return None
+    if not isinstance(w_prim, values.W_Prim):
+        return None
+    # errors are left for run time, where they can be handled
+    try:
+        if name in _arithmetic:
+            w_result = _fold_arithmetic(name, args_w)
+        elif name not in _foldable:
+            return None
+        elif len(args_w) == 1 and w_prim.simple1:
+            w_result = w_prim.simple1(args_w[0])
+        elif len(args_w) == 2 and w_prim.simple2:
+            w_result = w_prim.simple2(args_w[0], args_w[1])
+        else:
+            return None
+    except SchemeException:
+        return None
+    if w_result is None or isinstance(w_result, values.Values):
+        return None
+    return Quote(w_result)
+
+def _without(consts, syms):
+    """ |consts| without the bindings of |syms|, which are shadowed. """
+    for sym in syms:
+        if sym in consts:
+            break
+    else:
+        return consts
+    consts = consts.copy()
+    for sym in syms:
+        if sym in consts:
+            del consts[sym]
+    return consts
+
+class ConstantFoldVisitor(ASTVisitor):
+    """
+    Folds constants in an assignment converted AST. The extra argument of the
+    visit methods maps the symbols of the constant let bindings in scope to
+    their Quotes; the constant definitions of the module being visited are
+    kept on the visitor.
+    """
+
+    def __init__(self, modname=None):
+        self.modname = modname
+        self.module_path = None
+        self.module_consts = {}
+
+    def refers_to_current_module(self, var):
+        assert isinstance(var, ModuleVar)
+        path = var.path
+        if var.srcmod is None:
+            if path is not None:
+                for name in path:
+                    if name != ".":
+                        return False
+            return True
+        if self.modname is None or var.srcmod != self.modname:
+            return False
+        if path is None:
+            path = []
+        return path == self.module_path
+
+    def visit_module_var(self, ast, consts):
+        assert isinstance(ast, ModuleVar)
+        if ast.is_primitive() or not self.refers_to_current_module(ast):
+            return ast
+        return self.module_consts.get(ast.srcsym, ast)
+
+    def visit_lexical_var(self, ast, consts):
+        assert isinstance(ast, LexicalVar)
+        return consts.get(ast.sym, ast)
+
+    def visit_set_bang(self, ast, consts):
+        assert isinstance(ast, SetBang)
+        return SetBang(ast.var, ast.rhs.visit(self, consts))
+
+    def visit_app(self, ast, consts):
+        assert isinstance(ast, App)
+        rator = ast.rator.visit(self, consts)
+        rands = [r.visit(self, consts) for r in ast.rands]
+        folded = fold_primitive_app(rator, rands)
+        if folded is not None:
+            return folded
+        return App.make(rator, rands, ast.env_structure)
+
+    def visit_if(self, ast, consts):
+        assert isinstance(ast, If)
+        tst = ast.tst.visit(self, consts)
+        if isinstance(tst, Quote):
+            if tst.w_val is values.w_false:
+                return ast.els.visit(self, consts)
+            return ast.thn.visit(self, consts)
+        thn = ast.thn.visit(self, consts)
+        els = ast.els.visit(self, consts)
+        return If(tst, thn, els)
+
+    def visit_begin(self, ast, consts):
+        assert isinstance(ast, Begin)
+        # the length of the body has to stay the same for the env pruning
+        result = Begin([b.visit(self, consts) for b in ast.body])
+        result.copy_body_pruning(ast)
+        return result
+
+    def visit_begin0(self, ast, consts):
+        assert isinstance(ast, Begin0)
+        first = ast.first.visit(self, consts)
+        result = Begin0(first, [b.visit(self, consts) for b in ast.body])
+        result.copy_body_pruning(ast)
+        return result
+
+    def visit_case_lambda(self, ast, consts):
+        assert isinstance(ast, CaseLambda)
+        lams = [l.visit(self, consts) for l in ast.lams]
+        return CaseLambda(lams, recursive_sym=ast.recursive_sym, arity=ast._arity)
+
+    def visit_lambda(self, ast, consts):
+        assert isinstance(ast, Lambda)
+        ast.force_body()
+        consts = _without(consts, ast.args.elems)
+        body = [b.visit(self, consts) for b in ast.body]
+        result = Lambda(ast.formals, ast.rest, ast.args, ast.frees, body,
+                        sourceinfo=ast.sourceinfo,
+                        enclosing_env_structure=ast.enclosing_env_structure,
+                        env_structure=ast.env_structure)
+        result.copy_body_pruning(ast)
+        if ast._mutable_var_flags is not None:
+            result.init_mutable_var_flags(ast._mutable_var_flags)
+        return result
+
+    def visit_letrec(self, ast, consts):
+        assert isinstance(ast, Letrec)
+        consts = _without(consts, ast.args.elems)
+        rhss = [r.visit(self, consts) for r in ast.rhss]
+        body = [b.visit(self, consts) for b in ast.body]
+        result = Letrec(ast.args, ast.counts, rhss, body)
+        result.copy_body_pruning(ast)
+        return result
+
+    def visit_let(self, ast, consts):
+        assert isinstance(ast, Let)
+        rhss = [r.visit(self, consts) for r in ast.rhss]
+        vars = ast.args.elems
+        body_consts = _without(consts, vars)
+        offset = 0
+        for i, rhs in enumerate(rhss):
+            count = ast.counts[i]
+            if (count == 1 and isinstance(rhs, Quote) and
+                    not ast.is_mutable_var(offset)):
+                if body_consts is consts:
+                    body_consts = consts.copy()
+                body_consts[vars[offset]] = rhs
+            offset += count
+        body = [b.visit(self, body_consts) for b in ast.body]
+        result = Let(ast.args, ast.counts, rhss, body, ast.remove_num_envs)
+        result.copy_body_pruning(ast)
+        if ast._mutable_var_flags is not None:
+            result.init_mutable_var_flags(ast._mutable_var_flags)
+        return result
+
+    def visit_module(self, ast, consts):
+        """ Must not produce a new module AST """
+        assert isinstance(ast, Module)
+        old_path = self.module_path
+        old_consts = self.module_consts
+        self.module_path = _submodule_path(ast)
+        self.module_consts = {}
+        # a constant only replaces references in the forms following its
+        # definition, so that a use before the definition still fails
+        for i, b in enumerate(ast.body):
+            b = b.visit(self, {})
+            ast.body[i] = b
+            if (isinstance(b, DefineValues) and len(b.names) == 1 and
+                    isinstance(b.rhs, Quote)):
+                self.module_consts[b.names[0]] = b.rhs
+        self.module_path = old_path
+        self.module_consts = old_consts
+        return ast
+
+def _submodule_path(module):
+    path = []
+    while module.parent is not None:
+        path.append(module.name)
+        module = module.parent
+    path.reverse()
+    return path
+
+def constant_fold(ast, modname=None):
+    """ |modname| is the path the module was loaded from, which references
+    to its own definitions use. """
+    return ast.visit(ConstantFoldVisitor(modname), {})
@@ -10,6 +10,11 @@ class AbstractLink(object):
     def clone_links(self):
         raise NotImplementedError("abstract base class")
 
+    def relink(self, forward):
+        """ A copy of the links ending in |forward| instead of the current
+        forward link. """
+        raise NotImplementedError("abstract base class")
+
 class Link(AbstractLink):
 
     _immutable_fields_ = ["key", "next"]
@@ -30,6 +35,12 @@ class Link(AbstractLink):
             rest = next.clone_links()
         return Link(self.key, self.val, rest)
 
+    @jit.unroll_safe
+    def relink(self, forward):
+        next = self.next
+        rest = next.relink(forward) if next is not None else forward
+        return Link(self.key, self.val, rest)
+
 class ForwardLink(AbstractLink):
 
     _immutable_fields_ = ["cont"]
@@ -41,6 +52,9 @@ class ForwardLink(AbstractLink):
     def clone_links(self):
         return self
 
+    def relink(self, forward):
+        return forward
+
 class BaseCont(object):
     # Racket also keeps a separate stack for continuation marks
     # so that they can be saved without saving the whole continuation.
@@ -99,9 +113,26 @@ class BaseCont(object):
         marks = l.cont if isinstance(l, ForwardLink) else None
         return not_found, marks
 
+    @jit.unroll_safe
+    def next_marked(self):
+        """ The closest enclosing frame that has marks or may delimit them
+        (prompts and barriers), found through the forward link. The frames in
+        between have no marks and need not be visited. """
+        l = self.marks
+        while isinstance(l, Link):
+            l = l.next
+        return l.cont if isinstance(l, ForwardLink) else None
+
     @jit.unroll_safe
     def update_cm(self, k, v):
+        from pycket.prims.control import handler_cache
         from pycket.prims.equal import eqp_logic
+        from pycket.values import exn_handler_key, parameterization_key
+        from pycket.values_parameter import paramz_cache
+        if k is parameterization_key:
+            paramz_cache.clear()
+        elif k is exn_handler_key:
+            handler_cache.invalidate(self)
         l = self.marks
         while isinstance(l, Link):
             if eqp_logic(l.key, k):
@@ -159,10 +190,73 @@ class NilCont(BaseCont):
         from pycket.interpreter import Done
         raise Done(vals)
 
+# The bottom frame of the continuation segment a coroutine runs in. Its
+# continuation is the one of the latest resume, which is stored in the
+# coroutine, so resuming and yielding swap the whole segment in and out
+# without copying or scanning any of its frames.
+class CoroutineBase(BaseCont):
+
+    _attrs_ = _immutable_fields_ = ['coroutine']
+
+    def __init__(self, coroutine):
+        BaseCont.__init__(self)
+        self.coroutine = coroutine
+
+    def _clone(self):
+        # there is one such frame per coroutine
+        return self
+
+    def clone(self):
+        # the marks of the base are those of the current resume, shared by
+        # every continuation captured in the coroutine
+        return self
+
+    def relink(self, cont):
+        """ Continues the marks of the segment with those of |cont|. """
+        from pycket.prims.control import handler_cache
+        from pycket.values_parameter import paramz_cache
+        self.marks = get_forward_mark(cont)
+        # the parameterization and handlers of the frames above may change
+        paramz_cache.clear()
+        handler_cache.invalidate(self)
+
+    def get_previous_continuation(self, upto=[]):
+        return self.coroutine.resumer
+
+    def get_ast(self):
+        resumer = self.coroutine.resumer
+        return resumer.get_ast() if resumer is not None else None
+
+    def get_next_executed_ast(self):
+        resumer = self.coroutine.resumer
+        return resumer.get_next_executed_ast() if resumer is not None else None
+
+    def get_marks(self, key, upto=[]):
+        from pycket import values
+        resumer = self.coroutine.resumer
+        if resumer is None:
+            return values.w_null
+        return resumer.get_marks(key, upto=upto)
+
+    def append(self, tail, upto=None, stop=None):
+        # A copy of frames captured in the coroutine continues with a copy of
+        # the frames of the resume instead, it runs detached from the coroutine.
+        if self is stop:
+            return self
+        resumer = self.coroutine.resumer
+        if resumer is None:
+            return tail
+        return resumer.append(tail, upto, stop)
+
+    def plug_reduce(self, vals, env):
+        return self.coroutine.finish(vals, env)
+
 def get_forward_mark(prev):
     # Cannot forward through continuation prompts or barriers, as they can delimit
-    # the search for continuation marks.
-    if isinstance(prev, Prompt) or isinstance(prev, Barrier):
+    # the search for continuation marks. The marks beyond the base of a coroutine
+    # change with each resume.
+    if (isinstance(prev, Prompt) or isinstance(prev, Barrier) or
+            isinstance(prev, CoroutineBase)):
         return ForwardLink(prev)
 
     assert isinstance(prev, BaseCont)
@@ -196,20 +290,28 @@ class Cont(BaseCont):
         if self is stop:
             return self.clone()
         rest = self.prev.append(tail, upto, stop)
-        head = self.clone()
+        head = self._clone()
         assert isinstance(head, Cont)
         head.prev = rest
+        # the forward link of the marks points into the continuation this
+        # frame was captured from, the copy has to forward to the new tail
+        forward = get_forward_mark(rest)
+        marks = self.marks
+        head.marks = marks.relink(forward) if marks is not None else forward
         return head
 
     def get_marks(self, key, upto=[]):
         from pycket import values
         while self is not None:
             v, _ = self.find_cm(key)
-            prev = self.get_previous_continuation(upto=upto)
+            if self.get_previous_continuation(upto=upto) is None:
+                next = None
+            else:
+                next = self.next_marked()
             if v is not None:
-                rest = prev.get_marks(key, upto=upto) if prev is not None else values.w_null
+                rest = next.get_marks(key, upto=upto) if next is not None else values.w_null
                 return values.W_Cons.make(v, rest)
-            self = prev
+            self = next
         return values.w_null
 
 class Prompt(Cont):
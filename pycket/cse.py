@@ -0,0 +1,470 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Common subexpression elimination for applications of pure primitives.
+#
+# After A-normalization, a primitive application with simple operands is
+# either bound by a let or appears directly as an operand of another
+# application. A let binding of such an application makes its result
+# available in the body of the let:
+#
+#   (let ([n (vector-length v)]) ... (vector-length v) ...)
+#
+# becomes (let ([n (vector-length v)]) ... n ...), and an application that
+# occurs twice among the operands of an application is bound once:
+#
+#   (+ (car x) (car x))  =>  (let ([t (car x)]) (+ t t))
+#
+# A let binding a variable to an available result is dropped and references
+# to its variable are renamed. A let whose right hand sides repeat an earlier
+# one is split, so that the later ones can refer to its variable.
+#
+# Which primitives qualify is recorded when they are exposed (see |expose|).
+# The result of a |pure| primitive only depends on its arguments. The result
+# of a |reads_mutable| one also depends on the contents of its arguments, so
+# it stops being available at the next set!, vector-set!, struct mutation or
+# call of anything but such a primitive. Variables that are assigned are
+# never operands of available applications, and nothing is available in the
+# body of a lambda, which runs later.
+#
+# The pass runs between loop recognition and assignment conversion, so the
+# environment structures of the new bindings are computed like any other.
+#
+from pycket                   import values
+from pycket.ast_visitor       import ASTVisitor
+from pycket.error             import SchemeException
+from pycket.interpreter       import (
+    App,
+    Begin,
+    Begin0,
+    CaseLambda,
+    Gensym,
+    If,
+    Lambda,
+    Let,
+    Letrec,
+    LexicalVar,
+    Loop,
+    Module,
+    ModuleVar,
+    Quote,
+    Recur,
+    SetBang,
+    WithContinuationMark,
+    make_lambda,
+    make_let,
+    make_letrec,
+)
+from pycket.lambda_lift       import assigned_vars
+from pycket.loops             import count_uses
+
+# How the result of an application depends on the program state
+NOT_AVAILABLE = 0
+READS_MUTABLE = 1
+PURE          = 2
+
+def primitive_kind(ast):
+    """ How the result of |ast| depends on the program state if it applies a
+    primitive that qualifies, NOT_AVAILABLE otherwise. """
+    if not isinstance(ast, App) or isinstance(ast, Loop) or isinstance(ast, Recur):
+        return NOT_AVAILABLE
+    rator = ast.rator
+    if not isinstance(rator, ModuleVar) or not rator.is_primitive():
+        return NOT_AVAILABLE
+    try:
+        w_prim = rator._lookup_primitive()
+    except SchemeException:
+        return NOT_AVAILABLE
+    if not isinstance(w_prim, values.W_Prim) or w_prim.result_arity is None:
+        return NOT_AVAILABLE
+    if w_prim.pure:
+        return PURE
+    if w_prim.reads_mutable:
+        return READS_MUTABLE
+    return NOT_AVAILABLE
+
+def inline_apps(ast, apps):
+    """ Appends the applications among the operands of |ast| to |apps|, in
+    the order they are evaluated in. """
+    for rand in ast.rands:
+        if isinstance(rand, App) and not isinstance(rand, Loop):
+            inline_apps(rand, apps)
+            apps.append(rand)
+
+def mentions(ast, syms):
+    for sym in syms:
+        if ast.free_vars().haskey(sym):
+            return True
+    return False
+
+class Entry(object):
+    """ An available application and the variable holding its result. """
+
+    def __init__(self, app, sym, kind, next):
+        self.app = app
+        self.sym = sym
+        self.kind = kind
+        self.next = next
+
+class Available(object):
+    """
+    The applications whose results are available at a point of the program,
+    most recent first, and the variables whose bindings were dropped, mapped
+    to the variables they are renamed to. Never changed once built.
+    """
+
+    def __init__(self, entries=None, renames=None):
+        self.entries = entries
+        if renames is None:
+            renames = {}
+        self.renames = renames
+
+    def resolve(self, sym):
+        return self.renames.get(sym, sym)
+
+    def same_rand(self, rand, known):
+        if isinstance(rand, LexicalVar):
+            return (isinstance(known, LexicalVar) and
+                    self.resolve(rand.sym) is known.sym)
+        if isinstance(rand, Quote):
+            if not isinstance(known, Quote):
+                return False
+            w_a, w_b = rand.w_val, known.w_val
+            if w_a is w_b:
+                return True
+            return (isinstance(w_a, values.W_Fixnum) and
+                    isinstance(w_b, values.W_Fixnum) and
+                    w_a.value == w_b.value)
+        if isinstance(rand, App):
+            if isinstance(known, LexicalVar):
+                return self.lookup(rand) is known.sym
+            return isinstance(known, App) and self.same_app(rand, known)
+        return False
+
+    def same_app(self, app, known):
+        """ Whether |app| computes what the application |known| computes,
+        with the results of available applications among its operands. """
+        rator, known_rator = app.rator, known.rator
+        if (not isinstance(rator, ModuleVar) or
+                not isinstance(known_rator, ModuleVar) or
+                rator.srcsym is not known_rator.srcsym):
+            return False
+        if len(app.rands) != len(known.rands):
+            return False
+        for i, rand in enumerate(app.rands):
+            if not self.same_rand(rand, known.rands[i]):
+                return False
+        return True
+
+    def lookup(self, app):
+        """ The variable holding the result of |app|, or None. """
+        entry = self.entries
+        while entry is not None:
+            if self.same_app(app, entry.app):
+                return entry.sym
+            entry = entry.next
+        return None
+
+    def add(self, app, sym, kind):
+        return Available(Entry(app, sym, kind, self.entries), self.renames)
+
+    def rename(self, sym, new_sym):
+        renames = self.renames.copy()
+        renames[sym] = new_sym
+        return Available(self.entries, renames)
+
+    def _keep(self, pred, syms):
+        kept = []
+        entry = self.entries
+        while entry is not None:
+            if pred(entry, syms):
+                kept.append(entry)
+            entry = entry.next
+        entries = None
+        for i in range(len(kept) - 1, -1, -1):
+            entry = kept[i]
+            entries = Entry(entry.app, entry.sym, entry.kind, entries)
+        return entries
+
+    def without_reads(self):
+        """ The available results that survive a mutation. """
+        return Available(self._keep(_is_pure, None), self.renames)
+
+    def without(self, syms):
+        """ The available results that survive binding |syms| again. """
+        renames = self.renames
+        for sym, new_sym in self.renames.items():
+            if sym in syms or new_sym in syms:
+                if renames is self.renames:
+                    renames = self.renames.copy()
+                del renames[sym]
+        return Available(self._keep(_not_mentioning, syms), renames)
+
+    def in_lambda(self, syms):
+        """ What is available in the body of a lambda binding |syms|. """
+        return Available(None, self.renames).without(syms)
+
+def _is_pure(entry, syms):
+    return entry.kind == PURE
+
+def _not_mentioning(entry, syms):
+    return entry.sym not in syms and not mentions(entry.app, syms)
+
+class CSEVisitor(ASTVisitor):
+    """
+    Eliminates common subexpressions in a normalized AST that has not been
+    assignment converted. The argument of the visit methods is the Available
+    at the node.
+    """
+
+    def __init__(self):
+        self.assigned = {}
+        self.effects = {}
+
+    def classify(self, ast):
+        """ How the result of the application |ast| depends on the program
+        state, NOT_AVAILABLE if it cannot be reused. """
+        kind = primitive_kind(ast)
+        if kind == NOT_AVAILABLE:
+            return NOT_AVAILABLE
+        assert isinstance(ast, App)
+        for rand in ast.rands:
+            if isinstance(rand, Quote):
+                continue
+            if isinstance(rand, LexicalVar):
+                if rand.sym in self.assigned:
+                    return NOT_AVAILABLE
+                continue
+            kind = min(kind, self.classify(rand))
+            if kind == NOT_AVAILABLE:
+                return NOT_AVAILABLE
+        return kind
+
+    def mutates(self, ast):
+        """ Whether evaluating |ast| may change mutable state. Creating a
+        lambda does not run its body. """
+        if isinstance(ast, CaseLambda) or isinstance(ast, Lambda):
+            return False
+        if ast in self.effects:
+            return self.effects[ast]
+        result = False
+        if isinstance(ast, SetBang):
+            result = True
+        elif isinstance(ast, App) and primitive_kind(ast) == NOT_AVAILABLE:
+            result = True
+        else:
+            for child in ast.direct_children():
+                if self.mutates(child):
+                    result = True
+                    break
+        self.effects[ast] = result
+        return result
+
+    def after(self, avail, ast):
+        """ What remains available after evaluating |ast|. """
+        if self.mutates(ast):
+            return avail.without_reads()
+        return avail
+
+    def visit_sequence(self, body, avail):
+        new_body = [None] * len(body)
+        for i, b in enumerate(body):
+            new_body[i] = b.visit(self, avail)
+            avail = self.after(avail, b)
+        return new_body
+
+    def hoist(self, ast, apps, rest, avail):
+        """ A let around |ast| binding the first of the applications |apps|
+        evaluated at its start that is repeated later in |apps| or in |rest|,
+        or None. Applications before it must already be available, so the
+        order of evaluation is kept. """
+        for i, app in enumerate(apps):
+            if avail.lookup(app) is not None:
+                continue
+            if self.classify(app) != PURE:
+                return None
+            if self.occurs(app, apps[i + 1:] + rest, avail):
+                sym = Gensym.gensym("cse")
+                return make_let([[sym]], [app], [ast])
+            return None
+        return None
+
+    def visit_lexical_var(self, ast, avail):
+        assert isinstance(ast, LexicalVar)
+        sym = avail.resolve(ast.sym)
+        if sym is ast.sym:
+            return ast
+        return LexicalVar(sym)
+
+    def visit_app(self, ast, avail):
+        assert isinstance(ast, App)
+        apps = []
+        inline_apps(ast, apps)
+        let = self.hoist(ast, apps, [], avail)
+        if let is not None:
+            return let.visit(self, avail)
+        rator = ast.rator.visit(self, avail)
+        rands = self.visit_sequence(ast.rands, avail)
+        app = App.make(rator, rands, ast.env_structure)
+        if self.classify(app) != NOT_AVAILABLE:
+            sym = avail.lookup(app)
+            if sym is not None:
+                return LexicalVar(sym)
+        return app
+
+    def visit_if(self, ast, avail):
+        assert isinstance(ast, If)
+        tst = ast.tst
+        if isinstance(tst, App) and not isinstance(tst, Loop):
+            apps = []
+            inline_apps(tst, apps)
+            apps.append(tst)
+            let = self.hoist(ast, apps, [ast.thn, ast.els], avail)
+            if let is not None:
+                return let.visit(self, avail)
+        tst = tst.visit(self, avail)
+        avail = self.after(avail, ast.tst)
+        thn = ast.thn.visit(self, avail)
+        els = ast.els.visit(self, avail)
+        return If.make(tst, thn, els)
+
+    def visit_begin(self, ast, avail):
+        assert isinstance(ast, Begin)
+        return Begin.make(self.visit_sequence(ast.body, avail))
+
+    def visit_begin0(self, ast, avail):
+        assert isinstance(ast, Begin0)
+        first = ast.first.visit(self, avail)
+        body = self.visit_sequence(ast.body, self.after(avail, ast.first))
+        return Begin0.make(first, body)
+
+    def visit_with_continuation_mark(self, ast, avail):
+        assert isinstance(ast, WithContinuationMark)
+        key, value, body = self.visit_sequence([ast.key, ast.value, ast.body],
+                                               avail)
+        return WithContinuationMark(key, value, body)
+
+    def visit_set_bang(self, ast, avail):
+        assert isinstance(ast, SetBang)
+        return SetBang(ast.var, ast.rhs.visit(self, avail))
+
+    def visit_case_lambda(self, ast, avail):
+        assert isinstance(ast, CaseLambda)
+        if ast.recursive_sym is not None:
+            avail = avail.without([ast.recursive_sym])
+        lams = [l.visit(self, avail) for l in ast.lams]
+        return CaseLambda(lams, recursive_sym=ast.recursive_sym, arity=ast._arity)
+
+    def visit_lambda(self, ast, avail):
+        assert isinstance(ast, Lambda)
+        ast.force_body()
+        avail = avail.in_lambda(ast.args.elems)
+        body = self.visit_sequence(ast.body, avail)
+        return make_lambda(ast.formals, ast.rest, body, sourceinfo=ast.sourceinfo)
+
+    def visit_letrec(self, ast, avail):
+        assert isinstance(ast, Letrec)
+        avail = avail.without(ast.args.elems)
+        rhss = self.visit_sequence(ast.rhss, avail)
+        for rhs in ast.rhss:
+            avail = self.after(avail, rhs)
+        body = self.visit_sequence(ast.body, avail)
+        return make_letrec(ast._rebuild_args(), rhss, body)
+
+    def visit_let(self, ast, avail):
+        assert isinstance(ast, Let)
+        varss = ast._rebuild_args()
+        segments = []
+        seg_varss = []
+        seg_rhss = []
+        seg_syms = []
+        pending = []
+        renames = []
+        for i, vars in enumerate(varss):
+            rhs = ast.rhss[i]
+            if pending and not mentions(rhs, seg_syms):
+                inner = self.enter(avail, seg_syms, pending, renames)
+                if self.repeats(rhs, pending, inner):
+                    segments.append((seg_varss, seg_rhss))
+                    avail = inner
+                    seg_varss, seg_rhss, seg_syms = [], [], []
+                    pending, renames = [], []
+            new_rhs = rhs.visit(self, avail)
+            if self.mutates(rhs):
+                avail = avail.without_reads()
+                pending = [p for p in pending if p.kind == PURE]
+            seg_syms.extend(vars)
+            if len(vars) == 1 and vars[0] not in self.assigned:
+                sym = vars[0]
+                if (isinstance(new_rhs, LexicalVar) and isinstance(rhs, App) and
+                        self.can_rename(ast, i, new_rhs.sym)):
+                    # the binding is dropped, and |sym| is renamed
+                    renames.append((sym, new_rhs.sym))
+                    continue
+                kind = self.classify(new_rhs)
+                if kind != NOT_AVAILABLE:
+                    pending.append(Entry(new_rhs, sym, kind, None))
+            seg_varss.append(vars)
+            seg_rhss.append(new_rhs)
+        avail = self.enter(avail, seg_syms, pending, renames)
+        body = self.visit_sequence(ast.body, avail)
+        result = make_let(seg_varss, seg_rhss, body)
+        for i in range(len(segments) - 1, -1, -1):
+            seg_varss, seg_rhss = segments[i]
+            result = make_let(seg_varss, seg_rhss, [result])
+        return result
+
+    def repeats(self, rhs, pending, avail):
+        for entry in pending:
+            if self.occurs(entry.app, [rhs], avail):
+                return True
+        return False
+
+    def can_rename(self, ast, i, new_sym):
+        """ Whether the references to the variable bound by the |i|th binding
+        of |ast| can refer to |new_sym| instead. """
+        if new_sym in self.assigned or new_sym in ast.args.elems:
+            return False
+        for b in ast.rhss[i + 1:] + ast.body:
+            if count_uses(b, new_sym) < 0:
+                return False
+        return True
+
+    def enter(self, avail, syms, pending, renames):
+        """ What is available in the scope of a let binding |syms|, with the
+        |pending| entries and |renames| of its bindings. """
+        avail = avail.without(syms)
+        for entry in pending:
+            if not mentions(entry.app, syms):
+                avail = avail.add(entry.app, entry.sym, entry.kind)
+        for sym, new_sym in renames:
+            avail = avail.rename(sym, new_sym)
+        return avail
+
+    def occurs(self, app, asts, avail):
+        """ Whether |asts| apply what |app| applies outside of lambdas. """
+        todo = asts[:]
+        while todo:
+            ast = todo.pop()
+            if isinstance(ast, CaseLambda):
+                continue
+            if isinstance(ast, App) and avail.same_app(ast, app):
+                return True
+            todo.extend(ast.direct_children())
+        return False
+
+    def visit_module(self, ast, avail):
+        """ Must not produce a new module AST """
+        assert isinstance(ast, Module)
+        old_assigned = self.assigned
+        for i, b in enumerate(ast.body):
+            self.assigned = assigned_vars(b)
+            self.effects = {}
+            ast.body[i] = b.visit(self, Available())
+        self.assigned = old_assigned
+        self.effects = {}
+        return ast
+
+def eliminate_common_subexpressions(ast):
+    assert isinstance(ast, Module)
+    return ast.visit(CSEVisitor(), Available())
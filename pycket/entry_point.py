@@ -16,6 +16,12 @@ def register_post_run_callback(callback):
     POST_RUN_CALLBACKS.append(callback)
     return callback
 
+@register_post_run_callback
+def report_startup_profile(config, env):
+    from pycket import startup_profile
+    if startup_profile.profiler.enabled:
+        startup_profile.write_report()
+
 @register_post_run_callback
 def save_callgraph(config, env):
     if config.get('save-callgraph', False):
@@ -23,11 +29,12 @@ def save_callgraph(config, env):
             env.callgraph.write_dot_file(outfile)
 
 def make_entry_point(pycketconfig=None):
-    from pycket.expand import JsonLoader, PermException
+    from pycket.expand import JsonLoader, PermException, base_bundle_path
     from pycket.interpreter import interpret_one, ToplevelEnv, interpret_module
     from pycket.error import SchemeException
     from pycket.option_helper import parse_args, ensure_json_ast
     from pycket.values_string import W_String
+    from pycket import rpath, startup_profile
 
     def entry_point(argv):
         if not objectmodel.we_are_translated():
@@ -50,14 +57,42 @@ def make_entry_point(pycketconfig=None):
         if retval != 0 or config is None:
             return retval
         args_w = [W_String.fromstr_utf8(arg) for arg in args]
-        module_name, json_ast = ensure_json_ast(config, names)
-
+        if config.get('startup-profile', False):
+            startup_profile.profiler.enable(names.get('startup-profile-json', ""))
         entry_flag = 'byte-expand' in names
-        reader = JsonLoader(bytecode_expand=entry_flag)
-        if json_ast is None:
-            ast = reader.expand_to_ast(module_name)
+        reader = JsonLoader(bytecode_expand=entry_flag,
+                            lazy_bodies=config.get('lazy-bodies', False))
+        if 'load-image' in names:
+            module_name, ast = reader.load_image(names['load-image'])
         else:
-            ast = reader.load_json_ast_rpython(module_name, json_ast)
+            reader.load_base_bundle(base_bundle_path(argv[0]))
+            startup_profile.start(startup_profile.PHASE_EXPAND,
+                                  names.get('file', "<main>"))
+            try:
+                module_name, json_ast = ensure_json_ast(config, names)
+            finally:
+                startup_profile.stop()
+            if json_ast is not None and 'expand-jobs' in names:
+                from pycket.prefetch import prefetch_requires
+                jobs = int(names['expand-jobs'])
+                if jobs > 0:
+                    startup_profile.start(startup_profile.PHASE_PREFETCH, module_name)
+                    try:
+                        prefetch_requires(json_ast, jobs, entry_flag)
+                    finally:
+                        startup_profile.stop()
+            if json_ast is None:
+                ast = reader.expand_to_ast(module_name)
+            else:
+                ast = reader.load_json_ast_cached(module_name, json_ast)
+
+        if config.get('tree-shake', False):
+            from pycket.tree_shake import shake_program
+            startup_profile.start(startup_profile.PHASE_TREE_SHAKE, module_name)
+            try:
+                shake_program(ast, reader)
+            finally:
+                startup_profile.stop()
 
         env = ToplevelEnv(pycketconfig)
         env.globalconfig.load(ast)
@@ -65,6 +100,9 @@ def make_entry_point(pycketconfig=None):
         env.module_env.add_module(module_name, ast)
         try:
             val = interpret_module(ast, env)
+            if 'save-image' in names:
+                reader.save_image(names['save-image'],
+                                  rpath.realpath(module_name), ast)
         finally:
             from pycket.prims.input_output import shutdown
             for callback in POST_RUN_CALLBACKS:
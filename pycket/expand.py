@@ -3,15 +3,16 @@
 #
 import os
 import rpath
+import stat
 import sys
 
 from rpython.rlib import streamio
 from rpython.rlib.rbigint import rbigint
 from rpython.rlib.objectmodel import specialize, we_are_translated
-from rpython.rlib.rstring import ParseStringError, ParseStringOverflowError
+from rpython.rlib.rstring import ParseStringError, ParseStringOverflowError, StringBuilder
 from rpython.rlib.rarithmetic import string_to_int
 from rpython.rlib.unroll import unrolling_iterable
-from pycket import pycket_json
+from pycket import pycket_json, startup_profile
 from pycket.error import SchemeException
 from pycket.interpreter import *
 from pycket import values, values_string
@@ -100,6 +101,89 @@ def expand_file(fname):
         raise ExpandException("Racket produced an error")
     return data
 
+class ExpanderClient(object):
+    """
+    Client for the expansion server in pycket-lang/expand-server.rkt, which
+    keeps Racket running and expands modules on a pool of workers. If no
+    server is listening, |expand| returns None and the caller falls back to
+    starting Racket itself. The server is not asked again after a failed
+    connection.
+
+    The server runs the macros of the modules it expands, and its answers are
+    loaded as is, so only a socket of the current user is trusted. By default
+    it lives in $XDG_RUNTIME_DIR, or else in a directory of /tmp only the
+    user can enter.
+    """
+
+    _attrs_ = ["available"]
+
+    def __init__(self):
+        self.available = True
+
+    def socket_path(self):
+        path = os.environ.get("PYCKET_EXPAND_SOCKET", None)
+        if path is not None:
+            return path
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR", None)
+        if runtime_dir:
+            return runtime_dir + "/pycket-expand.sock"
+        return "/tmp/pycket-expand-%d/expand.sock" % os.getuid()
+
+    def trusted_socket(self, path):
+        """ Whether |path| is a socket owned by the current user. """
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+    def expand(self, rkt_file):
+        from rpython.rlib import rsocket
+        if not self.available or not rsocket.HAS_AF_UNIX:
+            return None
+        path = self.socket_path()
+        if not path or not self.trusted_socket(path):
+            self.available = False
+            return None
+        try:
+            sock = rsocket.RSocket(rsocket.AF_UNIX, rsocket.SOCK_STREAM)
+            try:
+                sock.connect(rsocket.UNIXAddress(path))
+                sock.sendall("expand - %s\n" % rkt_file)
+                builder = StringBuilder()
+                while True:
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        break
+                    builder.append(chunk)
+            finally:
+                sock.close()
+        except rsocket.SocketError:
+            self.available = False
+            return None
+        return self._parse_response(builder.build())
+
+    def _parse_response(self, response):
+        newline = response.find("\n")
+        if newline < 0:
+            raise ExpandException("Malformed answer from the expansion server")
+        header = response[:newline].split(" ")
+        start = newline + 1
+        if len(header) != 2:
+            raise ExpandException("Malformed answer from the expansion server")
+        try:
+            length = string_to_int(header[1])
+        except ParseStringError:
+            raise ExpandException("Malformed answer from the expansion server")
+        if length < 0 or start + length != len(response):
+            raise ExpandException("Truncated answer from the expansion server")
+        payload = response[start:]
+        if header[0] == "ok":
+            return payload
+        raise ExpandException("Racket produced an error and said '%s'" % payload)
+
+expander_client = ExpanderClient()
+
 # Call the Racket expander and read its output from STDOUT rather than producing an
 # intermediate (possibly cached) file.
 def expand_file_rpython(rkt_file, lib=_FN):
@@ -107,6 +191,10 @@ def expand_file_rpython(rkt_file, lib=_FN):
     cmd = "racket %s --stdout \"%s\" 2>&1" % (lib, rkt_file)
     if not os.access(rkt_file, os.R_OK):
         raise ValueError("Cannot access file %s" % rkt_file)
+    if lib == _FN:
+        data = expander_client.expand(rpath.realpath(rkt_file))
+        if data is not None:
+            return data
     pipe = create_popen_file(cmd, "r")
     out = pipe.read()
     err = os.WEXITSTATUS(pipe.close())
@@ -164,6 +252,17 @@ def _expand_file_to_json(rkt_file, json_file, byte_flag=False):
     except OSError:
         pass
 
+    if not byte_flag:
+        data = expander_client.expand(rpath.realpath(rkt_file))
+        if data is not None:
+            print "Expanding %s to %s (server)" % (rkt_file, json_file)
+            f = streamio.open_file_as_stream(json_file, "w")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            return json_file
+
     cmd = "racket %s --output \"%s\" \"%s\" 2>&1" % (lib, json_file, rkt_file)
 
     if byte_flag:
@@ -213,14 +312,106 @@ def needs_update(file_name, json_name):
 def _json_name(file_name):
     return file_name + '.json'
 
+def _inlined_modules_changed(module, ast_file):
+    for name in module.inlined_from:
+        if needs_update(name, ast_file):
+            return True
+    return False
+
+def _binary_ast_name(json_name):
+    if json_name.endswith('.json'):
+        to = len(json_name) - 5
+        assert to > 0
+        json_name = json_name[:to]
+    return json_name + '.ast'
+
+def _write_json_file(json_file, data):
+    """ Writes |data| to |json_file| and returns whether that succeeded. """
+    tmp_file = "%s.%d.tmp" % (json_file, os.getpid())
+    try:
+        f = streamio.open_file_as_stream(tmp_file, "w")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp_file, json_file)
+    except (OSError, IOError, streamio.StreamError):
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        return False
+    return True
+
+def expand_file_to_cache(cache, rkt_file, byte_flag=False, fallback=None):
+    """ Returns the JSON file of the expansion of |rkt_file| in |cache|,
+    expanding it first if there is no current one, or None if it could not
+    be stored. An expansion the cache could not store is written to the
+    JSON file |fallback| instead, if given, so that it is not expanded
+    again. """
+    lib = _BE if byte_flag else _FN
+    rkt_file = rpath.realpath(rkt_file)
+    json_file = cache.lookup(rkt_file, lib)
+    if json_file is None and cache.writable:
+        print "Expanding %s into %s" % (rkt_file, cache.directory)
+        data = expand_file_rpython(rkt_file, lib)
+        json_file = cache.store(rkt_file, lib, data)
+        if json_file is None and fallback is not None:
+            if _write_json_file(fallback, data):
+                json_file = fallback
+    return json_file
+
 def ensure_json_ast_run(file_name, byte_flag=False):
+    from pycket.expand_cache import get_expansion_cache
+    cache = get_expansion_cache()
     json = _json_name(file_name)
+    if cache is not None:
+        json_file = expand_file_to_cache(cache, file_name, byte_flag,
+                                         fallback=json)
+        if json_file is not None:
+            return json_file
     dbgprint("ensure_json_ast_run", json, filename=file_name)
     if needs_update(file_name, json):
         return expand_file_to_json(file_name, json, byte_flag)
     else:
         return json
 
+BASE_BUNDLE_ENV = "PYCKET_BASE_BUNDLE"
+BASE_BUNDLE_NAME = "pycket-base.image"
+
+def base_bundle_path(executable):
+    """ The bundle of pre-expanded base modules is $PYCKET_BASE_BUNDLE, or
+    pycket-base.image next to the executable. """
+    path = os.environ.get(BASE_BUNDLE_ENV)
+    if path is not None:
+        return path
+    if "/" not in executable:
+        found = ""
+        for directory in (os.environ.get("PATH") or "").split(":"):
+            candidate = rpath.join(directory, [executable])
+            if directory and os.access(candidate, os.X_OK):
+                found = candidate
+                break
+        if not found:
+            return ""
+        executable = found
+    return rpath.join(rpath.dirname(rpath.realpath(executable)), [BASE_BUNDLE_NAME])
+
+def lookup_json_ast(file_name, byte_flag=False):
+    """ Returns the JSON file of the expansion of |file_name| if it is up to
+    date, or None. """
+    from pycket.expand_cache import get_expansion_cache
+    cache = get_expansion_cache()
+    if cache is not None:
+        lib = _BE if byte_flag else _FN
+        json = cache.lookup(rpath.realpath(file_name), lib)
+        if json is not None:
+            return json
+    json = _json_name(file_name)
+    if needs_update(file_name, json):
+        return None
+    return json
+
 def ensure_json_ast_eval(code, file_name, stdlib=True, mcons=False, wrap=True):
     json = _json_name(file_name)
     if needs_update(file_name, json):
@@ -236,19 +427,31 @@ def parse_ast(json_string):
     modtable = ModTable()
     return to_ast(json, modtable)
 
-def finalize_module(mod):
+def finalize_module(mod, modname=None, modtable=None):
     from pycket.interpreter    import Context
     from pycket.assign_convert import assign_convert
+    from pycket.constant_fold  import constant_fold
+    from pycket.cse            import eliminate_common_subexpressions
+    from pycket.inline         import inline_calls
+    from pycket.lambda_lift    import lift_lambdas
+    from pycket.loops          import recognize_loops
+    from pycket.numeric_types  import specialize_numeric
+    from pycket.superinstructions import select_superinstructions
+    mod = inline_calls(mod, modname, modtable)
+    mod = lift_lambdas(mod)
     mod = Context.normalize_term(mod)
+    mod = recognize_loops(mod)
+    mod = eliminate_common_subexpressions(mod)
     mod = assign_convert(mod)
+    mod = constant_fold(mod, modname)
+    mod = specialize_numeric(mod)
+    mod = select_superinstructions(mod)
     mod.clean_caches()
     return mod
 
 def parse_module(json_string, bytecode_expand=False):
-    json = pycket_json.loads(json_string)
-    modtable = ModTable()
     reader = JsonLoader(bytecode_expand)
-    module = reader.to_module(json)
+    module = reader.to_module_from_string(json_string)
     return finalize_module(module)
 
 #### ========================== Implementation functions
@@ -421,11 +624,17 @@ def parse_path(p):
 
 class JsonLoader(object):
 
-    _immutable_fields_ = ["modtable", "bytecode_expand"]
+    _immutable_fields_ = ["modtable", "bytecode_expand", "lazy_bodies"]
 
-    def __init__(self, bytecode_expand=False):
+    def __init__(self, bytecode_expand=False, lazy_bodies=False):
         self.modtable = ModTable()
         self.bytecode_expand = bytecode_expand
+        # only decode lambda bodies from the binary AST cache when they are
+        # called for the first time
+        self.lazy_bodies = lazy_bodies
+        # pre-expanded modules, see |load_base_bundle|
+        self.bundle = None
+        self.bundle_mtime = 0.0
 
     def _lib_string(self):
         return _BE if self.bytecode_expand else _FN
@@ -434,30 +643,196 @@ class JsonLoader(object):
     def expand_to_ast(self, fname):
         assert fname is not None
         fname = rpath.realpath(fname)
-        data = expand_file_rpython(fname, self._lib_string())
-        self.modtable.enter_module(fname)
-        module = self.to_module(pycket_json.loads(data))
-        module = finalize_module(module)
-        self.modtable.exit_module(fname, module)
-        return module
+        startup_profile.start(startup_profile.PHASE_EXPAND, fname)
+        try:
+            data = expand_file_rpython(fname, self._lib_string())
+        finally:
+            startup_profile.stop()
+        return self._convert_module(fname, data)
 
     def load_json_ast_rpython(self, modname, fname):
         assert modname is not None
         modname = rpath.realpath(modname)
-        data = readfile_rpython(fname)
+        data = self._read_file(modname, fname)
+        return self._convert_module(modname, data)
+
+    def _read_file(self, modname, fname):
+        startup_profile.start(startup_profile.PHASE_READ, modname)
+        try:
+            return readfile_rpython(fname)
+        finally:
+            startup_profile.stop()
+
+    def _convert_module(self, modname, data):
         self.modtable.enter_module(modname)
-        module = self.to_module(pycket_json.loads(data))
-        module = finalize_module(module)
+        startup_profile.start(startup_profile.PHASE_TO_MODULE, modname)
+        try:
+            module = self.to_module_from_string(data)
+        finally:
+            startup_profile.stop()
+        startup_profile.start(startup_profile.PHASE_FINALIZE, modname)
+        try:
+            module = finalize_module(module, modname, self.modtable)
+        finally:
+            startup_profile.stop()
         self.modtable.exit_module(modname, module)
         return module
 
+    def load_binary_ast(self, modname, ast_file):
+        from pycket import ast_serialize
+        assert modname is not None
+        modname = rpath.realpath(modname)
+        data = self._read_file(modname, ast_file)
+        flags = ast_serialize.current_flags(self.bytecode_expand)
+        # Requires are resolved lazily, so nothing is loaded recursively here
+        startup_profile.start(startup_profile.PHASE_LOAD_BINARY, modname)
+        try:
+            module = ast_serialize.deserialize_module(data, self, flags,
+                                                      lazy=self.lazy_bodies)
+        finally:
+            startup_profile.stop()
+        self.modtable.enter_module(modname)
+        self.modtable.exit_module(modname, module)
+        return module
+
+    def save_binary_ast(self, module, ast_file):
+        from pycket import ast_serialize
+        flags = ast_serialize.current_flags(self.bytecode_expand)
+        try:
+            data = ast_serialize.serialize_module(module, flags)
+        except ast_serialize.SerializationError:
+            return
+        # Write to a temporary file first, so that a concurrent reader never
+        # sees a partially written cache.
+        tmp_file = "%s.%d.tmp" % (ast_file, os.getpid())
+        try:
+            f = streamio.open_file_as_stream(tmp_file, "w")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp_file, ast_file)
+        except (OSError, IOError, streamio.StreamError):
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+    def save_image(self, image_file, main_name, main_module):
+        """ Writes |main_module| and all the modules loaded so far into an
+        image, which |load_image| can load in one read. """
+        from pycket import ast_serialize
+        flags = ast_serialize.current_flags(self.bytecode_expand)
+        names = [main_name]
+        modules = [main_module]
+        for name, module in self.modtable.table.items():
+            if module is not None and name != main_name:
+                names.append(name)
+                modules.append(module)
+        data = ast_serialize.serialize_image(names, modules, flags)
+        f = streamio.open_file_as_stream(image_file, "w")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+    def load_image(self, image_file):
+        """ Loads all the modules of an image into the module table, and
+        returns the name of the main module and the module itself. """
+        from pycket import ast_serialize
+        flags = ast_serialize.current_flags(self.bytecode_expand)
+        data = self._read_file(image_file, image_file)
+        startup_profile.start(startup_profile.PHASE_LOAD_BINARY, image_file)
+        try:
+            names, modules = ast_serialize.deserialize_image(
+                data, self, flags, lazy=self.lazy_bodies)
+        finally:
+            startup_profile.stop()
+        image_mtime = os.stat(image_file).st_mtime
+        for i in range(len(names)):
+            try:
+                if os.stat(names[i]).st_mtime > image_mtime:
+                    raise SchemeException("image %s is out of date: %s changed"
+                                          % (image_file, names[i]))
+            except OSError:
+                pass # not a file, e.g. the module of an expression
+            self.modtable.add_module(names[i], modules[i])
+        return names[0], modules[0]
+
+    def load_base_bundle(self, bundle_file):
+        """ Makes the modules of the image |bundle_file| available to
+        |lazy_load|, which decodes each of them when it is first required.
+        Returns False if the bundle is missing or was built by another
+        version of pycket. """
+        from pycket import ast_serialize
+        if not bundle_file or not os.access(bundle_file, os.R_OK):
+            return False
+        flags = ast_serialize.current_flags(self.bytecode_expand)
+        try:
+            data = self._read_file(bundle_file, bundle_file)
+            self.bundle = ast_serialize.ImageIndex(data, self, flags,
+                                                   lazy=self.lazy_bodies)
+            self.bundle_mtime = os.stat(bundle_file).st_mtime
+        except ast_serialize.DeserializationError:
+            return False
+        except (OSError, streamio.StreamError):
+            return False
+        return True
+
+    def load_from_bundle(self, fname):
+        from pycket import ast_serialize
+        bundle = self.bundle
+        assert bundle is not None
+        try:
+            if os.stat(fname).st_mtime > self.bundle_mtime:
+                # the collection changed since the bundle was built
+                return None
+        except OSError:
+            pass
+        startup_profile.start(startup_profile.PHASE_LOAD_BINARY, fname)
+        try:
+            module = bundle.load(fname)
+        except ast_serialize.DeserializationError:
+            return None
+        finally:
+            startup_profile.stop()
+        if module is not None:
+            self.modtable.add_module(fname, module)
+        return module
+
+    # Load a module from the binary AST cache next to its JSON file. The cache
+    # is stale if it is older than the JSON file or one of the modules inlined
+    # into it, or was built by a different version of pycket or with different
+    # flags; in that case the module is loaded from the JSON file and the cache
+    # is rewritten.
+    def load_json_ast_cached(self, modname, json_file):
+        from pycket import ast_serialize
+        ast_file = _binary_ast_name(json_file)
+        if not needs_update(json_file, ast_file):
+            try:
+                module = self.load_binary_ast(modname, ast_file)
+                if not _inlined_modules_changed(module, ast_file):
+                    return module
+            except ast_serialize.DeserializationError:
+                pass
+            except (OSError, IOError, streamio.StreamError):
+                pass
+        module = self.load_json_ast_rpython(modname, json_file)
+        self.save_binary_ast(module, ast_file)
+        return module
+
     def expand_file_cached(self, rkt_file):
         dbgprint("expand_file_cached", "", lib=self._lib_string(), filename=rkt_file)
+        startup_profile.start(startup_profile.PHASE_EXPAND, rkt_file)
         try:
             json_file = ensure_json_ast_run(rkt_file, self.bytecode_expand)
         except PermException:
+            json_file = None
+        finally:
+            startup_profile.stop()
+        if json_file is None:
             return self.expand_to_ast(rkt_file)
-        return self.load_json_ast_rpython(rkt_file, json_file)
+        return self.load_json_ast_cached(rkt_file, json_file)
 
     def to_bindings(self, arr):
         varss = [None] * len(arr)
@@ -491,6 +866,10 @@ class JsonLoader(object):
         module = modtable.lookup(fname)
         if module is not None:
             return module
+        if self.bundle is not None:
+            module = self.load_from_bundle(fname)
+            if module is not None:
+                return module
         return self.expand_file_cached(fname)
 
     def _parse_require(self, path):
@@ -508,7 +887,35 @@ class JsonLoader(object):
         # YYY
         obj = json.value_object()
         assert "body-forms" in obj, "got malformed JSON from expander"
+        body = [self.to_ast(x) for x in getkey(obj, "body-forms", type='a')]
+        return self._make_module(obj, body)
+
+    # Like |to_module|, but reads the module from a pull parser. The body
+    # forms are converted to ASTs as soon as they are parsed, so at any time
+    # only the JSON tree of a single top-level form is alive.
+    def to_module_streaming(self, parser):
+        obj = {}
+        body = None
+        parser.expect(pycket_json.EV_START_OBJECT)
+        while parser.next_key():
+            key = parser.string_value
+            if key == "body-forms":
+                body = []
+                parser.expect(pycket_json.EV_START_ARRAY)
+                while parser.next_element():
+                    body.append(self.to_ast(parser.read_value()))
+            else:
+                obj[key] = parser.read_value()
+        assert body is not None, "got malformed JSON from expander"
+        return self._make_module(obj, body)
+
+    def to_module_from_string(self, data):
+        parser = pycket_json.JsonPullParser(data)
+        module = self.to_module_streaming(parser)
+        parser.finish()
+        return module
 
+    def _make_module(self, obj, body):
         config = {}
         config_obj = getkey(obj, "config", type='o')
         if config_obj is not None:
@@ -529,7 +936,6 @@ class JsonLoader(object):
         else:
             lang = self._parse_require([lang_arr[0].value_string()]) if lang_arr else None
 
-        body = [self.to_ast(x) for x in getkey(obj, "body-forms", type='a')]
         name = getkey(obj, "module-name", type='s')
         return Module(name, body, config, lang=lang)
 
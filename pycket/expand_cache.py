@@ -0,0 +1,388 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Content-addressed cache of expanded modules.
+#
+# Instead of writing foo.rkt.json next to every source and comparing mtimes,
+# expansions are stored in a central directory under a key that hashes the
+# path and contents of the source, the version of the expander and the flags
+# it was run with. The binary AST cache ends up next to the JSON entry, so
+# read-only source trees are cached as well, and touching a file without
+# changing it does not cause an expansion.
+#
+# The expansion of a module also depends on the modules it requires, because
+# of macros. Every entry therefore has a manifest recording the keys of its
+# requires at expansion time; an entry is only used if all of them are still
+# current and valid, and replacing an entry removes the entries of all the
+# modules that depend on it, transitively.
+#
+# Directory layout, with <key> the hex digest of the above:
+#
+#   <key>.json      the expanded module
+#   <key>.ast       the binary AST of it (see load_json_ast_cached)
+#   <key>.manifest  the source path on the first line, followed by one line
+#                   "<key> <path>" for every required module
+#
+# All files are written to a temporary file first and renamed into place, so
+# concurrent pycket processes never see a partially written entry. When the
+# directory grows beyond its size limit, the least recently used entries are
+# removed.
+#
+import os
+
+from rpython.rlib import rsha, streamio
+from rpython.rlib.listsort import make_timsort_class
+
+from pycket import rpath
+
+CACHE_DIR_ENV = "PYCKET_CACHE_DIR"
+CACHE_SIZE_ENV = "PYCKET_CACHE_SIZE"
+DEFAULT_MAX_SIZE = 512 # in megabytes
+
+_ENTRY_SUFFIXES = [".json", ".ast", ".manifest"]
+
+# recorded in manifests for requires whose source cannot be read
+_NO_KEY = "-"
+
+def _compute_expander_version():
+    "NOT_RPYTHON"
+    # the expanders are the Racket side of pycket; any change to them has to
+    # invalidate the cache
+    sha = rsha.RSHA()
+    for name in ["expand.rkt", "zo-expand.rkt"]:
+        fname = os.path.join(os.path.dirname(__file__), "pycket-lang", name)
+        try:
+            with open(fname) as f:
+                sha.update(f.read())
+        except IOError:
+            pass
+    return sha.hexdigest()
+
+EXPANDER_VERSION = _compute_expander_version()
+
+def _read_file(fname):
+    f = streamio.open_file_as_stream(fname)
+    try:
+        return f.readall()
+    finally:
+        f.close()
+
+def _write_file_atomic(fname, data):
+    tmp_file = "%s.%d.tmp" % (fname, os.getpid())
+    try:
+        f = streamio.open_file_as_stream(tmp_file, "w")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp_file, fname)
+    except (OSError, streamio.StreamError):
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        return False
+    return True
+
+def _remove(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+def _make_dirs(path):
+    if not path or os.access(path, os.F_OK):
+        return
+    _make_dirs(rpath.dirname(path))
+    try:
+        os.mkdir(path, 0700)
+    except OSError:
+        pass # possibly created concurrently
+
+def default_cache_dir():
+    path = os.environ.get("XDG_CACHE_HOME")
+    if not path:
+        home = os.environ.get("HOME")
+        if not home:
+            return ""
+        path = rpath.join(home, [".cache"])
+    return rpath.join(path, ["pycket"])
+
+class Manifest(object):
+    _immutable_fields_ = ["source", "dep_keys[*]", "dep_paths[*]"]
+
+    def __init__(self, source, dep_keys, dep_paths):
+        self.source = source
+        self.dep_keys = dep_keys
+        self.dep_paths = dep_paths
+
+    def tostring(self):
+        lines = [self.source]
+        for i in range(len(self.dep_keys)):
+            lines.append("%s %s" % (self.dep_keys[i], self.dep_paths[i]))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def fromstring(data):
+        lines = data.split("\n")
+        if len(lines) < 2 or lines[-1] != "":
+            return None
+        dep_keys = []
+        dep_paths = []
+        for i in range(1, len(lines) - 1):
+            line = lines[i]
+            space = line.find(" ")
+            if space <= 0:
+                return None
+            dep_keys.append(line[:space])
+            dep_paths.append(line[space + 1:])
+        return Manifest(lines[0], dep_keys, dep_paths)
+
+BaseSorter = make_timsort_class()
+
+class LeastRecentlyUsedSorter(BaseSorter):
+    def __init__(self, keys, mtimes):
+        BaseSorter.__init__(self, keys)
+        self.mtimes = mtimes
+
+    def lt(self, a, b):
+        return self.mtimes[a] < self.mtimes[b]
+
+class ExpansionCache(object):
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.keys = {}     # source path and flags -> key, or "" if unreadable
+        self.valid = {}    # key -> whether the entry can be used
+        self.manifests = None # key -> Manifest of all entries, when needed
+        self.writable = True
+
+    def reset(self):
+        """ Forgets what is known about the cache directory, after another
+        process changed it. """
+        self.keys = {}
+        self.valid = {}
+        self.manifests = None
+
+    def _entry_file(self, key, suffix):
+        return rpath.join(self.directory, [key + suffix])
+
+    def json_file(self, key):
+        return self._entry_file(key, ".json")
+
+    def key(self, rkt_file, flags):
+        """ Returns the key of the expansion of |rkt_file| with |flags| (a
+        string describing how the expander is run), or "" if the source
+        cannot be read. """
+        memo = "%s\0%s" % (flags, rkt_file)
+        key = self.keys.get(memo, None)
+        if key is None:
+            try:
+                source = _read_file(rkt_file)
+            except (OSError, streamio.StreamError):
+                key = ""
+            else:
+                sha = rsha.RSHA(EXPANDER_VERSION)
+                for part in ["\0", flags, "\0", rkt_file, "\0", source]:
+                    sha.update(part)
+                key = sha.hexdigest()
+            self.keys[memo] = key
+        return key
+
+    def read_manifest(self, key):
+        if self.manifests is not None:
+            return self.manifests.get(key, None)
+        try:
+            return Manifest.fromstring(_read_file(self._entry_file(key, ".manifest")))
+        except (OSError, streamio.StreamError):
+            return None
+
+    def is_valid(self, key, flags):
+        if key in self.valid:
+            return self.valid[key]
+        # requires are acyclic, but be safe against corrupted manifests
+        self.valid[key] = False
+        result = self._is_valid(key, flags)
+        self.valid[key] = result
+        return result
+
+    def _is_valid(self, key, flags):
+        if not os.access(self.json_file(key), os.R_OK):
+            return False
+        manifest = self.read_manifest(key)
+        if manifest is None:
+            return False
+        for i in range(len(manifest.dep_keys)):
+            dep_key = self.key(manifest.dep_paths[i], flags) or _NO_KEY
+            if dep_key != manifest.dep_keys[i]:
+                return False
+            # a required module that is not cached is expanded from the same
+            # source as before; one that is must itself be current
+            if (self.read_manifest(dep_key) is not None and
+                    not self.is_valid(dep_key, flags)):
+                return False
+        return True
+
+    def lookup(self, rkt_file, flags):
+        """ Returns the JSON file of the cached expansion of |rkt_file|, or
+        None if there is no usable one. """
+        key = self.key(rkt_file, flags)
+        if not key or not self.is_valid(key, flags):
+            return None
+        json_file = self.json_file(key)
+        try:
+            # the modification time orders entries for eviction
+            os.utime(json_file, None)
+        except OSError:
+            pass
+        return json_file
+
+    def store(self, rkt_file, flags, data):
+        """ Stores |data|, the expansion of |rkt_file| with |flags|, and
+        returns its JSON file, or None if it could not be written. """
+        from pycket.prefetch import module_requires
+        key = self.key(rkt_file, flags)
+        if not key:
+            return None
+        try:
+            requires = module_requires(data)
+        except ValueError:
+            return None
+        dep_keys = []
+        dep_paths = []
+        for path in requires:
+            if "\n" in path:
+                return None
+            dep_keys.append(self.key(path, flags) or _NO_KEY)
+            dep_paths.append(path)
+        manifest = Manifest(rkt_file, dep_keys, dep_paths)
+
+        if not self.writable:
+            return None
+        _make_dirs(self.directory)
+        self._load_manifests()
+        # everything expanded against an earlier expansion of this module
+        # has to be expanded again
+        replaced = False
+        for old_key, old_manifest in self.manifests.items():
+            if old_manifest.source == rkt_file:
+                replaced = True
+                if old_key != key:
+                    self._remove_entry(old_key)
+        if replaced:
+            self.invalidate_dependents(rkt_file)
+
+        json_file = self.json_file(key)
+        _remove(self._entry_file(key, ".ast"))
+        if (not _write_file_atomic(json_file, data) or
+                not _write_file_atomic(self._entry_file(key, ".manifest"),
+                                       manifest.tostring())):
+            # do not try again for every module
+            self.writable = False
+            return None
+        self.manifests[key] = manifest
+        self.valid[key] = True
+        self.evict(key)
+        return json_file
+
+    def _load_manifests(self):
+        if self.manifests is not None:
+            return
+        manifests = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith(".manifest"):
+                continue
+            key = name[:len(name) - len(".manifest")]
+            manifest = self.read_manifest(key)
+            if manifest is not None:
+                manifests[key] = manifest
+        self.manifests = manifests
+
+    def _remove_entry(self, key):
+        for suffix in _ENTRY_SUFFIXES:
+            _remove(self._entry_file(key, suffix))
+        if self.manifests is not None and key in self.manifests:
+            del self.manifests[key]
+        self.valid[key] = False
+
+    def invalidate_dependents(self, rkt_file):
+        """ Removes the entries of all modules that require |rkt_file|,
+        directly or indirectly. """
+        self._load_manifests()
+        todo = [rkt_file]
+        seen = {}
+        while todo:
+            path = todo.pop()
+            if path in seen:
+                continue
+            seen[path] = None
+            for key, manifest in self.manifests.items():
+                if path in manifest.dep_paths:
+                    self._remove_entry(key)
+                    todo.append(manifest.source)
+
+    def evict(self, keep=""):
+        """ Removes the least recently used entries, but not |keep|, until
+        the cache is no larger than its maximum size. """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        sizes = {}
+        mtimes = {}
+        total = 0
+        for name in names:
+            dot = name.find(".")
+            if dot <= 0:
+                continue
+            key = name[:dot]
+            try:
+                st = os.stat(rpath.join(self.directory, [name]))
+            except OSError:
+                continue
+            total += st.st_size
+            sizes[key] = sizes.get(key, 0) + st.st_size
+            if name.endswith(".json"):
+                mtimes[key] = st.st_mtime
+        if total <= self.max_size:
+            return
+        order = [key for key in mtimes.keys() if key != keep]
+        LeastRecentlyUsedSorter(order, mtimes).sort()
+        for key in order:
+            if total <= self.max_size:
+                break
+            self._remove_entry(key)
+            total -= sizes[key]
+
+class CacheHolder(object):
+    def __init__(self):
+        self.cache = None
+        self.initialized = False
+
+_holder = CacheHolder()
+
+def get_expansion_cache():
+    """ Returns the cache, or None if it is disabled. The directory is taken
+    from $PYCKET_CACHE_DIR (the empty string disables the cache) and defaults
+    to ~/.cache/pycket; the size limit is $PYCKET_CACHE_SIZE megabytes. """
+    if not _holder.initialized:
+        _holder.initialized = True
+        directory = os.environ.get(CACHE_DIR_ENV)
+        if directory is None:
+            directory = default_cache_dir()
+        max_size = DEFAULT_MAX_SIZE
+        size = os.environ.get(CACHE_SIZE_ENV)
+        if size:
+            try:
+                max_size = int(size)
+            except ValueError:
+                pass
+        if directory:
+            _holder.cache = ExpansionCache(rpath.realpath(directory),
+                                           max_size * 1024 * 1024)
+    return _holder.cache
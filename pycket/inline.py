@@ -0,0 +1,358 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Inlining of calls to small module-level procedures.
+#
+# A call (f a b) whose operator is a module variable bound to an immutable
+# (lambda (x y) body) is replaced by (let ([x' a] [y' b]) body'), where body'
+# is a copy of the body with all its bound variables renamed. The pass runs on
+# the module as it comes out of |JsonLoader.to_module|, before A-normalization
+# and assignment conversion, which then treat the inlined code like any other.
+#
+# Procedures are found in the module being converted, where only definitions
+# preceding the call are used, and in modules that were loaded before it.
+# Bodies of loaded modules are already assignment converted; the copy drops
+# their environment structures and rebuilds the binding forms, which are
+# converted again. Lambdas in an inlined body keep their source locations.
+# Loops in the copy become applications again and are recognized anew.
+#
+from pycket.ast_visitor       import ASTVisitor
+from pycket.interpreter       import (
+    App,
+    CaseLambda,
+    CellRef,
+    DefineValues,
+    Gensym,
+    Lambda,
+    Let,
+    Letrec,
+    LexicalVar,
+    Loop,
+    Module,
+    ModuleVar,
+    SetBang,
+    ToplevelVar,
+    VariableReference,
+    make_lambda,
+    make_let,
+    make_letrec,
+)
+
+# Number of AST nodes a procedure body may have to be inlined
+INLINE_SIZE_LIMIT = 40
+# How often inlined bodies are inlined into in turn
+INLINE_DEPTH_LIMIT = 3
+
+def ast_size(ast, limit):
+    """ The number of nodes of |ast|, counting stops above |limit|. """
+    size = 0
+    todo = [ast]
+    while todo:
+        ast = todo.pop()
+        size += 1
+        if size > limit:
+            break
+        if isinstance(ast, Lambda):
+            ast.force_body()
+        todo.extend(ast.direct_children())
+    return size
+
+def _resolve_submodule(module, path):
+    if path is None:
+        return module
+    for name in path:
+        module = module.find_submodule(name)
+        if module is None:
+            return None
+    return module
+
+def _is_current(path):
+    if path is not None:
+        for name in path:
+            if name != ".":
+                return False
+    return True
+
+class RenameVisitor(ASTVisitor):
+    """
+    Copies a procedure body, giving fresh names to all the variables it
+    binds. The argument of the visit methods maps old names to new ones.
+    References to the defining module, which are relative in the body, are
+    made absolute with |srcmod| and |path|. |ok| is cleared if the body
+    cannot be moved to another place.
+    """
+
+    def __init__(self, srcmod, path):
+        self.srcmod = srcmod
+        self.path = path
+        self.ok = True
+
+    def fresh(self, renames, syms):
+        new_syms = [None] * len(syms)
+        for i, sym in enumerate(syms):
+            new_syms[i] = Gensym.gensym(sym.utf8value)
+            renames[sym] = new_syms[i]
+        return new_syms
+
+    def visit_lexical_var(self, ast, renames):
+        assert isinstance(ast, LexicalVar)
+        return LexicalVar(renames.get(ast.sym, ast.sym))
+
+    def visit_cell_ref(self, ast, renames):
+        assert isinstance(ast, CellRef)
+        return CellRef(renames.get(ast.sym, ast.sym))
+
+    def visit_module_var(self, ast, renames):
+        assert isinstance(ast, ModuleVar)
+        srcmod = ast.srcmod
+        path = ast.path
+        if srcmod is None and self.srcmod is not None:
+            if not _is_current(path):
+                self.ok = False
+            srcmod = self.srcmod
+            path = self.path
+        return ModuleVar(ast.sym, srcmod, ast.srcsym, path)
+
+    def visit_toplevel_var(self, ast, renames):
+        self.ok = False
+        return ast
+
+    def visit_variable_reference(self, ast, renames):
+        # refers to the module it appears in
+        self.ok = False
+        return ast
+
+    def visit_set_bang(self, ast, renames):
+        assert isinstance(ast, SetBang)
+        if isinstance(ast.var, ModuleVar):
+            self.ok = False
+        var = ast.var.visit(self, renames)
+        rhs = ast.rhs.visit(self, renames)
+        return SetBang(var, rhs)
+
+    def visit_app(self, ast, renames):
+        assert isinstance(ast, App)
+        rator = ast.rator.visit(self, renames)
+        rands = [r.visit(self, renames) for r in ast.rands]
+        return App.make(rator, rands)
+
+    def visit_loop(self, ast, renames):
+        # the copy is normalized again, which recognizes the loop anew
+        assert isinstance(ast, Loop)
+        caselam = ast.rator
+        assert isinstance(caselam, CaseLambda)
+        inner = renames.copy()
+        self.fresh(inner, [caselam.recursive_sym])
+        rator = caselam.visit(self, inner)
+        rands = [r.visit(self, renames) for r in ast.rands]
+        return App.make(rator, rands)
+
+    def visit_recur(self, ast, renames):
+        return self.visit_app(ast, renames)
+
+    def visit_case_lambda(self, ast, renames):
+        assert isinstance(ast, CaseLambda)
+        lams = [l.visit(self, renames) for l in ast.lams]
+        recursive_sym = ast.recursive_sym
+        if recursive_sym is not None:
+            recursive_sym = renames.get(recursive_sym, recursive_sym)
+        return CaseLambda(lams, recursive_sym=recursive_sym)
+
+    def visit_lambda(self, ast, renames):
+        assert isinstance(ast, Lambda)
+        ast.force_body()
+        renames = renames.copy()
+        formals = self.fresh(renames, ast.formals)
+        rest = None
+        if ast.rest is not None:
+            rest = self.fresh(renames, [ast.rest])[0]
+        body = [b.visit(self, renames) for b in ast.body]
+        return make_lambda(formals, rest, body, sourceinfo=ast.sourceinfo)
+
+    def visit_let(self, ast, renames):
+        assert isinstance(ast, Let)
+        inner = renames.copy()
+        varss = [self.fresh(inner, vars) for vars in ast._rebuild_args()]
+        rhss = [None] * len(ast.rhss)
+        for i, rhs in enumerate(ast.rhss):
+            # recursive lambdas refer to their own binding
+            if (isinstance(rhs, CaseLambda) and rhs.recursive_sym is not None
+                    and rhs.recursive_sym in ast.args.elems):
+                rhss[i] = rhs.visit(self, inner)
+            else:
+                rhss[i] = rhs.visit(self, renames)
+        body = [b.visit(self, inner) for b in ast.body]
+        return make_let(varss, rhss, body)
+
+    def visit_letrec(self, ast, renames):
+        assert isinstance(ast, Letrec)
+        renames = renames.copy()
+        varss = [self.fresh(renames, vars) for vars in ast._rebuild_args()]
+        rhss = [r.visit(self, renames) for r in ast.rhss]
+        body = [b.visit(self, renames) for b in ast.body]
+        return make_letrec(varss, rhss, body)
+
+class InlineVisitor(ASTVisitor):
+    """
+    Inlines calls in a module that has not been normalized yet. The argument
+    of the visit methods is the inlining depth.
+    """
+
+    def __init__(self, root, modname, modtable):
+        self.root = root
+        self.modname = modname
+        self.modtable = modtable
+        self.module = None
+        self.module_defs = {}   # W_Symbol -> CaseLambda, defined so far
+        self.module_muts = None
+        self.loaded_defs = {}   # Module -> {W_Symbol -> CaseLambda}
+        self.inlining = []      # procedures whose bodies are being inlined
+        self.inlined_from = []  # other module files inlined from, see Module
+
+    def target_module(self, var):
+        """ The module |var| refers to, if it is known at this point. """
+        srcmod = var.srcmod
+        if srcmod is None:
+            if not _is_current(var.path):
+                return None
+            return self.module
+        if srcmod == self.modname:
+            base = self.root
+        elif self.modtable is None:
+            return None
+        else:
+            base = self.modtable.lookup(srcmod)
+            if base is None:
+                return None
+        return _resolve_submodule(base, var.path)
+
+    def find_procedure(self, var):
+        module = self.target_module(var)
+        if module is None:
+            return None
+        if module is self.module:
+            return self.module_defs.get(var.srcsym, None)
+        defs = self.loaded_defs.get(module, None)
+        if defs is None:
+            # definitions of mutated variables are Cells in converted modules,
+            # only the modules of |root| are not converted yet
+            mutated = None
+            if module.root_module() is self.root:
+                mutated = module.mod_mutated_vars()
+            defs = {}
+            for b in module.body:
+                if isinstance(b, DefineValues):
+                    proc = procedure_definition(b, mutated)
+                    if proc is not None:
+                        defs[b.names[0]] = proc
+            self.loaded_defs[module] = defs
+        return defs.get(var.srcsym, None)
+
+    def record_inlined_from(self, srcmod):
+        """ Notes that code of the module file |srcmod|, and so also the code
+        inlined into it, is inlined into this module. """
+        if srcmod is None or srcmod == self.modname or self.modtable is None:
+            return
+        base = self.modtable.lookup(srcmod)
+        names = [srcmod] + base.inlined_from if base is not None else [srcmod]
+        for name in names:
+            if name != self.modname and name not in self.inlined_from:
+                self.inlined_from.append(name)
+
+    def inline_call(self, rator, rands, depth):
+        if depth >= INLINE_DEPTH_LIMIT:
+            return None
+        if not isinstance(rator, ModuleVar) or rator.is_primitive():
+            return None
+        proc = self.find_procedure(rator)
+        if proc is None or proc in self.inlining:
+            return None
+        lam = _lambda_for_arity(proc, len(rands))
+        if lam is None or lam.rest is not None:
+            return None
+        lam.force_body()
+        size = 0
+        for b in lam.body:
+            size += ast_size(b, INLINE_SIZE_LIMIT)
+        if size > INLINE_SIZE_LIMIT:
+            return None
+
+        # relative references in the body are made absolute with the path of
+        # the procedure, unless it is inlined into its own module
+        renamer = RenameVisitor(rator.srcmod, rator.path)
+        renames = {}
+        formals = renamer.fresh(renames, lam.formals)
+        body = [b.visit(renamer, renames) for b in lam.body]
+        if not renamer.ok:
+            return None
+        self.record_inlined_from(rator.srcmod)
+
+        # the inlined body may contain calls to inline in turn
+        self.inlining.append(proc)
+        try:
+            body = [b.visit(self, depth + 1) for b in body]
+        finally:
+            self.inlining.pop()
+        return make_let([[formal] for formal in formals], rands, body)
+
+    def visit_app(self, ast, depth):
+        assert isinstance(ast, App)
+        rator = ast.rator.visit(self, depth)
+        rands = [r.visit(self, depth) for r in ast.rands]
+        inlined = self.inline_call(rator, rands, depth)
+        if inlined is not None:
+            return inlined
+        return App.make(rator, rands)
+
+    def visit_module(self, ast, depth):
+        """ Must not produce a new module AST """
+        assert isinstance(ast, Module)
+        old_module = self.module
+        old_defs = self.module_defs
+        old_muts = self.module_muts
+        self.module = ast
+        self.module_defs = {}
+        self.module_muts = ast.mod_mutated_vars()
+        for i, b in enumerate(ast.body):
+            b = b.visit(self, 0)
+            ast.body[i] = b
+            if isinstance(b, DefineValues):
+                proc = procedure_definition(b, self.module_muts)
+                if proc is not None:
+                    self.module_defs[b.names[0]] = proc
+        self.module = old_module
+        self.module_defs = old_defs
+        self.module_muts = old_muts
+        return ast
+
+def procedure_definition(define, mutated):
+    """ The CaseLambda |define| binds immutably, or None. |mutated| are the
+    variables its module mutates, if it is not converted yet. """
+    if len(define.names) != 1:
+        return None
+    rhs = define.rhs
+    if not isinstance(rhs, CaseLambda):
+        return None
+    if (mutated is not None and
+            ModuleVar(define.names[0], None, define.names[0]) in mutated):
+        return None
+    return rhs
+
+def _lambda_for_arity(proc, argc):
+    """ The case of |proc| that a call with |argc| arguments runs. """
+    for lam in proc.lams:
+        assert isinstance(lam, Lambda)
+        if len(lam.formals) == argc or (lam.rest is not None and
+                                        len(lam.formals) <= argc):
+            return lam
+    return None
+
+def inline_calls(ast, modname=None, modtable=None):
+    """ |modname| is the path |ast| was loaded from, |modtable| holds the
+    modules loaded so far. """
+    assert isinstance(ast, Module)
+    visitor = InlineVisitor(ast, modname, modtable)
+    ast = ast.visit(visitor, 0)
+    assert isinstance(ast, Module)
+    ast.inlined_from = visitor.inlined_from
+    return ast
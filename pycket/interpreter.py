@@ -4,6 +4,7 @@
 from pycket                   import config
 from pycket                   import values, values_string, values_parameter
 from pycket                   import vector
+from pycket                   import startup_profile
 from pycket.AST               import AST
 from pycket.arity             import Arity
 from pycket.cont              import Cont, NilCont, label
@@ -647,6 +648,11 @@ class Module(AST):
         self.env = None
         self.interpreted = False
         self.config = config
+        # definitions found to be unused by tree_shake, which are skipped
+        self.unused_defs = None
+        # the files of other modules whose procedures were inlined into this
+        # one, their changes make a cached AST of this module stale
+        self.inlined_from = []
 
         defs = {}
         for b in self.body:
@@ -706,6 +712,8 @@ class Module(AST):
     def interpret_mod(self, env):
         if self.interpreted:
             return values.w_void
+        startup_profile.start(startup_profile.PHASE_INSTANTIATE,
+                              self.full_module_path())
         try:
             self.interpreted = True
             return self._interpret_mod(env)
@@ -713,6 +721,8 @@ class Module(AST):
             if e.context_module is None:
                 e.context_module = self
             raise
+        finally:
+            startup_profile.stop()
 
     @jit.unroll_safe
     def root_module(self):
@@ -763,6 +773,8 @@ class Module(AST):
             # FIXME: this is wrong -- the continuation barrier here is around the RHS,
             # whereas in Racket it's around the whole `define-values`
             if isinstance(f, DefineValues):
+                if self.unused_defs is not None and f in self.unused_defs:
+                    continue
                 e = f.rhs
                 vs = interpret_one(e, self.env).get_all_values()
                 if len(f.names) == len(vs):
@@ -979,6 +991,12 @@ class App(AST):
                         return SimplePrimApp1(rator, rands, env_structure, w_prim)
                     if w_prim.simple2 and len(rands) == 2:
                         return SimplePrimApp2(rator, rands, env_structure, w_prim)
+                    if w_prim.simple3 and len(rands) == 3:
+                        return SimplePrimApp3(rator, rands, env_structure, w_prim)
+        if len(rands) <= FixedArityApp.MAX_ARGC:
+            if isinstance(rator, ModuleVar) and not rator.is_primitive():
+                return KnownCallApp(rator, rands, env_structure)
+            return FixedArityApp(rator, rands, env_structure)
         return App(rator, rands, env_structure)
 
     def direct_children(self):
@@ -1011,6 +1029,110 @@ class App(AST):
         elements = [self.rator] + self.rands
         return "(%s)" % " ".join([r.tostring() for r in elements])
 
+class FixedArityApp(App):
+    """ An application to at most |MAX_ARGC| arguments, which are passed to
+    the procedure one by one instead of in a list. """
+    _immutable_fields_ = ["argc", "rand1", "rand2", "rand3", "rand4"]
+    visitable = False
+    MAX_ARGC = 4
+
+    def __init__(self, rator, rands, env_structure=None):
+        App.__init__(self, rator, rands, env_structure)
+        self.argc = argc = len(rands)
+        assert argc <= FixedArityApp.MAX_ARGC
+        self.rand1 = self.rand2 = self.rand3 = self.rand4 = None
+        if argc > 0:
+            self.rand1 = rands[0]
+        if argc > 1:
+            self.rand2 = rands[1]
+        if argc > 2:
+            self.rand3 = rands[2]
+        if argc > 3:
+            self.rand4 = rands[3]
+
+    def interpret(self, env, cont):
+        rator = self.rator
+        if (not env.pycketconfig().callgraph and
+                isinstance(rator, ModuleVar) and
+                rator.is_primitive()):
+            self.set_should_enter() # to jit downrecursion
+        w_callable = rator.interpret_simple(env)
+        argc = self.argc
+        w_arg1 = w_arg2 = w_arg3 = w_arg4 = None
+        if argc > 0:
+            w_arg1 = self.rand1.interpret_simple(env)
+        if argc > 1:
+            w_arg2 = self.rand2.interpret_simple(env)
+        if argc > 2:
+            w_arg3 = self.rand3.interpret_simple(env)
+        if argc > 3:
+            w_arg4 = self.rand4.interpret_simple(env)
+        if isinstance(w_callable, values.W_PromotableClosure):
+            # fast path
+            jit.promote(w_callable)
+            w_callable = w_callable.closure
+        return w_callable.call_fixed(argc, w_arg1, w_arg2, w_arg3, w_arg4,
+                                     env, cont, self)
+
+class KnownCallApp(FixedArityApp):
+    """ A call of a module-level variable. The first execution links the call
+    site: if the variable is immutable and bound to a procedure defined at
+    module level with a case for exactly |argc| arguments, that case and its
+    environment are stored and later calls enter its body directly, without
+    looking up the variable or dispatching on the procedure. Like the value
+    cache of ModuleVar this relies on the module being instantiated once. """
+    _immutable_fields_ = ["linked?", "known_lam?", "known_frees?"]
+    visitable = False
+
+    UNLINKED = 0
+    KNOWN    = 1
+    GENERIC  = 2
+
+    def __init__(self, rator, rands, env_structure=None):
+        FixedArityApp.__init__(self, rator, rands, env_structure)
+        self.linked = KnownCallApp.UNLINKED
+        self.known_lam = None
+        self.known_frees = None
+
+    def link(self, env):
+        rator = self.rator
+        assert isinstance(rator, ModuleVar)
+        # raises the usual error if the variable is not defined yet
+        w_callable = rator.interpret_simple(env)
+        self.linked = KnownCallApp.GENERIC
+        if rator.is_mutable(env):
+            return
+        if not isinstance(w_callable, values.W_PromotableClosure):
+            return
+        closure = w_callable.closure
+        i = closure._find_lam_fixed(self.argc)
+        if i < 0:
+            return
+        self.known_lam = closure.caselam.lams[i]
+        self.known_frees = closure._get_list(i)
+        self.linked = KnownCallApp.KNOWN
+
+    def interpret(self, env, cont):
+        if self.linked == KnownCallApp.UNLINKED:
+            self.link(env)
+        if self.linked != KnownCallApp.KNOWN:
+            return FixedArityApp.interpret(self, env, cont)
+        lam = self.known_lam
+        argc = self.argc
+        w_arg1 = w_arg2 = w_arg3 = w_arg4 = None
+        if argc > 0:
+            w_arg1 = self.rand1.interpret_simple(env)
+        if argc > 1:
+            w_arg2 = self.rand2.interpret_simple(env)
+        if argc > 2:
+            w_arg3 = self.rand3.interpret_simple(env)
+        if argc > 3:
+            w_arg4 = self.rand4.interpret_simple(env)
+        prev = values.enter_lambda(lam, self.known_frees, env, cont, self)
+        return lam.make_begin_cont(
+            lam.make_fixed_args_env(argc, w_arg1, w_arg2, w_arg3, w_arg4, prev),
+            cont)
+
 class SimplePrimApp1(App):
     _immutable_fields_ = ['w_prim', 'rand1']
     simple = True
@@ -1082,6 +1204,118 @@ class SimplePrimApp2(App):
             return convert_runtime_exception(exn, env, cont)
         return return_multi_vals_direct(result, env, cont)
 
+class SimplePrimApp3(App):
+    _immutable_fields_ = ['w_prim', 'rand1', 'rand2', 'rand3']
+    simple = True
+    visitable = False
+
+    def __init__(self, rator, rands, env_structure, w_prim):
+        App.__init__(self, rator, rands, env_structure)
+        assert len(rands) == 3
+        self.rand1, self.rand2, self.rand3 = rands
+        self.w_prim = w_prim
+
+    def normalize(self, context):
+        context = Context.AppRand(self.rator, context)
+        return Context.normalize_names(self.rands, context)
+
+    def run(self, env):
+        arg1 = self.rand1.interpret_simple(env)
+        arg2 = self.rand2.interpret_simple(env)
+        arg3 = self.rand3.interpret_simple(env)
+        result = self.w_prim.simple3(arg1, arg2, arg3)
+        if result is None:
+            result = values.w_void
+        return result
+
+    def interpret_simple(self, env):
+        return check_one_val(self.run(env))
+
+    def interpret(self, env, cont):
+        from pycket.prims.control import convert_runtime_exception
+        if not env.pycketconfig().callgraph:
+            self.set_should_enter() # to jit downrecursion
+        try:
+            result = self.run(env)
+        except SchemeException, exn:
+            return convert_runtime_exception(exn, env, cont)
+        return return_multi_vals_direct(result, env, cont)
+
+def enter_loop(w_closure, args_w, cont):
+    """ Runs the body of the loop procedure |w_closure| with the arguments
+    |args_w|, without going through the generic procedure call. """
+    if isinstance(w_closure, values.W_Closure1AsEnv):
+        caselam = w_closure.caselam
+        prev = w_closure
+    else:
+        assert isinstance(w_closure, values.W_Closure)
+        caselam = w_closure.caselam
+        prev = w_closure._get_list(0)
+    lam = jit.promote(caselam).lams[0]
+    lam.force_body()
+    return lam.make_begin_cont(ConsEnv.make(lam.match_args(args_w), prev), cont)
+
+class Loop(App):
+    """
+    A named let, (let name ([x init] ...) body), whose procedure is only
+    called in tail position of its own body. The rator is the procedure, a
+    CaseLambda with |recursive_sym| name, the rands are the initial values of
+    the loop variables. The calls in the body are Recur nodes, so the first
+    expression of the body is the only place the loop comes back to, which
+    makes it the place where the JIT enters the loop.
+    """
+    visitable = True
+
+    def __init__(self, rator, rands, env_structure=None):
+        assert isinstance(rator, CaseLambda)
+        assert rator.recursive_sym is not None and len(rator.lams) == 1
+        App.__init__(self, rator, rands, env_structure)
+        rator.enable_jitting()
+
+    @jit.unroll_safe
+    def interpret(self, env, cont):
+        w_closure = self.rator.interpret_simple(env)
+        args_w = [None] * len(self.rands)
+        for i, rand in enumerate(self.rands):
+            args_w[i] = rand.interpret_simple(env)
+        if isinstance(w_closure, values.W_PromotableClosure):
+            w_closure = w_closure.closure
+        return enter_loop(w_closure, args_w, cont)
+
+    def normalize(self, context):
+        # becomes an application of the procedure, recognized again after
+        # normalization
+        return App.normalize(self, context)
+
+    def _tostring(self):
+        caselam = self.rator
+        assert isinstance(caselam, CaseLambda)
+        lam = caselam.lams[0]
+        lam.force_body()
+        bindings = [None] * len(self.rands)
+        for i, rand in enumerate(self.rands):
+            bindings[i] = "[%s %s]" % (lam.formals[i].variable_name(),
+                                       rand.tostring())
+        body = " ".join([b.tostring() for b in lam.body])
+        return "(let %s (%s) %s)" % (caselam.recursive_sym.variable_name(),
+                                     " ".join(bindings), body)
+
+class Recur(App):
+    """ A call of the procedure of the enclosing Loop whose name is the
+    rator. It starts the next iteration of the loop. """
+    visitable = True
+
+    @jit.unroll_safe
+    def interpret(self, env, cont):
+        w_closure = self.rator.interpret_simple(env)
+        args_w = [None] * len(self.rands)
+        for i, rand in enumerate(self.rands):
+            args_w[i] = rand.interpret_simple(env)
+        return enter_loop(w_closure, args_w, cont)
+
+    def normalize(self, context):
+        return App.normalize(self, context)
+
 class SequencedBodyAST(AST):
     _immutable_fields_ = ["body[*]", "counting_asts[*]",
                           "_sequenced_env_structure",
@@ -1429,7 +1663,8 @@ class SetBang(AST):
         return values.w_void
 
     def _mutated_vars(self):
-        x = self.rhs.mutated_vars()
+        x = variable_set()
+        x.update(self.rhs.mutated_vars())
         var = self.var
         if isinstance(var, CellRef):
             x[LexicalVar(self.var.sym)] = None
@@ -1466,6 +1701,10 @@ class If(AST):
                 return els
             else:
                 return thn
+        if isinstance(tst, SimplePrimApp1):
+            return IfPrimTest1(tst, thn, els)
+        if isinstance(tst, SimplePrimApp2):
+            return IfPrimTest2(tst, thn, els)
         return If(tst, thn, els)
 
     @objectmodel.always_inline
@@ -1486,6 +1725,48 @@ class If(AST):
     def _tostring(self):
         return "(if %s %s %s)" % (self.tst.tostring(), self.thn.tostring(), self.els.tostring())
 
+class IfPrimTest1(If):
+    """ An if whose test applies a primitive to one simple argument. The
+    primitive is called directly, and its errors are raised like those of
+    any primitive application. """
+    _immutable_fields_ = ["prim_tst"]
+
+    def __init__(self, tst, thn, els):
+        If.__init__(self, tst, thn, els)
+        assert isinstance(tst, SimplePrimApp1)
+        self.prim_tst = tst
+
+    def interpret(self, env, cont):
+        from pycket.prims.control import convert_runtime_exception
+        try:
+            w_val = check_one_val(self.prim_tst.run(env))
+        except SchemeException, exn:
+            return convert_runtime_exception(exn, env, cont)
+        if w_val is values.w_false:
+            return self.els, env, cont
+        else:
+            return self.thn, env, cont
+
+class IfPrimTest2(If):
+    """ Like IfPrimTest1, for a primitive applied to two arguments. """
+    _immutable_fields_ = ["prim_tst"]
+
+    def __init__(self, tst, thn, els):
+        If.__init__(self, tst, thn, els)
+        assert isinstance(tst, SimplePrimApp2)
+        self.prim_tst = tst
+
+    def interpret(self, env, cont):
+        from pycket.prims.control import convert_runtime_exception
+        try:
+            w_val = check_one_val(self.prim_tst.run(env))
+        except SchemeException, exn:
+            return convert_runtime_exception(exn, env, cont)
+        if w_val is values.w_false:
+            return self.els, env, cont
+        else:
+            return self.thn, env, cont
+
 def make_lambda(formals, rest, body, sourceinfo=None):
     """
     Create a λ-node after computing information about the free variables
@@ -1614,18 +1895,35 @@ class CaseLambda(AST):
         result = CaseLambda(lams, recursive_sym=self.recursive_sym, arity=self._arity)
         return context.plug(result)
 
+class LazyBody(object):
+    """ The body of a Lambda which has not been loaded yet. |load| is called
+    when the body is needed for the first time, usually when the closure is
+    applied. See ast_serialize. """
+
+    def load(self):
+        raise NotImplementedError("abstract base class")
+
 class Lambda(SequencedBodyAST):
     _immutable_fields_ = ["formals[*]", "rest", "args",
                           "frees", "enclosing_env_structure", "env_structure",
-                          "sourceinfo"]
+                          "sourceinfo", "lazy_body?"]
     visitable = True
     simple = True
     ispure = True
 
+    lazy_body = None
+    jitting_requested = False
+
     import_from_mixin(BindingFormMixin)
 
-    def __init__ (self, formals, rest, args, frees, body, sourceinfo=None, enclosing_env_structure=None, env_structure=None):
-        SequencedBodyAST.__init__(self, body)
+    def __init__ (self, formals, rest, args, frees, body, sourceinfo=None, enclosing_env_structure=None, env_structure=None, lazy_body=None):
+        if lazy_body is None:
+            SequencedBodyAST.__init__(self, body)
+        else:
+            assert body is None
+            self.body = None
+            self.counting_asts = None
+            self.lazy_body = lazy_body
         self.sourceinfo = sourceinfo
         self.formals = formals
         self.rest = rest
@@ -1633,21 +1931,44 @@ class Lambda(SequencedBodyAST):
         self.frees = frees
         self.enclosing_env_structure = enclosing_env_structure
         self.env_structure = env_structure
+        if lazy_body is None:
+            for b in self.body:
+                b.set_surrounding_lambda(self)
+
+    @objectmodel.always_inline
+    def force_body(self):
+        if self.lazy_body is not None:
+            self._load_body()
+
+    @jit.dont_look_inside
+    def _load_body(self):
+        lazy_body = self.lazy_body
+        assert lazy_body is not None
+        body = lazy_body.load()
+        SequencedBodyAST.__init__(self, body)
         for b in self.body:
             b.set_surrounding_lambda(self)
+        # mutating the quasi-immutable field invalidates any code that still
+        # expected the body to be missing
+        self.lazy_body = None
+        if self.jitting_requested:
+            self.body[0].set_should_enter()
 
     def init_arg_cell_flags(self, args_need_cell_flags):
         if True in args_need_cell_flags:
             self.args_need_cell_flags = args_need_cell_flags
 
     def enable_jitting(self):
+        if self.lazy_body is not None:
+            # the body will be marked when it is loaded
+            self.jitting_requested = True
+            return
         self.body[0].set_should_enter()
 
     def can_enter(self):
+        self.force_body()
         return self.body[0].should_enter
 
-    # returns n for fixed arity, -(n+1) for arity-at-least n
-    # my kingdom for Either
     def get_arity(self):
         if self.rest:
             return -(len(self.formals)+1)
@@ -1658,13 +1979,21 @@ class Lambda(SequencedBodyAST):
         assert False # unreachable
 
     def direct_children(self):
+        self.force_body()
         return self.body[:]
 
+    def collect_module_info(self, info):
+        if self.lazy_body is not None:
+            # requires and submodules cannot appear inside a lambda
+            return []
+        return self.direct_children()
+
     def set_surrounding_lambda(self, lam):
         self.surrounding_lambda = lam
         # don't recurse
 
     def _mutated_vars(self):
+        self.force_body()
         x = variable_set()
         for b in self.body:
             x.update(b.mutated_vars())
@@ -1675,6 +2004,7 @@ class Lambda(SequencedBodyAST):
         return x
 
     def _free_vars(self):
+        self.force_body()
         return free_vars_lambda(self.body, self.args)
 
     @jit.unroll_safe
@@ -1712,6 +2042,26 @@ class Lambda(SequencedBodyAST):
         actuals[-1] = self.wrap_value(rest, -1)
         return actuals
 
+    def make_fixed_args_env(self, argc, w_arg1, w_arg2, w_arg3, w_arg4, prev):
+        """ The environment binding the formals of a lambda without rest
+        argument to the first |argc| of the given arguments. """
+        assert self.rest is None and len(self.formals) == argc
+        if argc == 0:
+            return ConsEnv.make0(prev)
+        w_arg1 = self.wrap_value(w_arg1, 0)
+        if argc == 1:
+            return ConsEnv.make1(w_arg1, prev)
+        w_arg2 = self.wrap_value(w_arg2, 1)
+        if argc == 2:
+            return ConsEnv.make2(w_arg1, w_arg2, prev)
+        env = ConsEnv.make_n(argc, prev)
+        env._set_list(0, w_arg1)
+        env._set_list(1, w_arg2)
+        env._set_list(2, self.wrap_value(w_arg3, 2))
+        if argc == 4:
+            env._set_list(3, self.wrap_value(w_arg4, 3))
+        return env
+
     def raise_nice_error(self, args):
         fmls_len = len(self.formals)
         args_len = len(args)
@@ -1750,6 +2100,7 @@ class Lambda(SequencedBodyAST):
         return vals
 
     def normalize(self, context):
+        self.force_body()
         body = [Context.normalize_term(b) for b in self.body]
         result = Lambda(self.formals, self.rest, self.args, self.frees, body,
                         sourceinfo=self.sourceinfo,
@@ -1758,6 +2109,7 @@ class Lambda(SequencedBodyAST):
         return context.plug(result)
 
     def _tostring(self):
+        self.force_body()
         if self.rest and not self.formals:
             return "(lambda %s %s)" % (self.rest.tostring(), [b.tostring() for b in self.body])
         if self.rest:
@@ -1996,6 +2348,17 @@ class Let(SequencedBodyAST):
             env_structure = env_structure.prev
         return env
 
+    @staticmethod
+    def make(args, counts, rhss, body, remove_num_envs=None):
+        """ A Let, or one of the fused forms below if its right hand sides
+        are primitive applications that need no continuation. """
+        if len(counts) == 1 and counts[0] == 1 and _is_prim_rhs(rhss[0]):
+            return LetPrim1(args, counts, rhss, body, remove_num_envs)
+        if (len(counts) == 2 and counts[0] == 1 and counts[1] == 1 and
+                _is_prim_rhs(rhss[0]) and _is_prim_rhs(rhss[1])):
+            return LetPrim2(args, counts, rhss, body, remove_num_envs)
+        return Let(args, counts, rhss, body, remove_num_envs)
+
     @objectmodel.always_inline
     def interpret(self, env, cont):
         env = self._prune_env(env, 0)
@@ -2062,6 +2425,73 @@ class Let(SequencedBodyAST):
         result.append(")")
         return "".join(result)
 
+def _is_prim_rhs(rhs):
+    return isinstance(rhs, App) and rhs.simple
+
+class LetPrim1(Let):
+    """
+    A let binding one variable to the result of a simple primitive
+    application. The application is computed directly instead of in its own
+    step with a LetCont, and if the body is an if that tests the variable,
+    the branch is chosen right away too.
+    """
+    _immutable_fields_ = ["rhs", "test_if"]
+
+    def __init__(self, args, counts, rhss, body, remove_num_envs=None):
+        Let.__init__(self, args, counts, rhss, body, remove_num_envs)
+        assert len(rhss) == 1
+        self.rhs = rhss[0]
+        self.test_if = None
+        if len(body) == 1 and isinstance(body[0], If):
+            tst = body[0].tst
+            if isinstance(tst, LexicalVar) and tst.sym is args.elems[0]:
+                self.test_if = body[0]
+
+    def interpret(self, env, cont):
+        from pycket.prims.control import convert_runtime_exception
+        env = self._prune_env(env, 0)
+        try:
+            w_val = self.rhs.interpret_simple(env)
+        except SchemeException, exn:
+            return convert_runtime_exception(exn, env, cont)
+        prev = self._prune_env(env, 1)
+        env = ConsEnv.make1(self.wrap_value(w_val, 0), prev)
+        test_if = self.test_if
+        if test_if is not None and not self.is_mutable_var(0):
+            env = self._prune_sequenced_envs(env, 0)
+            if w_val is values.w_false:
+                return test_if.els, env, cont
+            else:
+                return test_if.thn, env, cont
+        return self.make_begin_cont(env, cont)
+
+class LetPrim2(Let):
+    """ A let binding two variables to the results of simple primitive
+    applications, which are computed directly. """
+    _immutable_fields_ = ["rhs1", "rhs2"]
+
+    def __init__(self, args, counts, rhss, body, remove_num_envs=None):
+        Let.__init__(self, args, counts, rhss, body, remove_num_envs)
+        assert len(rhss) == 2
+        self.rhs1, self.rhs2 = rhss
+
+    def interpret(self, env, cont):
+        from pycket.prims.control import convert_runtime_exception
+        env = self._prune_env(env, 0)
+        try:
+            w_val1 = self.rhs1.interpret_simple(env)
+        except SchemeException, exn:
+            return convert_runtime_exception(exn, env, cont)
+        env = self._prune_env(env, 1)
+        try:
+            w_val2 = self.rhs2.interpret_simple(env)
+        except SchemeException, exn:
+            return convert_runtime_exception(exn, env, cont)
+        prev = self._prune_env(env, 2)
+        env = ConsEnv.make2(self.wrap_value(w_val1, 0),
+                            self.wrap_value(w_val2, 1), prev)
+        return self.make_begin_cont(env, cont)
+
 class DefineValues(AST):
     _immutable_fields_ = ["names", "rhs", "display_names"]
     visitable = True
@@ -2117,8 +2547,16 @@ def inner_interpret_two_state(ast, env, cont):
         # (see Jones, Gomard, Sestof 1993)
         if t is Let:
             ast, env, cont = ast.interpret(env, cont)
+        elif t is LetPrim1:
+            ast, env, cont = ast.interpret(env, cont)
+        elif t is LetPrim2:
+            ast, env, cont = ast.interpret(env, cont)
         elif t is If:
             ast, env, cont = ast.interpret(env, cont)
+        elif t is IfPrimTest1:
+            ast, env, cont = ast.interpret(env, cont)
+        elif t is IfPrimTest2:
+            ast, env, cont = ast.interpret(env, cont)
         elif t is Begin:
             ast, env, cont = ast.interpret(env, cont)
         else:
@@ -0,0 +1,292 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Lambda lifting of local procedures that do not escape.
+#
+# A procedure bound by a let or letrec inside a lambda is a new closure every
+# time the lambda runs. If the procedure is only ever called directly, it can
+# be defined at module level instead, taking the variables it closes over as
+# additional leading arguments:
+#
+#   (lambda (x) (let ([f (lambda (y) (+ x y))]) (f 1)))
+#
+# becomes (define f' (lambda (x y) (+ x y))) before the module-level form and
+#
+#   (lambda (x) (f' x 1))
+#
+# The calls then go to a module variable, and no closure is allocated. The
+# pass runs on the module as it comes out of inlining, before
+# A-normalization. Variables that are assigned are never passed as extra
+# arguments, since the procedure has to see their later values, and the
+# procedures of named lets are left alone, so that they become loops.
+#
+from pycket                   import values
+from pycket.ast_visitor       import ASTVisitor
+from pycket.interpreter       import (
+    App,
+    CaseLambda,
+    CellRef,
+    DefineValues,
+    Gensym,
+    Lambda,
+    Let,
+    Letrec,
+    LexicalVar,
+    Module,
+    ModuleVar,
+    SetBang,
+    make_lambda,
+    make_let,
+    make_letrec,
+)
+
+class Lifted(object):
+    """ A lifted procedure: the module variable it is defined by and the
+    variables to pass in front of the arguments of a call. """
+
+    def __init__(self, var, extras):
+        self.var = var
+        self.extras = extras
+
+def assigned_vars(ast):
+    """ The symbols of the lexical variables assigned in |ast|. """
+    assigned = {}
+    todo = [ast]
+    while todo:
+        ast = todo.pop()
+        if isinstance(ast, Lambda):
+            ast.force_body()
+        elif isinstance(ast, SetBang) and isinstance(ast.var, CellRef):
+            assigned[ast.var.sym] = None
+        todo.extend(ast.direct_children())
+    return assigned
+
+def _accepts(caselam, argc):
+    for lam in caselam.lams:
+        assert isinstance(lam, Lambda)
+        if len(lam.formals) == argc or (lam.rest is not None and
+                                        len(lam.formals) <= argc):
+            return True
+    return False
+
+def only_called(asts, sym, caselam):
+    """ Whether |sym| is used in |asts| only as the operator of calls that
+    |caselam| accepts, and neither assigned nor bound again. """
+    todo = asts[:]
+    while todo:
+        ast = todo.pop()
+        if isinstance(ast, App):
+            rator = ast.rator
+            if isinstance(rator, LexicalVar) and rator.sym is sym:
+                if not _accepts(caselam, len(ast.rands)):
+                    return False
+                todo.extend(ast.rands)
+                continue
+        elif isinstance(ast, LexicalVar) or isinstance(ast, CellRef):
+            if ast.sym is sym:
+                return False
+        elif isinstance(ast, Lambda):
+            ast.force_body()
+            if sym in ast.args.elems:
+                return False
+        elif isinstance(ast, Let) or isinstance(ast, Letrec):
+            if sym in ast.args.elems:
+                return False
+        todo.extend(ast.direct_children())
+    return True
+
+def binds_any(asts, syms):
+    """ Whether a binding form in |asts| binds one of |syms|. """
+    todo = asts[:]
+    while todo:
+        ast = todo.pop()
+        elems = None
+        if isinstance(ast, Lambda):
+            ast.force_body()
+            elems = ast.args.elems
+        elif isinstance(ast, Let) or isinstance(ast, Letrec):
+            elems = ast.args.elems
+        if elems is not None:
+            for sym in syms:
+                if sym in elems:
+                    return True
+        todo.extend(ast.direct_children())
+    return False
+
+class LiftVisitor(ASTVisitor):
+    """
+    Lifts the local procedures of a module that has not been normalized yet.
+    The argument of the visit methods maps the names of the lifted procedures
+    in scope to their Lifted. The definitions of the procedures lifted out of
+    a module-level form are collected in |lifted| and precede the form.
+    """
+
+    def __init__(self):
+        self.lifted = []
+        self.assigned = {}
+        self.lambda_depth = 0
+
+    def extras(self, caselams, group, lifted):
+        """ The variables the procedures |caselams| close over, other than
+        the procedures of |group|, or None if one of them is assigned. """
+        extras = []
+        for caselam in caselams:
+            for sym in caselam.free_vars():
+                if sym in group:
+                    continue
+                info = lifted.get(sym, None)
+                syms = info.extras if info is not None else [sym]
+                for s in syms:
+                    if s in self.assigned:
+                        return None
+                    if s not in extras:
+                        extras.append(s)
+        return extras
+
+    def can_lift(self, syms, caselams, scope):
+        """ Whether the procedures |caselams| bound to |syms| are only called
+        in |scope| and their own bodies. """
+        for i, sym in enumerate(syms):
+            if sym in self.assigned:
+                return False
+            if not only_called(scope + caselams, sym, caselams[i]):
+                return False
+        return True
+
+    def lift(self, sym, extras):
+        name = values.W_Symbol.make_unreadable(
+            Gensym.gensym(sym.utf8value + ".lifted").utf8value)
+        return Lifted(ModuleVar(name, None, name), extras)
+
+    def define(self, sym, caselam, info, lifted):
+        lams = [None] * len(caselam.lams)
+        for i, lam in enumerate(caselam.lams):
+            assert isinstance(lam, Lambda)
+            lam.force_body()
+            body = [b.visit(self, lifted) for b in lam.body]
+            lams[i] = make_lambda(info.extras + lam.formals, lam.rest, body,
+                                  sourceinfo=lam.sourceinfo)
+        name = info.var.srcsym
+        self.lifted.append(DefineValues([name], CaseLambda(lams), [sym]))
+
+    def visit_app(self, ast, lifted):
+        assert isinstance(ast, App)
+        rator = ast.rator
+        rands = [r.visit(self, lifted) for r in ast.rands]
+        if isinstance(rator, LexicalVar) and rator.sym in lifted:
+            info = lifted[rator.sym]
+            extras = [LexicalVar(sym) for sym in info.extras]
+            return App.make(info.var, extras + rands)
+        return App.make(rator.visit(self, lifted), rands)
+
+    def visit_lambda(self, ast, lifted):
+        self.lambda_depth += 1
+        try:
+            return ASTVisitor.visit_lambda(self, ast, lifted)
+        finally:
+            self.lambda_depth -= 1
+
+    def visit_let(self, ast, lifted):
+        assert isinstance(ast, Let)
+        varss = ast._rebuild_args()
+        body_lifted = lifted
+        lifts = [None] * len(varss)
+        if self.lambda_depth > 0:
+            for i, vars in enumerate(varss):
+                rhs = ast.rhss[i]
+                if len(vars) != 1 or not isinstance(rhs, CaseLambda):
+                    continue
+                sym = vars[0]
+                if rhs.recursive_sym is sym and self.is_named_let(ast, sym):
+                    continue
+                if not self.can_lift([sym], [rhs], ast.body):
+                    continue
+                extras = self.extras([rhs], [sym], lifted)
+                if not extras or binds_any(ast.body + [rhs], extras):
+                    continue
+                lifts[i] = self.lift(sym, extras)
+                if body_lifted is lifted:
+                    body_lifted = lifted.copy()
+                body_lifted[sym] = lifts[i]
+        new_varss = []
+        new_rhss = []
+        for i, vars in enumerate(varss):
+            rhs = ast.rhss[i]
+            info = lifts[i]
+            if info is None:
+                new_varss.append(vars)
+                new_rhss.append(rhs.visit(self, lifted))
+                continue
+            # the procedure may call itself through its recursive name
+            assert isinstance(rhs, CaseLambda)
+            own_lifted = lifted
+            if rhs.recursive_sym is not None:
+                own_lifted = lifted.copy()
+                own_lifted[rhs.recursive_sym] = info
+            self.define(vars[0], rhs, info, own_lifted)
+        body = [b.visit(self, body_lifted) for b in ast.body]
+        return make_let(new_varss, new_rhss, body)
+
+    @staticmethod
+    def is_named_let(ast, sym):
+        if len(ast.body) != 1:
+            return False
+        app = ast.body[0]
+        return (isinstance(app, App) and isinstance(app.rator, LexicalVar) and
+                app.rator.sym is sym)
+
+    def visit_letrec(self, ast, lifted):
+        assert isinstance(ast, Letrec)
+        varss = ast._rebuild_args()
+        group = []
+        caselams = []
+        for i, vars in enumerate(varss):
+            rhs = ast.rhss[i]
+            if len(vars) != 1 or not isinstance(rhs, CaseLambda):
+                break
+            group.append(vars[0])
+            caselams.append(rhs)
+        else:
+            if (self.lambda_depth > 0 and
+                    self.can_lift(group, caselams, ast.body)):
+                extras = self.extras(caselams, group, lifted)
+                if (extras is not None and
+                        not binds_any(ast.body + caselams, extras)):
+                    return self.lift_group(ast, group, caselams, extras,
+                                           lifted)
+        rhss = [r.visit(self, lifted) for r in ast.rhss]
+        body = [b.visit(self, lifted) for b in ast.body]
+        return make_letrec(varss, rhss, body)
+
+    def lift_group(self, ast, group, caselams, extras, lifted):
+        lifted = lifted.copy()
+        infos = [self.lift(sym, extras) for sym in group]
+        for i, sym in enumerate(group):
+            lifted[sym] = infos[i]
+        for i, sym in enumerate(group):
+            self.define(sym, caselams[i], infos[i], lifted)
+        body = [b.visit(self, lifted) for b in ast.body]
+        return make_let([], [], body)
+
+    def visit_module(self, ast, lifted):
+        """ Must not produce a new module AST """
+        assert isinstance(ast, Module)
+        old_lifted = self.lifted
+        old_assigned = self.assigned
+        new_body = []
+        for b in ast.body:
+            self.lifted = []
+            self.assigned = assigned_vars(b)
+            b = b.visit(self, {})
+            for define in self.lifted:
+                define.defined_vars(ast.defs)
+                new_body.append(define)
+            new_body.append(b)
+        ast.body = new_body
+        self.lifted = old_lifted
+        self.assigned = old_assigned
+        return ast
+
+def lift_lambdas(ast):
+    assert isinstance(ast, Module)
+    return ast.visit(LiftVisitor(), {})
@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Recognition of named let loops.
+#
+# A named let (let lp ([x init] ...) body) comes out of A-normalization as
+#
+#   (let ([lp (lambda (x ...) body)]) (lp init ...))
+#
+# where the lambda is a CaseLambda with |recursive_sym| lp. A named let that
+# is not in tail position is followed by the rest of the enclosing body in
+# the same let, (let ([lp (lambda (x ...) body)]) (lp init ...) rest ...).
+# If lp is used only as the operator of calls with the right number of
+# arguments in tail position of the body, the let becomes a Loop node and
+# these calls become Recur nodes. Both still behave like applications of the procedure, but a
+# Recur runs the next iteration directly, without the generic procedure call,
+# and the first expression of the body is a fixed entry point for the JIT.
+#
+# The pass runs between A-normalization and assignment conversion, so the
+# environment structures of the loop are computed like those of any lambda.
+#
+from pycket.ast_visitor       import ASTVisitor
+from pycket.interpreter       import (
+    App,
+    Begin,
+    CaseLambda,
+    CellRef,
+    If,
+    Lambda,
+    Let,
+    Letrec,
+    LexicalVar,
+    Loop,
+    Recur,
+    WithContinuationMark,
+    make_lambda,
+    make_let,
+)
+
+def count_uses(ast, sym):
+    """ The number of references to |sym| in |ast|, or -1 if |ast| binds a
+    variable of the same name. """
+    count = 0
+    todo = [ast]
+    while todo:
+        ast = todo.pop()
+        if isinstance(ast, LexicalVar) or isinstance(ast, CellRef):
+            if ast.sym is sym:
+                count += 1
+        elif isinstance(ast, Lambda):
+            ast.force_body()
+            if sym in ast.args.elems:
+                return -1
+        elif isinstance(ast, Let) or isinstance(ast, Letrec):
+            if sym in ast.args.elems:
+                return -1
+        elif isinstance(ast, CaseLambda):
+            if ast.recursive_sym is sym:
+                return -1
+        todo.extend(ast.direct_children())
+    return count
+
+class TailCalls(object):
+    """ Replaces the calls of |sym| with |argc| arguments in tail position by
+    Recur nodes, counting them. """
+
+    def __init__(self, sym, argc):
+        self.sym = sym
+        self.argc = argc
+        self.count = 0
+
+    def replace_body(self, body):
+        body = body[:]
+        body[-1] = self.replace(body[-1])
+        return body
+
+    def replace(self, ast):
+        if isinstance(ast, Loop):
+            # the body of a loop entered in tail position is in tail position
+            caselam = ast.rator
+            assert isinstance(caselam, CaseLambda)
+            lam = caselam.lams[0]
+            lam.force_body()
+            body = self.replace_body(lam.body)
+            lam = make_lambda(lam.formals, lam.rest, body,
+                              sourceinfo=lam.sourceinfo)
+            caselam = CaseLambda([lam], recursive_sym=caselam.recursive_sym,
+                                 arity=caselam._arity)
+            return Loop(caselam, ast.rands)
+        if isinstance(ast, Recur):
+            return ast
+        if isinstance(ast, App):
+            rator = ast.rator
+            if (isinstance(rator, LexicalVar) and rator.sym is self.sym and
+                    len(ast.rands) == self.argc):
+                self.count += 1
+                return Recur(rator, ast.rands)
+            return ast
+        if isinstance(ast, If):
+            return If(ast.tst, self.replace(ast.thn), self.replace(ast.els))
+        if isinstance(ast, Let):
+            return Let(ast.args, ast.counts, ast.rhss,
+                       self.replace_body(ast.body))
+        if isinstance(ast, Letrec):
+            return Letrec(ast.args, ast.counts, ast.rhss,
+                          self.replace_body(ast.body))
+        if isinstance(ast, Begin):
+            return Begin(self.replace_body(ast.body))
+        if isinstance(ast, WithContinuationMark):
+            return WithContinuationMark(ast.key, ast.value,
+                                        self.replace(ast.body))
+        return ast
+
+def make_loop(caselam, rands):
+    """ The Loop applying |caselam| to |rands|, or None if its procedure is
+    not only called in tail position of its body. """
+    assert isinstance(caselam, CaseLambda)
+    sym = caselam.recursive_sym
+    if sym is None or len(caselam.lams) != 1:
+        return None
+    lam = caselam.lams[0]
+    assert isinstance(lam, Lambda)
+    if lam.rest is not None or len(lam.formals) != len(rands):
+        return None
+    lam.force_body()
+    uses = 0
+    for b in lam.body:
+        n = count_uses(b, sym)
+        if n < 0:
+            return None
+        uses += n
+    if uses == 0:
+        return None
+    calls = TailCalls(sym, len(rands))
+    body = calls.replace_body(lam.body)
+    if calls.count != uses:
+        return None
+    lam = make_lambda(lam.formals, None, body, sourceinfo=lam.sourceinfo)
+    caselam = CaseLambda([lam], recursive_sym=sym, arity=caselam._arity)
+    return Loop(caselam, rands)
+
+class LoopVisitor(ASTVisitor):
+    """ Replaces named let loops by Loop nodes in a normalized AST, inner
+    loops first. """
+
+    def visit_app(self, ast):
+        assert isinstance(ast, App)
+        rator = ast.rator.visit(self)
+        rands = [r.visit(self) for r in ast.rands]
+        if isinstance(rator, CaseLambda):
+            loop = make_loop(rator, rands)
+            if loop is not None:
+                return loop
+        return App.make(rator, rands, ast.env_structure)
+
+    def visit_let(self, ast):
+        assert isinstance(ast, Let)
+        rhss = [r.visit(self) for r in ast.rhss]
+        body = [b.visit(self) for b in ast.body]
+        varss = ast._rebuild_args()
+        loop = self.let_loop(varss, rhss, body)
+        if loop is not None:
+            return loop
+        return make_let(varss, rhss, body)
+
+    def let_loop(self, varss, rhss, body):
+        """ The Loop for (let ([lp <lambda>] ...) (lp init ...) rest ...),
+        with the other bindings of the let and the rest of its body kept
+        around it. """
+        app = body[0]
+        if (not isinstance(app, App) or isinstance(app, Loop) or
+                isinstance(app, Recur)):
+            return None
+        rator = app.rator
+        if not isinstance(rator, LexicalVar):
+            return None
+        sym = rator.sym
+        for i, vars in enumerate(varss):
+            if len(vars) == 1 and vars[0] is sym:
+                break
+        else:
+            return None
+        caselam = rhss[i]
+        if not isinstance(caselam, CaseLambda) or caselam.recursive_sym is not sym:
+            return None
+        for rand in app.rands:
+            if count_uses(rand, sym) != 0:
+                return None
+        rest = body[1:]
+        for b in rest:
+            if count_uses(b, sym) != 0:
+                return None
+        loop = make_loop(caselam, app.rands)
+        if loop is None:
+            return None
+        if len(varss) == 1:
+            if not rest:
+                return loop
+            return Begin.make([loop] + rest)
+        return make_let(varss[:i] + varss[i+1:], rhss[:i] + rhss[i+1:],
+                        [loop] + rest)
+
+def recognize_loops(ast):
+    return ast.visit(LoopVisitor())
@@ -0,0 +1,310 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Local inference of fixnum and flonum types for assignment converted ASTs.
+#
+# Generic arithmetic like (+ x y) dispatches on the classes of both operands
+# every time it runs, and with two operands it does not even have a direct
+# entry point, since + takes any number of arguments. When both operands are
+# known to be flonums or both known to be fixnums, the application is
+# rewritten to the primitive of that type, which is called directly.
+#
+# Types come from quoted numbers, from the results of primitives like fl* or
+# unsafe-fx+ and of exact->inexact, from if tests like (flonum? x), and are
+# carried by immutable let bindings and by the variables of loops, where the
+# types of the initial values are joined with those passed by the Recur nodes
+# until they agree. Sums, differences and products of fixnums are only known
+# to be exact integers, which is enough to make their exact->inexact a
+# flonum. Like constant folding, the pass relies on mutated variables being
+# read through CellRefs.
+#
+# The replacements compute exactly what the generic primitives compute for
+# the proven types. Flonum arithmetic and all comparisons use the unsafe
+# primitives; fixnum arithmetic uses fx+, fx- and fx*, whose overflow check
+# guards the fast path and moves to bignums like the generic operations do,
+# and flonum division keeps the zero check of fl/.
+#
+from pycket                   import values
+from pycket.ast_visitor       import ASTVisitor
+from pycket.interpreter       import (
+    App,
+    Begin,
+    Begin0,
+    CaseLambda,
+    If,
+    Lambda,
+    Let,
+    Letrec,
+    LexicalVar,
+    Loop,
+    ModuleVar,
+    Quote,
+    Recur,
+)
+
+UNKNOWN = 0
+FIXNUM  = 1
+FLONUM  = 2
+INTEGER = 3     # a fixnum or a bignum
+
+# Primitives whose result is of the given type, whatever their arguments
+RESULT_TYPES = {
+    "fl+": FLONUM, "fl-": FLONUM, "fl*": FLONUM, "fl/": FLONUM,
+    "flmin": FLONUM, "flmax": FLONUM, "flabs": FLONUM,
+    "unsafe-fl+": FLONUM, "unsafe-fl-": FLONUM, "unsafe-fl*": FLONUM,
+    "unsafe-fl/": FLONUM, "unsafe-flmin": FLONUM, "unsafe-flmax": FLONUM,
+    "unsafe-flabs": FLONUM,
+    "fx->fl": FLONUM, "unsafe-fx->fl": FLONUM, "->fl": FLONUM,
+    "real->double-flonum": FLONUM,
+    "flvector-ref": FLONUM, "unsafe-flvector-ref": FLONUM,
+    "fxmin": FIXNUM, "fxmax": FIXNUM, "fxand": FIXNUM,
+    "unsafe-fx+": FIXNUM, "unsafe-fx-": FIXNUM, "unsafe-fx*": FIXNUM,
+    "unsafe-fxmin": FIXNUM, "unsafe-fxmax": FIXNUM,
+    "unsafe-fxand": FIXNUM, "unsafe-fxior": FIXNUM, "unsafe-fxxor": FIXNUM,
+    "vector-length": FIXNUM, "unsafe-vector-length": FIXNUM,
+    "flvector-length": FIXNUM, "unsafe-flvector-length": FIXNUM,
+    "string-length": FIXNUM, "unsafe-string-length": FIXNUM,
+    "fx+": INTEGER, "fx-": INTEGER, "fx*": INTEGER,
+}
+
+# Generic operations whose result is an exact integer for exact integers
+INTEGER_OPS = {"+": None, "-": None, "*": None, "add1": None, "sub1": None}
+
+# Replacements of the generic binary operations for operands of one type
+FLONUM_OPS = {
+    "+": "unsafe-fl+", "-": "unsafe-fl-", "*": "unsafe-fl*", "/": "fl/",
+    "min": "flmin", "max": "flmax",
+    "=": "unsafe-fl=", "<": "unsafe-fl<", ">": "unsafe-fl>",
+    "<=": "unsafe-fl<=", ">=": "unsafe-fl>=",
+}
+FIXNUM_OPS = {
+    "+": "fx+", "-": "fx-", "*": "fx*",
+    "min": "fxmin", "max": "fxmax",
+    "=": "unsafe-fx=", "<": "unsafe-fx<", ">": "unsafe-fx>",
+    "<=": "unsafe-fx<=", ">=": "unsafe-fx>=",
+}
+
+# Type predicates, which narrow the type of their operand in the then branch
+PREDICATES = {
+    "flonum?": FLONUM, "double-flonum?": FLONUM, "fixnum?": FIXNUM,
+    "exact-integer?": INTEGER,
+}
+
+def join(typ1, typ2):
+    """ The type of values that are of |typ1| or of |typ2|. """
+    if typ1 == typ2:
+        return typ1
+    if is_integer(typ1) and is_integer(typ2):
+        return INTEGER
+    return UNKNOWN
+
+def is_integer(typ):
+    return typ == FIXNUM or typ == INTEGER
+
+def _primitive_name(ast):
+    if not isinstance(ast, App):
+        return None
+    rator = ast.rator
+    if not isinstance(rator, ModuleVar) or not rator.is_primitive():
+        return None
+    return rator.srcsym.utf8value
+
+def type_of(ast, types):
+    """ The type of the values of the simple expression |ast|, where |types|
+    maps symbols of variables to their types. """
+    if isinstance(ast, Quote):
+        w_val = ast.w_val
+        if type(w_val) is values.W_Flonum:
+            return FLONUM
+        if type(w_val) is values.W_Fixnum:
+            return FIXNUM
+        if type(w_val) is values.W_Bignum:
+            return INTEGER
+        return UNKNOWN
+    if isinstance(ast, LexicalVar):
+        return types.get(ast.sym, UNKNOWN)
+    if isinstance(ast, If):
+        return join(type_of(ast.thn, types), type_of(ast.els, types))
+    name = _primitive_name(ast)
+    if name is None:
+        return UNKNOWN
+    assert isinstance(ast, App)
+    if name == "exact->inexact":
+        if len(ast.rands) == 1 and type_of(ast.rands[0], types) != UNKNOWN:
+            return FLONUM
+        return UNKNOWN
+    if name in INTEGER_OPS:
+        if not ast.rands:
+            return UNKNOWN
+        for rand in ast.rands:
+            if not is_integer(type_of(rand, types)):
+                return UNKNOWN
+        return INTEGER
+    return RESULT_TYPES.get(name, UNKNOWN)
+
+def specialize_app(rator, rands, types):
+    """ The primitive replacing the application of |rator| to |rands|, or
+    None if the types of the operands are not known to agree. """
+    if len(rands) != 2:
+        return None
+    if not isinstance(rator, ModuleVar) or not rator.is_primitive():
+        return None
+    typ = type_of(rands[0], types)
+    if (typ != FIXNUM and typ != FLONUM) or type_of(rands[1], types) != typ:
+        return None
+    name = rator.srcsym.utf8value
+    if typ == FLONUM:
+        new_name = FLONUM_OPS.get(name, None)
+    else:
+        new_name = FIXNUM_OPS.get(name, None)
+    if new_name is None:
+        return None
+    sym = values.W_Symbol.make(new_name)
+    if new_name.startswith("unsafe-"):
+        return ModuleVar(sym, "#%unsafe", sym)
+    return ModuleVar(sym, "#%flfxnum", sym)
+
+def _bind(types, syms, typs):
+    """ |types| with |syms| bound to |typs|, shadowing outer bindings. """
+    new_types = types.copy()
+    for i, sym in enumerate(syms):
+        if typs is not None and typs[i] != UNKNOWN:
+            new_types[sym] = typs[i]
+        elif sym in new_types:
+            del new_types[sym]
+    return new_types
+
+class NumericTypesVisitor(ASTVisitor):
+    """
+    Rewrites generic arithmetic on operands of known types. The extra
+    argument of the visit methods maps the symbols of the variables in scope
+    to their types. |recur_types| holds the types of the loop variables of
+    the loops being visited, by the symbol of their procedure.
+    """
+
+    def __init__(self):
+        self.recur_types = {}
+
+    def visit_app(self, ast, types):
+        assert isinstance(ast, App)
+        rator = ast.rator.visit(self, types)
+        rands = [r.visit(self, types) for r in ast.rands]
+        specialized = specialize_app(rator, rands, types)
+        if specialized is not None:
+            rator = specialized
+        return App.make(rator, rands, ast.env_structure)
+
+    def visit_loop(self, ast, types):
+        assert isinstance(ast, Loop)
+        rands = [r.visit(self, types) for r in ast.rands]
+        caselam = ast.rator
+        assert isinstance(caselam, CaseLambda)
+        sym = caselam.recursive_sym
+        lam = caselam.lams[0]
+        assert isinstance(lam, Lambda)
+        typs = [type_of(r, types) for r in rands]
+        # the types of the loop variables only become more general, so this
+        # terminates after at most two more rounds per variable
+        while True:
+            self.recur_types[sym] = typs[:]
+            body_types = _bind(_bind(types, lam.args.elems, None),
+                               lam.formals, typs)
+            new_lam = self.visit_lambda_body(lam, body_types)
+            recur_typs = self.recur_types[sym]
+            del self.recur_types[sym]
+            if recur_typs == typs:
+                break
+            typs = recur_typs
+        rator = CaseLambda([new_lam], recursive_sym=sym, arity=caselam._arity)
+        return Loop(rator, rands, ast.env_structure)
+
+    def visit_recur(self, ast, types):
+        assert isinstance(ast, Recur)
+        rator = ast.rator.visit(self, types)
+        rands = [r.visit(self, types) for r in ast.rands]
+        assert isinstance(rator, LexicalVar)
+        typs = self.recur_types.get(rator.sym, None)
+        if typs is not None:
+            for i, rand in enumerate(rands):
+                typs[i] = join(typs[i], type_of(rand, types))
+        return Recur(rator, rands, ast.env_structure)
+
+    def visit_if(self, ast, types):
+        assert isinstance(ast, If)
+        tst = ast.tst.visit(self, types)
+        thn_types = types
+        name = _primitive_name(tst)
+        if name is not None and name in PREDICATES:
+            assert isinstance(tst, App)
+            if len(tst.rands) == 1 and isinstance(tst.rands[0], LexicalVar):
+                thn_types = types.copy()
+                thn_types[tst.rands[0].sym] = PREDICATES[name]
+        thn = ast.thn.visit(self, thn_types)
+        els = ast.els.visit(self, types)
+        return If(tst, thn, els)
+
+    def visit_begin(self, ast, types):
+        assert isinstance(ast, Begin)
+        # the length of the body has to stay the same for the env pruning
+        result = Begin([b.visit(self, types) for b in ast.body])
+        result.copy_body_pruning(ast)
+        return result
+
+    def visit_begin0(self, ast, types):
+        assert isinstance(ast, Begin0)
+        first = ast.first.visit(self, types)
+        result = Begin0(first, [b.visit(self, types) for b in ast.body])
+        result.copy_body_pruning(ast)
+        return result
+
+    def visit_case_lambda(self, ast, types):
+        assert isinstance(ast, CaseLambda)
+        lams = [l.visit(self, types) for l in ast.lams]
+        return CaseLambda(lams, recursive_sym=ast.recursive_sym, arity=ast._arity)
+
+    def visit_lambda(self, ast, types):
+        assert isinstance(ast, Lambda)
+        return self.visit_lambda_body(ast, _bind(types, ast.args.elems, None))
+
+    def visit_lambda_body(self, ast, types):
+        ast.force_body()
+        body = [b.visit(self, types) for b in ast.body]
+        result = Lambda(ast.formals, ast.rest, ast.args, ast.frees, body,
+                        sourceinfo=ast.sourceinfo,
+                        enclosing_env_structure=ast.enclosing_env_structure,
+                        env_structure=ast.env_structure)
+        result.copy_body_pruning(ast)
+        if ast._mutable_var_flags is not None:
+            result.init_mutable_var_flags(ast._mutable_var_flags)
+        return result
+
+    def visit_letrec(self, ast, types):
+        assert isinstance(ast, Letrec)
+        types = _bind(types, ast.args.elems, None)
+        rhss = [r.visit(self, types) for r in ast.rhss]
+        body = [b.visit(self, types) for b in ast.body]
+        result = Letrec(ast.args, ast.counts, rhss, body)
+        result.copy_body_pruning(ast)
+        return result
+
+    def visit_let(self, ast, types):
+        assert isinstance(ast, Let)
+        rhss = [r.visit(self, types) for r in ast.rhss]
+        vars = ast.args.elems
+        typs = [UNKNOWN] * len(vars)
+        offset = 0
+        for i, rhs in enumerate(rhss):
+            count = ast.counts[i]
+            if count == 1 and not ast.is_mutable_var(offset):
+                typs[offset] = type_of(rhs, types)
+            offset += count
+        body_types = _bind(types, vars, typs)
+        body = [b.visit(self, body_types) for b in ast.body]
+        result = Let(ast.args, ast.counts, rhss, body, ast.remove_num_envs)
+        result.copy_body_pruning(ast)
+        if ast._mutable_var_flags is not None:
+            result.init_mutable_var_flags(ast._mutable_var_flags)
+        return result
+
+def specialize_numeric(ast):
+    return ast.visit(NumericTypesVisitor(), {})
@@ -41,6 +41,21 @@ def print_help(argv):
   -b (-R) <file> : run pycket with bytecode expansion, optional -R flag enables recursive bytecode expansion
  Configuration options:
   --stdlib: Use Pycket's version of stdlib (only applicable for -e)
+  --lazy-bodies : Load function bodies from the binary AST cache only when
+                  they are first called
+  --save-image <file> : After running the program, write all its modules
+                        into <file>
+  --load-image <file> : Run the program saved in the image <file>, without
+                        expanding or reading any other module
+  --startup-profile : Print the time and memory spent expanding, loading and
+                      instantiating every module
+  --startup-profile-json <file> : Like --startup-profile, and also write the
+                                  numbers to <file> as JSON
+  --tree-shake : Do not evaluate the definitions of required modules that the
+                 program cannot reach and that only allocate; breaks programs
+                 which access them through eval, namespaces or dynamic-require
+  --expand-jobs <n> : Expand the modules the program requires ahead of time,
+                      with up to <n> expansions running in parallel
  Meta options:
   --jit <jitargs> : Set RPython JIT options may be 'default', 'off',
                     or 'param=value,param=value' list
@@ -134,6 +149,48 @@ def parse_args(argv):
         elif argv[i] == '--save-callgraph':
             config['save-callgraph'] = True
 
+        elif argv[i] == '--lazy-bodies':
+            config['lazy-bodies'] = True
+
+        elif argv[i] in ["--save-image", "--load-image"]:
+            if to <= i + 1:
+                print "missing argument after %s" % argv[i]
+                retval = 2
+                break
+            names[argv[i][2:]] = argv[i + 1]
+            if argv[i] == "--load-image":
+                retval = 0
+            i += 1
+
+        elif argv[i] == '--startup-profile':
+            config['startup-profile'] = True
+
+        elif argv[i] == '--startup-profile-json':
+            if to <= i + 1:
+                print "missing argument after --startup-profile-json"
+                retval = 2
+                break
+            i += 1
+            config['startup-profile'] = True
+            names['startup-profile-json'] = argv[i]
+
+        elif argv[i] == '--tree-shake':
+            config['tree-shake'] = True
+
+        elif argv[i] == '--expand-jobs':
+            if to <= i + 1:
+                print "missing argument after --expand-jobs"
+                retval = 2
+                break
+            i += 1
+            try:
+                int(argv[i])
+            except ValueError:
+                print "--expand-jobs expects a number, got %s" % argv[i]
+                retval = 2
+                break
+            names['expand-jobs'] = argv[i]
+
         else:
             if 'file' in names:
                 break
@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Parallel expansion of the require graph of a program.
+#
+# Normally modules are expanded one at a time, whenever interpreting a
+# Require reaches a module whose JSON is missing or out of date. On a cold
+# cache this serializes every run of the expander. The prefetcher walks the
+# require graph ahead of time instead: as soon as a module is expanded, the
+# modules it requires are expanded in child processes, up to |jobs| at once.
+# Each child writes the JSON and the binary AST cache of its module (in the
+# expansion cache, or next to the source if it is disabled), so the module
+# table later finds them up to date and loads them without expanding.
+#
+import os
+
+from rpython.rlib import streamio
+
+from pycket import pycket_json, rpath
+from pycket.expand import (ModTable, JsonLoader, PermException,
+                           ensure_json_ast_run, lookup_json_ast, _json_name,
+                           readfile_rpython, dbgprint)
+from pycket.expand_cache import get_expansion_cache
+
+# exit codes of the expanding children
+_EXPANDED = 0
+_FAILED = 1
+_NO_PERMISSION = 2
+
+def _add_require(fname, acc):
+    if fname in (".", "..") or ModTable.builtin(fname):
+        return
+    acc[rpath.realpath(fname)] = None
+
+def _collect_requires(parser, acc):
+    event = parser.next_event()
+    if event == pycket_json.EV_START_OBJECT:
+        while parser.next_key():
+            key = parser.string_value
+            if key == "require":
+                for path in parser.read_value().value_array():
+                    path = path.value_array()
+                    if path:
+                        _add_require(path[0].value_string(), acc)
+            elif key == "language":
+                lang_arr = parser.read_value().value_array()
+                if lang_arr:
+                    _add_require(lang_arr[0].value_string(), acc)
+            else:
+                _collect_requires(parser, acc)
+    elif event == pycket_json.EV_START_ARRAY:
+        while parser.next_element():
+            _collect_requires(parser, acc)
+
+def module_requires(data):
+    """ Returns the files required by the expanded module |data|, including
+    the requires of its submodules and its language. """
+    parser = pycket_json.JsonPullParser(data)
+    acc = {}
+    _collect_requires(parser, acc)
+    parser.finish()
+    return acc.keys()
+
+def _expand_module(rkt_file, bytecode_expand):
+    json_file = ensure_json_ast_run(rkt_file, bytecode_expand)
+    try:
+        JsonLoader(bytecode_expand).load_json_ast_cached(rkt_file, json_file)
+    except Exception:
+        # the binary AST is only an optimization, the parent will report
+        # real problems when it loads the module
+        pass
+
+class Prefetcher(object):
+
+    def __init__(self, jobs, bytecode_expand=False):
+        assert jobs > 0
+        self.jobs = jobs
+        self.bytecode_expand = bytecode_expand
+        self.seen = {}
+        self.todo = []
+        self.running = {}
+
+    def prefetch(self, json_file):
+        """ Expands everything the expanded module in |json_file| requires,
+        directly or indirectly, that is not up to date already. """
+        self.scan(json_file)
+        while self.todo or self.running:
+            while self.todo and len(self.running) < self.jobs:
+                self.start(self.todo.pop())
+            self.wait()
+
+    def scan(self, json_file):
+        try:
+            requires = module_requires(readfile_rpython(json_file))
+        except (OSError, streamio.StreamError, ValueError):
+            # leave it to the module loader to report the error
+            return
+        for rkt_file in requires:
+            if rkt_file in self.seen:
+                continue
+            self.seen[rkt_file] = None
+            if not os.access(rkt_file, os.R_OK):
+                continue
+            json_file = lookup_json_ast(rkt_file, self.bytecode_expand)
+            if json_file is None:
+                self.todo.append(rkt_file)
+            else:
+                self.scan(json_file)
+
+    def start(self, rkt_file):
+        dbgprint("prefetch", "", lib="", filename=rkt_file)
+        pid = os.fork()
+        if pid == 0:
+            code = _EXPANDED
+            try:
+                _expand_module(rkt_file, self.bytecode_expand)
+            except PermException:
+                code = _NO_PERMISSION
+            except Exception:
+                code = _FAILED
+            os._exit(code)
+        self.running[pid] = rkt_file
+
+    def wait(self):
+        pid, status = os.waitpid(-1, 0)
+        rkt_file = self.running.get(pid, None)
+        if rkt_file is None:
+            return
+        del self.running[pid]
+        cache = get_expansion_cache()
+        if cache is not None:
+            # the child changed the cache behind our back
+            cache.reset()
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == _EXPANDED:
+            json_file = lookup_json_ast(rkt_file, self.bytecode_expand)
+            if json_file is not None:
+                self.scan(json_file)
+        elif os.WIFEXITED(status) and os.WEXITSTATUS(status) == _NO_PERMISSION:
+            # the module loader expands it without writing a file
+            pass
+        elif cache is None:
+            # do not leave a truncated file behind that looks up to date; the
+            # module loader expands the module again and reports the error
+            try:
+                os.remove(_json_name(rkt_file))
+            except OSError:
+                pass
+
+def prefetch_requires(json_file, jobs, bytecode_expand=False):
+    Prefetcher(jobs, bytecode_expand).prefetch(json_file)
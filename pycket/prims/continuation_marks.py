@@ -46,7 +46,6 @@ def get_marks_all(cont, keys, not_found, upto=[]):
         if cont is None:
             return values.w_null
         found = False
-        next  = None
         for i, key in enumerate(keys):
             value, _ = cont.find_cm(key)
             if value is not None:
@@ -54,7 +53,11 @@ def get_marks_all(cont, keys, not_found, upto=[]):
             else:
                 value = not_found
             results.set(i, value)
-        cont = cont.get_previous_continuation(upto=upto)
+        # only frames with marks can contribute, skip the others
+        if cont.get_previous_continuation(upto=upto) is None:
+            cont = None
+        else:
+            cont = cont.next_marked()
         if found:
             break
     rest = get_marks_all(cont, keys, not_found, upto=upto)
@@ -90,7 +93,7 @@ def cms_first(cms, mark, missing, prompt_tag, env, cont):
         v = cont.get_mark_first(m, upto=[prompt_tag])
     elif isinstance(cms, values.W_ContinuationMarkSet):
         the_cont = cms.cont
-        v = cont.get_mark_first(m, upto=[prompt_tag, cms.prompt_tag])
+        v = the_cont.get_mark_first(m, upto=[prompt_tag, cms.prompt_tag])
     else:
         raise SchemeException("Expected #f or a continuation-mark-set")
     val = v if v is not None else missing
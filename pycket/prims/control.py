@@ -3,7 +3,7 @@
 
 from pycket                    import values, values_parameter, values_string
 from pycket.arity              import Arity
-from pycket.cont               import continuation, loop_label, call_cont, Barrier, Cont, NilCont, Prompt
+from pycket.cont               import continuation, loop_label, call_cont, Barrier, Cont, CoroutineBase, NilCont, Prompt
 from pycket.error              import SchemeException
 from pycket.argument_parser    import ArgParser, EndOfInput
 from pycket.prims.expose       import default, expose, expose_val, procedure, make_procedure
@@ -62,48 +62,95 @@ def convert_runtime_exception(exn, env, cont):
         return exn_fail.constructor.call([message, marks], env, cont)
 
 @jit.unroll_safe
-def scan_continuation(curr, prompt_tag, look_for=None, escape=False):
+def find_escape(curr, prompt_tag, target, escape=False):
+    """
+    Determine whether the continuation |target| is a prefix of the extant
+    continuation |curr|, that is, whether installing it only pops frames.
+    This is the case for escapes (let/ec, early exits from loops), and then
+    installing the continuation is much simpler, as the expensive merge
+    operation needed to find common substructure in the two continuations is
+    not needed. Also reports whether any dynamic-wind frames are popped.
+    Unlike scan_continuation, this does not allocate.
+    """
+    handlers = False
+    while curr is not None:
+        if curr is target:
+            return True, handlers
+        if isinstance(curr, CoroutineBase):
+            curr = curr.get_previous_continuation()
+            continue
+        if not isinstance(curr, Cont):
+            break
+        handlers |= isinstance(curr, DynamicWindValueCont)
+        if isinstance(curr, Prompt) and curr.tag is prompt_tag:
+            break
+        curr = curr.prev
+        if not escape and not jit.isvirtual(curr):
+            found, handlers, curr = _find_escape(curr, prompt_tag, target, handlers)
+            if found:
+                return True, handlers
+    return False, handlers
+
+@jit.elidable
+def _find_escape(curr, prompt_tag, target, handlers):
+    """
+    Variant of find_escape which is elidable.
+    find_escape switchs to using this function when all the virtual
+    continuation frames are exhausted. It stops at the base of a coroutine,
+    whose enclosing frames change with each resume, and returns it so that
+    find_escape can continue beyond it.
+    """
+    while isinstance(curr, Cont):
+        if curr is target:
+            return True, handlers, None
+        handlers |= isinstance(curr, DynamicWindValueCont)
+        if isinstance(curr, Prompt) and curr.tag is prompt_tag:
+            return False, handlers, None
+        curr = curr.prev
+    if curr is target:
+        return True, handlers, None
+    if isinstance(curr, CoroutineBase):
+        return False, handlers, curr
+    return False, handlers, None
+
+@jit.unroll_safe
+def scan_continuation(curr, prompt_tag, escape=False):
     """
     Segment a continuation based on a given continuation-prompt-tag.
     The head of the continuation, up to and including the desired continuation
     prompt is reversed (in place), and the tail is returned un-altered.
-
-    The hint value |look_for| is used to determine when the continuation being
-    installed is a prefix of the extant continuation.
-    In this case, installing the continuation is much simpler, as the expensive
-    merge operation needed to find common substructure is the two continuation is
-    not needed.
     """
-    handlers = False
     xs = []
-    while isinstance(curr, Cont):
-        if curr is look_for:
-            return None, handlers
-        handlers |= isinstance(curr, DynamicWindValueCont)
+    while curr is not None:
+        if isinstance(curr, CoroutineBase):
+            curr = curr.get_previous_continuation()
+            continue
+        if not isinstance(curr, Cont):
+            break
         xs.append(curr)
         if isinstance(curr, Prompt) and curr.tag is prompt_tag:
             break
         curr = curr.prev
         if not escape and not jit.isvirtual(curr):
-            return _scan_continuation(curr, prompt_tag, look_for, xs, handlers)
-    return xs, handlers
+            curr = _scan_continuation(curr, prompt_tag, xs)
+    return xs
 
 @jit.elidable
-def _scan_continuation(curr, prompt_tag, look_for, xs, handlers):
+def _scan_continuation(curr, prompt_tag, xs):
     """
     Variant of scan_continuation which is elidable.
     scan_continuation switchs to using this function when all the virtual
-    continuation frames are exhausted.
+    continuation frames are exhausted. Like _find_escape, it returns the base
+    of a coroutine it stops at.
     """
     while isinstance(curr, Cont):
-        if curr is look_for:
-            return None, handlers
-        handlers |= isinstance(curr, DynamicWindValueCont)
         xs.append(curr)
         if isinstance(curr, Prompt) and curr.tag is prompt_tag:
-            break
+            return None
         curr = curr.prev
-    return xs, handlers
+    if isinstance(curr, CoroutineBase):
+        return curr
+    return None
 
 @jit.elidable
 def find_merge_point(c1, c2):
@@ -128,17 +175,27 @@ def find_merge_point(c1, c2):
         j -= 1
     return r1, r2, unwind, rewind
 
-@jit.elidable
+@jit.unroll_safe
 def find_handlers(cont, target):
     result = None
     while cont is not target:
+        if isinstance(cont, CoroutineBase):
+            cont = cont.get_previous_continuation()
+            continue
+        result, cont = _find_handlers(cont, target, result)
+    return result
+
+@jit.elidable
+def _find_handlers(cont, target, result):
+    # stops at the base of a coroutine, as the frames beyond it change
+    while cont is not target and not isinstance(cont, CoroutineBase):
         assert isinstance(cont, Cont)
         if isinstance(cont, DynamicWindValueCont):
             if not result:
                 result = []
             result.append(cont)
         cont = cont.prev
-    return result
+    return result, cont
 
 @jit.unroll_safe
 def install_continuation_fast_path(current_cont, args, has_handlers, env, cont):
@@ -169,11 +226,11 @@ def install_continuation(cont, prompt_tag, args, env, current_cont, extend=False
         base, unwind = current_cont, None
         stop         = None
     else:
-        head1, handlers = scan_continuation(
-                current_cont, prompt_tag, look_for=cont, escape=escape)
-        if head1 is None:
+        found, handlers = find_escape(current_cont, prompt_tag, cont, escape=escape)
+        if found:
             return install_continuation_fast_path(current_cont, args, handlers, env, cont)
-        head2, _ = scan_continuation(cont, prompt_tag)
+        head1 = scan_continuation(current_cont, prompt_tag, escape=escape)
+        head2 = scan_continuation(cont, prompt_tag)
         base, stop, unwind, rewind = find_merge_point(head1, head2)
 
     # Append the continuations at the appropriate prompt
@@ -315,6 +372,59 @@ def call_with_composable_continuation(proc, prompt_tag, env, cont, extra_call_in
     kont = [values.W_ComposableContinuation(cont, prompt_tag)]
     return proc.call_with_extra_info(kont, env, cont, extra_call_info)
 
+# Native coroutines, for generators and other code switching back and forth
+# between two computations. Unlike with continuations captured by call/cc,
+# resuming and yielding do not copy or scan continuation frames.
+
+# The continuation of a resume. Escapes and aborts leaving the coroutine
+# unwind this frame like the post thunk of a dynamic-wind, which finishes
+# the coroutine.
+@add_copy_method(copy_method="_clone")
+class CoroutineResumeCont(DynamicWindValueCont):
+
+    _immutable_fields_ = ['coroutine']
+
+    def __init__(self, coroutine, env, cont):
+        DynamicWindValueCont.__init__(self, None, None, env, cont)
+        self.coroutine = coroutine
+
+    def unwind(self, env, cont):
+        from pycket.interpreter import return_void
+        coroutine = self.coroutine
+        if coroutine.resumer is self and coroutine.state == values.W_Coroutine.RUNNING:
+            coroutine.abandon()
+        return return_void(env, cont)
+
+    def rewind(self, env, cont):
+        from pycket.interpreter import return_void
+        return return_void(env, cont)
+
+    def plug_reduce(self, _vals, env):
+        from pycket.interpreter import return_multi_vals
+        return return_multi_vals(_vals, env, self.prev)
+
+@expose("make-coroutine", [procedure])
+def make_coroutine(proc):
+    return values.W_Coroutine(proc)
+
+@expose("coroutine-resume", arity=Arity.geq(1), simple=False)
+def coroutine_resume(args, env, cont):
+    co = args[0]
+    if not isinstance(co, values.W_Coroutine):
+        raise SchemeException("coroutine-resume: expected coroutine")
+    return co.resume(args[1:], env, cont)
+
+@expose("coroutine-yield", arity=Arity.geq(1), simple=False)
+def coroutine_yield(args, env, cont):
+    co = args[0]
+    if not isinstance(co, values.W_Coroutine):
+        raise SchemeException("coroutine-yield: expected coroutine")
+    return co.yield_(args[1:], env, cont)
+
+@expose("coroutine-state", [values.W_Coroutine])
+def coroutine_state(co):
+    return co.state_name()
+
 @expose("make-continuation-prompt-tag", [default(values.W_Symbol, None)])
 def make_continuation_prompt_tag(sym):
     return values.W_ContinuationPromptTag(sym)
@@ -392,17 +502,73 @@ def call_with_continuation_barrier(proc, env, cont, calling_app):
     cont = Barrier(env, cont)
     return proc.call_with_extra_info([], env, cont, calling_app)
 
-def raise_exception(v, barrier, env, cont):
-    # TODO: Handle case where barrier is not #t
-    assert barrier is values.w_true
+# Remembers the exception handler found from the continuation of the last
+# raise and the frame that installed it. Code raising over and over under the
+# same handler, as when exceptions are used for control flow, finds it without
+# walking the marks again. The cache is emptied by |BaseCont.update_cm|
+# whenever a handler is installed.
+class HandlerCache(object):
+    """ The frame that installed the last exception handler found, and that
+    handler. A raise that reaches the frame without finding a closer handler
+    uses the cached one. Only an update of the marks of the frame itself
+    changes the handler it installs, so handlers installed in other frames
+    leave the cache alone. """
+    _attrs_ = ["handler", "frame"]
+    def __init__(self):
+        self.handler = None
+        self.frame   = None
+
+    def clear(self):
+        self.handler = None
+        self.frame   = None
+
+    def invalidate(self, frame):
+        """ Called when the marks of |frame| change. """
+        if frame is self.frame:
+            self.clear()
+
+handler_cache = HandlerCache()
 
-    handler = None
+@jit.unroll_safe
+def find_exception_handler(cont):
+    """ The innermost exception handler of |cont| and the frame it was
+    installed in, or None and None. Only frames with marks are visited. """
+    cache = handler_cache
+    cached = cache.frame
+    bases = None
     while cont is not None:
+        if cont is cached:
+            handler, frame = cache.handler, cont
+            break
         handler, _ = cont.find_cm(values.exn_handler_key)
         if handler is not None:
+            frame = cont
             break
-        cont = cont.get_previous_continuation()
+        if isinstance(cont, CoroutineBase):
+            if bases is None:
+                bases = []
+            bases.append(cont)
+        if cont.get_previous_continuation() is None:
+            cont = None
+        else:
+            cont = cont.next_marked()
     else:
+        return None, None
+    if bases is not None:
+        # the handler runs outside of these coroutines, they are left for good
+        for base in bases:
+            base.coroutine.abandon()
+        return handler, frame
+    cache.handler = handler
+    cache.frame   = frame
+    return handler, frame
+
+def raise_exception(v, barrier, env, cont):
+    # TODO: Handle case where barrier is not #t
+    assert barrier is values.w_true
+
+    handler, cont = find_exception_handler(cont)
+    if handler is None:
         raise SchemeException("uncaught exception:\n %s" % v.tostring())
 
     if not handler.iscallable():
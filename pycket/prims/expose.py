@@ -72,7 +72,8 @@ def unwrap_procedure(w_arg):
 
 procedure = procedure()
 
-def _make_arg_unwrapper(func, argstypes, funcname, has_self=False, simple=False):
+def _make_arg_unwrapper(func, argstypes, funcname, has_self=False, simple=False,
+                        fixed=False):
     argtype_tuples = []
     min_arg = 0
     isdefault = False
@@ -97,15 +98,19 @@ def _make_arg_unwrapper(func, argstypes, funcname, has_self=False, simple=False)
         aritystring = "%s to %s" % (min_arg, max_arity)
     errormsg_arity = "expected %s arguments to %s, got " % (
         aritystring, funcname)
-    if min_arg == max_arity and not has_self and min_arg in (1, 2) and simple:
-        func_arg_unwrap, call1, call2 = make_direct_arg_unwrapper(
+    if min_arg == max_arity and not has_self and min_arg in (1, 2, 3) and simple:
+        func_arg_unwrap, call1, call2, call3 = make_direct_arg_unwrapper(
             func, min_arg, unroll_argtypes, errormsg_arity)
     else:
         func_arg_unwrap = make_list_arg_unwrapper(
             func, has_self, min_arg, max_arity, unroll_argtypes, errormsg_arity)
-        call1 = call2 = None
+        call1 = call2 = call3 = None
+    call_fixed = None
+    if fixed and min_arg == max_arity and not has_self and max_arity <= 4:
+        call_fixed = make_fixed_arg_unwrapper(
+            func, min_arg, unroll_argtypes, errormsg_arity)
     _arity = Arity.oneof(*range(min_arg, max_arity+1))
-    return func_arg_unwrap, _arity, call1, call2
+    return func_arg_unwrap, _arity, call1, call2, call3, call_fixed
 
 def make_direct_arg_unwrapper(func, num_args, unroll_argtypes, errormsg_arity):
     # fast paths that allow the calling without constructing an args list
@@ -119,9 +124,11 @@ def make_direct_arg_unwrapper(func, num_args, unroll_argtypes, errormsg_arity):
             raise SchemeException(errormsg_arity + str(lenargs))
         if num_args == 1:
             return func_direct_unwrap(args[0], *rest)
-        else:
-            assert num_args == 2
+        elif num_args == 2:
             return func_direct_unwrap(args[0], args[1], *rest)
+        else:
+            assert num_args == 3
+            return func_direct_unwrap(args[0], args[1], args[2], *rest)
     func_arg_unwrap.func_name = "%s_arg_unwrap%s" % (func.func_name, num_args)
     if num_args == 1:
         (i, unwrapper, default, default_value, type_errormsg), = list(unroll_argtypes)
@@ -133,9 +140,8 @@ def make_direct_arg_unwrapper(func, num_args, unroll_argtypes, errormsg_arity):
                 raise SchemeException(type_errormsg + arg1.tostring())
             return func(typed_arg1, *rest)
         func_direct_unwrap.func_name = "%s_fast1" % (func.func_name, )
-        return func_arg_unwrap, func_direct_unwrap, None
-    else:
-        assert num_args == 2
+        return func_arg_unwrap, func_direct_unwrap, None, None
+    elif num_args == 2:
         ((i1, unwrapper1, default1, default_value1, type_errormsg1),
          (i2, unwrapper2, default2, default_value2, type_errormsg2)
             ) = list(unroll_argtypes)
@@ -155,8 +161,48 @@ def make_direct_arg_unwrapper(func, num_args, unroll_argtypes, errormsg_arity):
                 arg = arg1
             raise SchemeException(type_errormsg + arg.tostring())
         func_direct_unwrap.func_name = "%s_fast2" % (func.func_name, )
-        return func_arg_unwrap, None, func_direct_unwrap
-
+        return func_arg_unwrap, None, func_direct_unwrap, None
+    else:
+        assert num_args == 3
+        ((i1, unwrapper1, default1, default_value1, type_errormsg1),
+         (i2, unwrapper2, default2, default_value2, type_errormsg2),
+         (i3, unwrapper3, default3, default_value3, type_errormsg3)
+            ) = list(unroll_argtypes)
+        assert i1 == 0 and i2 == 1 and i3 == 2
+        assert not default1 and not default2 and not default3
+        def func_direct_unwrap(arg1, arg2, arg3, *rest):
+            typed_arg1 = unwrapper1(arg1)
+            if typed_arg1 is None:
+                raise SchemeException(type_errormsg1 + arg1.tostring())
+            typed_arg2 = unwrapper2(arg2)
+            if typed_arg2 is None:
+                raise SchemeException(type_errormsg2 + arg2.tostring())
+            typed_arg3 = unwrapper3(arg3)
+            if typed_arg3 is None:
+                raise SchemeException(type_errormsg3 + arg3.tostring())
+            return func(typed_arg1, typed_arg2, typed_arg3, *rest)
+        func_direct_unwrap.func_name = "%s_fast3" % (func.func_name, )
+        return func_arg_unwrap, None, None, func_direct_unwrap
+
+
+def make_fixed_arg_unwrapper(func, num_args, unroll_argtypes, errormsg_arity):
+    # the entry for calls that pass at most four arguments one by one instead
+    # of in a list, see W_Object.call_fixed
+    def func_fixed_unwrap(argc, w_arg1, w_arg2, w_arg3, w_arg4, *rest):
+        if argc != num_args:
+            raise SchemeException(errormsg_arity + str(argc))
+        args = (w_arg1, w_arg2, w_arg3, w_arg4)
+        typed_args = ()
+        for i, unwrapper, default, default_value, type_errormsg in unroll_argtypes:
+            arg = args[i]
+            typed_arg = unwrapper(arg)
+            if typed_arg is None:
+                raise SchemeException(type_errormsg + arg.tostring())
+            typed_args += (typed_arg, )
+        typed_args += rest
+        return func(*typed_args)
+    func_fixed_unwrap.func_name = "%s_fixed%s" % (func.func_name, num_args)
+    return func_fixed_unwrap
 
 def make_list_arg_unwrapper(func, has_self, min_arg, max_arity, unroll_argtypes, errormsg_arity):
     def func_arg_unwrap(*allargs):
@@ -223,7 +269,7 @@ def make_procedure(n="<procedure>", argstypes=None, simple=True, arity=None):
         names = [n] if isinstance(n, str) else n
         name = names[0]
         if argstypes is not None:
-            func_arg_unwrap, _arity, _, _ = _make_arg_unwrapper(func, argstypes, name, simple=simple)
+            func_arg_unwrap, _arity, _, _, _, _ = _make_arg_unwrapper(func, argstypes, name, simple=simple)
             if arity is not None:
                 _arity = arity
         else:
@@ -243,7 +289,8 @@ def make_remove_extra_info(func):
     remove_extra_info.__name__ += func.__name__
     return remove_extra_info
 
-def expose(n, argstypes=None, simple=True, arity=None, nyi=False, extra_info=False):
+def expose(n, argstypes=None, simple=True, arity=None, nyi=False, extra_info=False,
+           pure=False, reads_mutable=False):
     """
     n:          names that the function should be exposed under
     argstypes:  if None, the list of args is passed directly to the function
@@ -257,6 +304,13 @@ def expose(n, argstypes=None, simple=True, arity=None, nyi=False, extra_info=Fal
                 do with it is to pass it into a w_value.call_with_extra_info as
                 the last argument. This will ensure that the call graph
                 information stays correct.
+    pure:       the function has no effects and its result only depends on
+                its arguments, so applications to the same arguments can share
+                one result (see pycket.cse)
+    reads_mutable:
+                like pure, but the result also depends on the mutable contents
+                of the arguments, so it can only be shared until the next
+                mutation
     """
     def wrapper(func):
         from pycket import values
@@ -264,15 +318,20 @@ def expose(n, argstypes=None, simple=True, arity=None, nyi=False, extra_info=Fal
         name = names[0]
         if extra_info:
             assert not simple
-        call1 = call2 = None
+        if pure or reads_mutable:
+            assert simple
+        call1 = call2 = call3 = call_fixed = None
         if nyi:
             def func_arg_unwrap(*args):
                 raise SchemeException(
                     "primitive %s is not yet implemented" % name)
             _arity = arity or Arity.unknown
         elif argstypes is not None:
-            func_arg_unwrap, _arity, call1, call2 = _make_arg_unwrapper(
-                    func, argstypes, name, simple=simple)
+            # simple primitives with one to three arguments are called
+            # through simple1 to simple3 instead
+            func_arg_unwrap, _arity, call1, call2, call3, call_fixed = \
+                _make_arg_unwrapper(func, argstypes, name, simple=simple,
+                                    fixed=not simple)
             if arity is not None:
                 _arity = arity
         else:
@@ -281,10 +340,14 @@ def expose(n, argstypes=None, simple=True, arity=None, nyi=False, extra_info=Fal
         func_result_handling = _make_result_handling_func(func_arg_unwrap, simple)
         if not extra_info:
             func_result_handling = make_remove_extra_info(func_result_handling)
+            if call_fixed is not None:
+                call_fixed = make_remove_extra_info(call_fixed)
         result_arity = Arity.ONE if simple else None
         p = values.W_Prim(name, func_result_handling,
                           arity=_arity, result_arity=result_arity,
-                          simple1=call1, simple2=call2)
+                          simple1=call1, simple2=call2, simple3=call3,
+                          fixed=call_fixed, pure=pure,
+                          reads_mutable=reads_mutable)
         for nam in names:
             sym = values.W_Symbol.make(nam)
             if sym in prim_env:
@@ -297,7 +360,7 @@ def expose(n, argstypes=None, simple=True, arity=None, nyi=False, extra_info=Fal
 def make_call_method(argstypes=None, arity=None, simple=True, name="<method>"):
     def wrapper(func):
         if argstypes is not None:
-            func_arg_unwrap, _, _, _ = _make_arg_unwrapper(
+            func_arg_unwrap, _, _, _, _, _ = _make_arg_unwrapper(
                 func, argstypes, name, has_self=True)
         else:
             func_arg_unwrap = func
@@ -44,14 +44,14 @@ from pycket.prims import vector
 from rpython.rlib import jit
 
 def make_pred(name, cls):
-    @expose(name, [values.W_Object], simple=True)
+    @expose(name, [values.W_Object], simple=True, pure=True)
     def predicate_(a):
         return values.W_Bool.make(isinstance(a, cls))
     predicate_.__name__ +=  cls.__name__
 
 def make_pred_eq(name, val):
     typ = type(val)
-    @expose(name, [values.W_Object], simple=True)
+    @expose(name, [values.W_Object], simple=True, pure=True)
     def pred_eq(a):
         return values.W_Bool.make(a is val)
 
@@ -91,6 +91,7 @@ for args in [
         ("pseudo-random-generator?", values.W_PseudoRandomGenerator),
         ("char?", values.W_Character),
         ("continuation?", values.W_Continuation),
+        ("coroutine?", values.W_Coroutine),
         ("continuation-mark-set?", values.W_ContinuationMarkSet),
         ("continuation-mark-key?", values.W_ContinuationMarkKey),
         ("primitive?", values.W_Prim),
@@ -765,7 +766,7 @@ def make_list_eater(name):
         else:
             assert False, "Bad list eater specification"
 
-    @expose(name, [values.W_Object])
+    @expose(name, [values.W_Object], pure=True)
     def process_list(_lst):
         lst = _lst
         for letter in unrolled:
@@ -798,11 +799,11 @@ def do_mlist(args):
 def do_mcons(a, b):
     return values.W_MCons(a,b)
 
-@expose("mcar", [values.W_MCons])
+@expose("mcar", [values.W_MCons], reads_mutable=True)
 def do_mcar(a):
     return a.car()
 
-@expose("mcdr", [values.W_MCons])
+@expose("mcdr", [values.W_MCons], reads_mutable=True)
 def do_mcdr(a):
     return a.cdr()
 
@@ -1155,19 +1156,19 @@ def current_command_line_arguments(env, cont):
     return return_value(w_v, env, cont)
 
 # Unsafe pair ops
-@expose("unsafe-car", [subclass_unsafe(values.W_Cons)])
+@expose("unsafe-car", [subclass_unsafe(values.W_Cons)], pure=True)
 def unsafe_car(p):
     return p.car()
 
-@expose("unsafe-mcar", [subclass_unsafe(values.W_MCons)])
+@expose("unsafe-mcar", [subclass_unsafe(values.W_MCons)], reads_mutable=True)
 def unsafe_mcar(p):
     return p.car()
 
-@expose("unsafe-cdr", [subclass_unsafe(values.W_Cons)])
+@expose("unsafe-cdr", [subclass_unsafe(values.W_Cons)], pure=True)
 def unsafe_cdr(p):
     return p.cdr()
 
-@expose("unsafe-mcdr", [subclass_unsafe(values.W_MCons)])
+@expose("unsafe-mcdr", [subclass_unsafe(values.W_MCons)], reads_mutable=True)
 def unsafe_mcdr(p):
     return p.cdr()
 
@@ -48,10 +48,8 @@ def call_w_paramz(f, paramz, env, cont):
     return call_with_parameterization(f, [], paramz, env, cont)
 
 def call_with_extended_paramz(f, args, keys, vals, env, cont):
-    from pycket.values import parameterization_key
     # XXX seems untested?
-    paramz = cont.get_mark_first(parameterization_key)
-    assert isinstance(paramz, values_parameter.W_Parameterization) # XXX is this always right?
+    paramz = values_parameter.current_parameterization(cont)
     paramz_new = paramz.extend(keys, vals)
     return call_with_parameterization(f, args, paramz_new, env, cont)
 
@@ -265,7 +265,7 @@ def string_append(args):
         assert unibuilder is not None
         return W_String.fromunicode(unibuilder.build())
 
-@expose(["string-length", "unsafe-string-length"], [W_String])
+@expose(["string-length", "unsafe-string-length"], [W_String], pure=True)
 def string_length(s1):
     return values.W_Fixnum(s1.length())
 
@@ -387,7 +387,7 @@ def bytes_append(args):
     assert cnt == total_len
     return values.W_MutableBytes(result)
 
-@expose("bytes-length", [values.W_Bytes])
+@expose("bytes-length", [values.W_Bytes], pure=True)
 def bytes_length(s1):
     return values.W_Fixnum(s1.length())
 
@@ -176,7 +176,8 @@ def mk_stp(sym, guard, supers, _can_imp):
                                values_struct.W_StructPropertyAccessor(prop)])
 
 # Unsafe struct ops
-@expose("unsafe-struct-ref", [values.W_Object, unsafe(values.W_Fixnum)])
+@expose("unsafe-struct-ref", [values.W_Object, unsafe(values.W_Fixnum)],
+        reads_mutable=True)
 def unsafe_struct_ref(v, k):
     v = imp.get_base_object(v)
     assert isinstance(v, values_struct.W_Struct)
@@ -191,7 +192,8 @@ def unsafe_struct_set(v, k, val):
     assert 0 <= k.value < v.struct_type().total_field_cnt
     return v._set(k.value, val)
 
-@expose("unsafe-struct*-ref", [values_struct.W_Struct, unsafe(values.W_Fixnum)])
+@expose("unsafe-struct*-ref", [values_struct.W_Struct, unsafe(values.W_Fixnum)],
+        reads_mutable=True)
 def unsafe_struct_star_ref(v, k):
     assert 0 <= k.value < v.struct_type().total_field_cnt
     return v._ref(k.value)
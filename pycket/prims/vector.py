@@ -41,11 +41,11 @@ def make_flvector(w_size, w_val):
         raise SchemeException("make-flvector: expected a positive fixnum")
     return values_vector.W_FlVector.fromelement(w_val, size)
 
-@expose("vector-length", [values_vector.W_MVector])
+@expose("vector-length", [values_vector.W_MVector], pure=True)
 def vector_length(v):
     return values.W_Fixnum(v.length())
 
-@expose("flvector-length", [values_vector.W_FlVector])
+@expose("flvector-length", [values_vector.W_FlVector], pure=True)
 def flvector_length(v):
     return values.W_Fixnum(v.length())
 
@@ -189,11 +189,13 @@ def unsafe_vector_ref(v, i, env, cont):
         assert val >= 0
         return return_value(v.unsafe_ref(val), env, cont)
 
-@expose("unsafe-flvector-ref", [unsafe(values_vector.W_FlVector), unsafe(values.W_Fixnum)])
+@expose("unsafe-flvector-ref", [unsafe(values_vector.W_FlVector), unsafe(values.W_Fixnum)],
+        reads_mutable=True)
 def unsafe_flvector_ref(v, i):
     return v.unsafe_ref(i.value)
 
-@expose("unsafe-vector*-ref", [unsafe(values_vector.W_Vector), unsafe(values.W_Fixnum)])
+@expose("unsafe-vector*-ref", [unsafe(values_vector.W_Vector), unsafe(values.W_Fixnum)],
+        reads_mutable=True)
 def unsafe_vector_star_ref(v, i):
     return v.unsafe_ref(i.value)
 
@@ -220,11 +222,11 @@ def unsafe_vector_star_set(v, i, new):
 def unsafe_flvector_set(v, i, new):
     return v.unsafe_set(i.value, new)
 
-@expose("unsafe-vector-length", [subclass_unsafe(values.W_MVector)])
+@expose("unsafe-vector-length", [subclass_unsafe(values.W_MVector)], pure=True)
 def unsafe_vector_length(v):
     return values.W_Fixnum(v.length())
 
-@expose("unsafe-vector*-length", [unsafe(values_vector.W_Vector)])
+@expose("unsafe-vector*-length", [unsafe(values_vector.W_Vector)], pure=True)
 def unsafe_vector_star_length(v):
     return values.W_Fixnum(v.length())
 
@@ -1,4 +1,5 @@
-from rpython.rlib.rstring import StringBuilder
+from rpython.rlib.rstring import StringBuilder, ParseStringOverflowError
+from rpython.rlib.rarithmetic import string_to_int
 from rpython.rlib.runicode import unicode_encode_utf_8
 from rpython.rlib.objectmodel import specialize
 from rpython.rlib.parsing.ebnfparse import parse_ebnf, make_parse_function
@@ -290,3 +291,348 @@ def loads(s):
     finally:
         decoder.close()
 
+
+
+# ____________________________________________________________
+# Pull parser
+#
+# A single pass scanner over a JSON string. Instead of building the whole
+# JsonBase tree, the consumer asks for one event at a time and decides for
+# each value whether it wants the subtree (|read_value|), wants to skip it
+# (|skip_value|) or iterate over its contents itself. This allows the loader
+# to convert a module form by form, without keeping the JSON tree of the
+# whole module alive.
+
+EV_EOF          = 0
+EV_START_OBJECT = 1
+EV_END_OBJECT   = 2
+EV_START_ARRAY  = 3
+EV_END_ARRAY    = 4
+EV_KEY          = 5
+EV_STRING       = 6
+EV_INT          = 7
+EV_FLOAT        = 8
+EV_TRUE         = 9
+EV_FALSE        = 10
+EV_NULL         = 11
+
+# Parser states, one per open container
+_ARRAY_START  = 0 # after '['
+_ARRAY_NEXT   = 1 # after an element
+_OBJECT_START = 2 # after '{'
+_OBJECT_NEXT  = 3 # after a key/value pair
+_OBJECT_VALUE = 4 # after a key
+
+def _append_utf8(builder, code):
+    if code < 0x80:
+        builder.append(chr(code))
+    elif code < 0x800:
+        builder.append(chr(0xc0 | (code >> 6)))
+        builder.append(chr(0x80 | (code & 0x3f)))
+    elif code < 0x10000:
+        builder.append(chr(0xe0 | (code >> 12)))
+        builder.append(chr(0x80 | ((code >> 6) & 0x3f)))
+        builder.append(chr(0x80 | (code & 0x3f)))
+    else:
+        builder.append(chr(0xf0 | (code >> 18)))
+        builder.append(chr(0x80 | ((code >> 12) & 0x3f)))
+        builder.append(chr(0x80 | ((code >> 6) & 0x3f)))
+        builder.append(chr(0x80 | (code & 0x3f)))
+
+class JsonPullParser(object):
+
+    def __init__(self, s):
+        self.s = s
+        # the '\0' sentinel means we never have to check for the end of the
+        # string while scanning a token
+        self.ll_chars = s + chr(0)
+        self.pos = 0
+        self.states = []
+        self.done = False
+        self.peeked = -1
+        self.string_value = ""
+        self.int_value = 0
+        self.float_value = 0.0
+
+    @specialize.arg(1)
+    def _raise(self, msg, *args):
+        raise ValueError(msg % args)
+
+    def skip_whitespace(self, i):
+        while True:
+            ch = self.ll_chars[i]
+            if ch == ' ' or ch == '\t' or ch == '\r' or ch == '\n':
+                i += 1
+            else:
+                return i
+
+    def getslice(self, start, end):
+        assert start >= 0
+        assert end >= 0
+        return self.s[start:end]
+
+    # ____________________________________________________________
+    # events
+
+    def peek_event(self):
+        if self.peeked == -1:
+            self.peeked = self._next_event()
+        return self.peeked
+
+    def next_event(self):
+        event = self.peeked
+        if event != -1:
+            self.peeked = -1
+            return event
+        return self._next_event()
+
+    def _next_event(self):
+        i = self.skip_whitespace(self.pos)
+        ch = self.ll_chars[i]
+        if not self.states:
+            if self.done:
+                if i < len(self.s):
+                    self._raise("Extra data: char %d - %d", i, len(self.s) - 1)
+                self.pos = i
+                return EV_EOF
+            self.done = True
+            return self._value_event(i)
+        state = self.states[-1]
+        if state == _ARRAY_START or state == _ARRAY_NEXT:
+            if ch == ']':
+                self.pos = i + 1
+                self.states.pop()
+                return EV_END_ARRAY
+            if state == _ARRAY_NEXT:
+                if ch != ',':
+                    self._raise("Unexpected '%s' when decoding array (char %d)", ch, i)
+                i = self.skip_whitespace(i + 1)
+            self.states[-1] = _ARRAY_NEXT
+            return self._value_event(i)
+        if state == _OBJECT_VALUE:
+            if ch != ':':
+                self._raise("No ':' found at char %d", i)
+            i = self.skip_whitespace(i + 1)
+            self.states[-1] = _OBJECT_NEXT
+            return self._value_event(i)
+        # _OBJECT_START or _OBJECT_NEXT
+        if ch == '}':
+            self.pos = i + 1
+            self.states.pop()
+            return EV_END_OBJECT
+        if state == _OBJECT_NEXT:
+            if ch != ',':
+                self._raise("Unexpected '%s' when decoding object (char %d)", ch, i)
+            i = self.skip_whitespace(i + 1)
+        if self.ll_chars[i] != '"':
+            self._raise("Key name must be string at char %d", i)
+        self.string_value = self._scan_string(i + 1)
+        self.states[-1] = _OBJECT_VALUE
+        return EV_KEY
+
+    def _value_event(self, i):
+        ch = self.ll_chars[i]
+        if ch == '{':
+            self.pos = i + 1
+            self.states.append(_OBJECT_START)
+            return EV_START_OBJECT
+        if ch == '[':
+            self.pos = i + 1
+            self.states.append(_ARRAY_START)
+            return EV_START_ARRAY
+        if ch == '"':
+            self.string_value = self._scan_string(i + 1)
+            return EV_STRING
+        if ch == '-' or ('0' <= ch <= '9'):
+            return self._scan_number(i)
+        if ch == 't' and self.getslice(i, i + 4) == "true":
+            self.pos = i + 4
+            return EV_TRUE
+        if ch == 'f' and self.getslice(i, i + 5) == "false":
+            self.pos = i + 5
+            return EV_FALSE
+        if ch == 'n' and self.getslice(i, i + 4) == "null":
+            self.pos = i + 4
+            return EV_NULL
+        if ch == '\0' and i >= len(self.s):
+            self._raise("Unexpected end of input at char %d", i)
+        raise ValueError("No JSON object could be decoded: unexpected '%s' at char %d" % (ch, i))
+
+    def _scan_number(self, i):
+        start = i
+        if self.ll_chars[i] == '-':
+            i += 1
+        is_float = False
+        while True:
+            ch = self.ll_chars[i]
+            if '0' <= ch <= '9':
+                i += 1
+            elif ch == '.' or ch == 'e' or ch == 'E' or ch == '+' or ch == '-':
+                is_float = True
+                i += 1
+            else:
+                break
+        self.pos = i
+        s = self.getslice(start, i)
+        if not is_float:
+            try:
+                self.int_value = string_to_int(s)
+                return EV_INT
+            except ParseStringOverflowError:
+                pass
+        self.float_value = float(s)
+        return EV_FLOAT
+
+    def _scan_string(self, i):
+        start = i
+        while True:
+            # fast path for strings which do not contain escape characters
+            ch = self.ll_chars[i]
+            if ch == '"':
+                self.pos = i + 1
+                return self.getslice(start, i)
+            elif ch == '\\':
+                return self._scan_string_escaped(start, i)
+            elif ch < '\x20':
+                if ch == '\0' and i >= len(self.s):
+                    self._raise("Unterminated string starting at char %d", start - 1)
+                self._raise("Invalid control character at char %d", i)
+            i += 1
+
+    def _scan_string_escaped(self, start, i):
+        builder = StringBuilder((i - start) * 2)
+        builder.append_slice(self.s, start, i)
+        while True:
+            ch = self.ll_chars[i]
+            i += 1
+            if ch == '"':
+                self.pos = i
+                return builder.build()
+            elif ch == '\\':
+                ch = self.ll_chars[i]
+                i += 1
+                if ch == '"' or ch == '\\' or ch == '/':
+                    builder.append(ch)
+                elif ch == 'n':
+                    builder.append('\n')
+                elif ch == 't':
+                    builder.append('\t')
+                elif ch == 'r':
+                    builder.append('\r')
+                elif ch == 'b':
+                    builder.append('\b')
+                elif ch == 'f':
+                    builder.append('\f')
+                elif ch == 'u':
+                    code = self._scan_hex4(i)
+                    i += 4
+                    if (0xd800 <= code <= 0xdbff and self.ll_chars[i] == '\\'
+                            and self.ll_chars[i + 1] == 'u'):
+                        low = self._scan_hex4(i + 2)
+                        if 0xdc00 <= low <= 0xdfff:
+                            code = 0x10000 + (((code - 0xd800) << 10) | (low - 0xdc00))
+                            i += 6
+                    _append_utf8(builder, code)
+                else:
+                    self._raise("Invalid \\escape: %s (char %d)", ch, i - 1)
+            elif ch < '\x20':
+                if ch == '\0' and i > len(self.s):
+                    self._raise("Unterminated string starting at char %d", start - 1)
+                self._raise("Invalid control character at char %d", i - 1)
+            else:
+                builder.append(ch)
+
+    def _scan_hex4(self, i):
+        code = 0
+        for j in range(4):
+            ch = self.ll_chars[i + j]
+            if '0' <= ch <= '9':
+                digit = ord(ch) - ord('0')
+            elif 'a' <= ch <= 'f':
+                digit = ord(ch) - ord('a') + 10
+            elif 'A' <= ch <= 'F':
+                digit = ord(ch) - ord('A') + 10
+            else:
+                self._raise("Invalid \\uXXXX escape (char %d)", i + j)
+            code = (code << 4) | digit
+        return code
+
+    # ____________________________________________________________
+    # structured access
+
+    def expect(self, expected):
+        event = self.next_event()
+        if event != expected:
+            self._raise("Unexpected JSON event %d, expected %d (char %d)",
+                        event, expected, self.pos)
+
+    def next_key(self):
+        """ Inside an object: returns True and sets |string_value| to the next
+        key, or returns False at the end of the object. """
+        event = self.next_event()
+        if event == EV_KEY:
+            return True
+        if event == EV_END_OBJECT:
+            return False
+        raise ValueError("Expected key or end of object (char %d)" % self.pos)
+
+    def next_element(self):
+        """ Inside an array: returns True if there is another element, which
+        must then be consumed, or consumes the end of the array and returns
+        False. """
+        if self.peek_event() == EV_END_ARRAY:
+            self.next_event()
+            return False
+        return True
+
+    def read_value(self):
+        """ Reads the next value, building the JsonBase tree for it. """
+        event = self.next_event()
+        if event == EV_START_OBJECT:
+            dct = {}
+            while self.next_key():
+                key = self.string_value
+                dct[key] = self.read_value()
+            return JsonObject(dct)
+        if event == EV_START_ARRAY:
+            lst = []
+            while self.next_element():
+                lst.append(self.read_value())
+            return JsonArray(lst)
+        if event == EV_STRING:
+            return JsonString(self.string_value)
+        if event == EV_INT:
+            return JsonInt(self.int_value)
+        if event == EV_FLOAT:
+            return JsonFloat(self.float_value)
+        if event == EV_TRUE:
+            return json_true
+        if event == EV_FALSE:
+            return json_false
+        if event == EV_NULL:
+            return json_null
+        raise ValueError("Unexpected JSON event %d (char %d)" % (event, self.pos))
+
+    def skip_value(self):
+        """ Skips the next value without building anything. """
+        depth = 0
+        while True:
+            event = self.next_event()
+            if event == EV_START_OBJECT or event == EV_START_ARRAY:
+                depth += 1
+            elif event == EV_END_OBJECT or event == EV_END_ARRAY:
+                depth -= 1
+            elif event == EV_EOF:
+                self._raise("Unexpected end of input (char %d)", self.pos)
+            if depth == 0 and event != EV_KEY:
+                return
+
+    def finish(self):
+        """ Checks that nothing but whitespace follows the parsed value. """
+        self.expect(EV_EOF)
+
+def loads_pull(s):
+    parser = JsonPullParser(s)
+    w_res = parser.read_value()
+    parser.finish()
+    return w_res
@@ -0,0 +1,236 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Wall time and memory spent in the phases of starting a program, per module.
+#
+# Phases nest: instantiating a module requires other modules, which are
+# expanded, read, converted and instantiated in turn. Every phase records its
+# total cost and its own cost, which excludes the phases nested in it, so that
+# the own costs of all phases add up to the cost of the whole startup.
+#
+# RPython does not expose a counter of allocated bytes, so the memory column
+# is the growth of the resident set size during a phase, as reported by
+# /proc/self/statm; it is 0 where that is not available.
+#
+import os
+import time
+
+from rpython.rlib.listsort import make_timsort_class
+from rpython.rlib.rfloat import formatd
+from rpython.rlib.rstring import StringBuilder
+
+PAGE_SIZE = 4096
+
+def resident_bytes():
+    try:
+        fd = os.open("/proc/self/statm", os.O_RDONLY, 0)
+    except OSError:
+        return 0
+    try:
+        data = os.read(fd, 256)
+    finally:
+        os.close(fd)
+    fields = data.split(" ")
+    if len(fields) < 2:
+        return 0
+    try:
+        return int(fields[1]) * PAGE_SIZE
+    except ValueError:
+        return 0
+
+class PhaseRecord(object):
+    def __init__(self, phase, module):
+        self.phase = phase
+        self.module = module
+        self.count = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+        self.self_bytes = 0
+
+class Frame(object):
+    def __init__(self, record, start_time, start_bytes):
+        self.record = record
+        self.start_time = start_time
+        self.start_bytes = start_bytes
+        self.child_time = 0.0
+        self.child_bytes = 0
+
+BaseSorter = make_timsort_class()
+
+class CostSorter(BaseSorter):
+    def lt(self, a, b):
+        return a.self_time > b.self_time
+
+class StartupProfiler(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.json_file = ""
+        self.records = {}
+        self.order = []
+        self.stack = []
+
+    def enable(self, json_file=""):
+        self.enabled = True
+        self.json_file = json_file
+
+    def _record(self, phase, module):
+        key = "%s\0%s" % (phase, module)
+        record = self.records.get(key, None)
+        if record is None:
+            record = PhaseRecord(phase, module)
+            self.records[key] = record
+            self.order.append(record)
+        return record
+
+    def start(self, phase, module):
+        record = self._record(phase, module)
+        self.stack.append(Frame(record, time.time(), resident_bytes()))
+
+    def stop(self):
+        frame = self.stack.pop()
+        elapsed = time.time() - frame.start_time
+        grown = resident_bytes() - frame.start_bytes
+        record = frame.record
+        record.count += 1
+        record.total_time += elapsed
+        record.self_time += elapsed - frame.child_time
+        record.self_bytes += grown - frame.child_bytes
+        if self.stack:
+            parent = self.stack[-1]
+            parent.child_time += elapsed
+            parent.child_bytes += grown
+
+    def phase_totals(self):
+        """ One record per phase, summing the own costs over all modules,
+        sorted by cost. """
+        totals = {}
+        result = []
+        for record in self.order:
+            total = totals.get(record.phase, None)
+            if total is None:
+                total = PhaseRecord(record.phase, "")
+                totals[record.phase] = total
+                result.append(total)
+            total.count += record.count
+            total.self_time += record.self_time
+            total.total_time += record.self_time
+            total.self_bytes += record.self_bytes
+        CostSorter(result).sort()
+        return result
+
+    def module_records(self):
+        result = self.order[:]
+        CostSorter(result).sort()
+        return result
+
+    def report(self):
+        lines = ["Startup profile (ms of wall time, kB of resident memory growth;",
+                 "'self' excludes nested phases)",
+                 "",
+                 _row(["phase", "count", "self ms", "self kB"], [-16, 6, 10, 10])]
+        for record in self.phase_totals():
+            lines.append(_row([record.phase, str(record.count),
+                               _ms(record.self_time),
+                               str(record.self_bytes // 1024)],
+                              [-16, 6, 10, 10]))
+        lines.append("")
+        lines.append(_row(["phase", "self ms", "total ms", "self kB", "module"],
+                          [-16, 10, 10, 10, 0]))
+        for record in self.module_records():
+            lines.append(_row([record.phase, _ms(record.self_time),
+                               _ms(record.total_time),
+                               str(record.self_bytes // 1024), record.module],
+                              [-16, 10, 10, 10, 0]))
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        builder = StringBuilder()
+        builder.append("{\"phases\": [")
+        first = True
+        for record in self.phase_totals():
+            if not first:
+                builder.append(", ")
+            first = False
+            builder.append("{\"phase\": %s, \"count\": %d, \"self_ms\": %s, \"self_bytes\": %d}" % (
+                json_string(record.phase), record.count,
+                _ms(record.self_time), record.self_bytes))
+        builder.append("], \"modules\": [")
+        first = True
+        for record in self.module_records():
+            if not first:
+                builder.append(", ")
+            first = False
+            builder.append("{\"phase\": %s, \"module\": %s, \"count\": %d, \"self_ms\": %s, \"total_ms\": %s, \"self_bytes\": %d}" % (
+                json_string(record.phase), json_string(record.module),
+                record.count, _ms(record.self_time),
+                _ms(record.total_time), record.self_bytes))
+        builder.append("]}\n")
+        return builder.build()
+
+def _ms(seconds):
+    return formatd(seconds * 1000.0, "f", 1)
+
+def _row(cells, widths):
+    """ Pads the cells to the widths, negative widths align left. """
+    builder = StringBuilder()
+    for i in range(len(cells)):
+        cell = cells[i]
+        width = widths[i]
+        if i > 0:
+            builder.append(" ")
+        if width < 0:
+            builder.append(cell)
+            builder.append(" " * max(0, -width - len(cell)))
+        else:
+            builder.append(" " * max(0, width - len(cell)))
+            builder.append(cell)
+    return builder.build()
+
+def json_string(s):
+    builder = StringBuilder(len(s) + 2)
+    builder.append("\"")
+    for c in s:
+        if c == "\"" or c == "\\":
+            builder.append("\\")
+            builder.append(c)
+        elif ord(c) < 0x20:
+            builder.append("\\u00")
+            builder.append("0123456789abcdef"[ord(c) >> 4])
+            builder.append("0123456789abcdef"[ord(c) & 0xf])
+        else:
+            builder.append(c)
+    builder.append("\"")
+    return builder.build()
+
+profiler = StartupProfiler()
+
+# Phases, see the call sites of |start|
+PHASE_EXPAND      = "expand"
+PHASE_PREFETCH    = "prefetch"
+PHASE_READ        = "read file"
+PHASE_TO_MODULE   = "parse+convert"
+PHASE_FINALIZE    = "finalize"
+PHASE_LOAD_BINARY = "load binary ast"
+PHASE_TREE_SHAKE  = "tree shake"
+PHASE_INSTANTIATE = "instantiate"
+
+def start(phase, module):
+    if profiler.enabled:
+        profiler.start(phase, module)
+
+def stop():
+    if profiler.enabled:
+        profiler.stop()
+
+def write_report():
+    """ Prints the report to stderr, and writes it as JSON to the file given
+    to |enable|, if any. """
+    os.write(2, profiler.report())
+    json_file = profiler.json_file
+    if json_file:
+        fd = os.open(json_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.write(fd, profiler.to_json())
+        finally:
+            os.close(fd)
@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Selection of the fused AST nodes for common shapes of normalized code.
+#
+# Most steps of the interpreter loop are an if whose test is a primitive
+# application or a let binding the result of one, often of the comparison
+# the following if tests:
+#
+#   (let ([if0 (unsafe-fx< i n)]) (if if0 ...))
+#
+# A Let evaluates its right hand side in a step of its own and binds it in a
+# LetCont. The fused nodes (IfPrimTest1/2, LetPrim1/2) call the primitives
+# directly, and a LetPrim1 whose body tests its variable picks the branch in
+# the same step. |If.make| and |Let.make| choose them; this pass rebuilds the
+# ifs and lets of a finished module through these, keeping the environment
+# structures. Deserialized modules get them from the same constructors.
+#
+from pycket.ast_visitor       import ASTVisitor
+from pycket.interpreter       import (
+    Begin,
+    Begin0,
+    CaseLambda,
+    If,
+    Lambda,
+    Let,
+    Letrec,
+    Module,
+)
+
+class SuperinstructionVisitor(ASTVisitor):
+    """ Rebuilds an assignment converted AST with the fused nodes. """
+
+    def visit_if(self, ast):
+        assert isinstance(ast, If)
+        tst = ast.tst.visit(self)
+        thn = ast.thn.visit(self)
+        els = ast.els.visit(self)
+        return If.make(tst, thn, els)
+
+    def visit_begin(self, ast):
+        assert isinstance(ast, Begin)
+        # the length of the body has to stay the same for the env pruning
+        result = Begin([b.visit(self) for b in ast.body])
+        result.copy_body_pruning(ast)
+        return result
+
+    def visit_begin0(self, ast):
+        assert isinstance(ast, Begin0)
+        first = ast.first.visit(self)
+        result = Begin0(first, [b.visit(self) for b in ast.body])
+        result.copy_body_pruning(ast)
+        return result
+
+    def visit_case_lambda(self, ast):
+        assert isinstance(ast, CaseLambda)
+        lams = [l.visit(self) for l in ast.lams]
+        return CaseLambda(lams, recursive_sym=ast.recursive_sym, arity=ast._arity)
+
+    def visit_lambda(self, ast):
+        assert isinstance(ast, Lambda)
+        ast.force_body()
+        body = [b.visit(self) for b in ast.body]
+        result = Lambda(ast.formals, ast.rest, ast.args, ast.frees, body,
+                        sourceinfo=ast.sourceinfo,
+                        enclosing_env_structure=ast.enclosing_env_structure,
+                        env_structure=ast.env_structure)
+        result.copy_body_pruning(ast)
+        if ast._mutable_var_flags is not None:
+            result.init_mutable_var_flags(ast._mutable_var_flags)
+        return result
+
+    def visit_letrec(self, ast):
+        assert isinstance(ast, Letrec)
+        rhss = [r.visit(self) for r in ast.rhss]
+        body = [b.visit(self) for b in ast.body]
+        result = Letrec(ast.args, ast.counts, rhss, body)
+        result.copy_body_pruning(ast)
+        return result
+
+    def visit_let(self, ast):
+        assert isinstance(ast, Let)
+        rhss = [r.visit(self) for r in ast.rhss]
+        body = [b.visit(self) for b in ast.body]
+        result = Let.make(ast.args, ast.counts, rhss, body, ast.remove_num_envs)
+        result.copy_body_pruning(ast)
+        if ast._mutable_var_flags is not None:
+            result.init_mutable_var_flags(ast._mutable_var_flags)
+        return result
+
+def select_superinstructions(ast):
+    assert isinstance(ast, Module)
+    return ast.visit(SuperinstructionVisitor())
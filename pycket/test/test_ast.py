@@ -8,10 +8,11 @@ from pycket.expand import parse_module
 from pycket.interpreter import (LexicalVar, ModuleVar, Done, CaseLambda,
                                 variable_set, variables_equal,
                                 Lambda, Letrec, Let, Quote, App, If, Begin,
-                                SimplePrimApp1, SimplePrimApp2,
-                                WithContinuationMark, SetBang,
+                                SimplePrimApp1, SimplePrimApp2, SimplePrimApp3,
+                                FixedArityApp, KnownCallApp,
+                                WithContinuationMark, SetBang, DefineValues,
                                 )
-from pycket.test.testhelper import format_pycket_mod, run_mod
+from pycket.test.testhelper import format_pycket_mod, nodes, prim, run_mod
 
 skip = pytest.mark.skipif("True")
 
@@ -31,7 +32,7 @@ def test_symlist_depth():
     assert s.depth_and_size() == (2, 4)
 
 def test_mutvars():
-    p = expr_ast("(lambda (x) (set! x 2))")
+    p = expr_ast("(lambda (x) (set! x 2) (lambda () x))")
     assert len(p.mutated_vars()) == 0
     assert p.lams[0]._mutable_var_flags[0]
     p = expr_ast(("(lambda (y) (set! x 2))"))
@@ -55,7 +56,7 @@ def test_cache_lambda_if_no_frees():
     assert w_cl1.closure._get_list(0).toplevel_env() is toplevel
 
 def test_env_structure_apps():
-    p = expr_ast("(let ([a 1] [b 2]) (+ a b))")
+    p = expr_ast("(let ([a (cons 1 2)] [b (cons 3 4)]) (cons a b))")
     a = W_Symbol.make("a")
     b = W_Symbol.make("b")
     assert isinstance(p, Let)
@@ -92,6 +93,114 @@ def test_remove_simple_if():
     p = expr_ast("(if #f 'then 'else)")
     assert isinstance(p, Quote) and p.w_val is W_Symbol.make("else")
 
+def test_constant_fold_prims():
+    p = expr_ast("(+ 1 (* 2 3))")
+    assert isinstance(p, Quote) and p.w_val.value == 7
+    p = expr_ast("(if (< 1 2) 'then 'else)")
+    assert isinstance(p, Quote) and p.w_val is W_Symbol.make("then")
+    # errors happen at run time
+    p = expr_ast("(car 1)")
+    assert isinstance(p, SimplePrimApp1)
+    # allocating primitives keep their identity
+    p = expr_ast("(cons 1 2)")
+    assert isinstance(p, SimplePrimApp2)
+
+    p = expr_ast("(string-set! (make-string 1) 0 #\\a)")
+    assert isinstance(p, Let)
+    assert isinstance(p.body[0], SimplePrimApp3)
+
+def test_fixed_arity_apps():
+    f = LexicalVar(W_Symbol.make("f"))
+    for argc in range(5):
+        rands = [Quote(W_Fixnum(i)) for i in range(argc)]
+        p = App.make(f, rands)
+        assert isinstance(p, FixedArityApp)
+        assert p.argc == argc
+    p = App.make(f, [Quote(W_Fixnum(i)) for i in range(5)])
+    assert type(p) is App
+
+def test_fixed_arity_calls():
+    m = run_mod("""
+    #lang pycket
+    (define (f0) 0)
+    (define (f4 a b c d) (list a b c d))
+    (define (g a b c) (set! b (+ a b c)) b)
+    (define h (case-lambda [(x) 1] [(x . r) r] [(x y) 2]))
+    (define (k y) (lambda (a b c) (+ y a b c)))
+    (define r (list (f0) (f4 1 2 3 4) (g 1 2 3) (h 1 2) ((k 1) 2 3 4)))
+    """)
+    r = m.defs[W_Symbol.make("r")]
+    assert r.tostring() == "(0 (1 2 3 4) 6 (2) 10)"
+
+def test_known_call_apps():
+    f = W_Symbol.make("f")
+    p = App.make(ModuleVar(f, None, f), [Quote(W_Fixnum(1))])
+    assert isinstance(p, KnownCallApp)
+    assert p.linked == KnownCallApp.UNLINKED
+    car = W_Symbol.make("car")
+    p = App.make(ModuleVar(car, "#%kernel", car), [Quote(W_Fixnum(1))])
+    assert not isinstance(p, KnownCallApp)
+    p = App.make(LexicalVar(f), [Quote(W_Fixnum(1))])
+    assert not isinstance(p, KnownCallApp)
+
+def test_known_calls():
+    m = run_mod("""
+    #lang pycket
+    (define (f x) (+ x 1))
+    (define g (case-lambda [(x) 1] [(x y) (list x y)]))
+    (define (h x) x)
+    (define (k . r) r)
+    (define (call-all) (list (f 1) (g 1) (g 1 2) (h 1) (k 1 2)))
+    (define before (call-all))
+    (set! h (lambda (x) (* x 10)))
+    (define r (list before (call-all)))
+    """)
+    r = m.defs[W_Symbol.make("r")]
+    assert r.tostring() == "((2 1 (1 2) 1 (1 2)) (2 1 (1 2) 10 (1 2)))"
+
+def test_constant_fold_let():
+    p = expr_ast("(lambda (y) (let ([a 1] [b (add1 1)]) (+ a b y)))")
+    let = p.lams[0].body[0]
+    assert isinstance(let, Let)
+    assert isinstance(let.rhss[1], Quote) and let.rhss[1].w_val.value == 2
+    app = let.body[0]
+    assert isinstance(app, App)
+    assert [r.w_val.value for r in app.rands[:2]] == [1, 2]
+    # mutated variables are not constant
+    p = expr_ast("(let ([a 1]) (set! a 2) a)")
+    assert isinstance(p, Let)
+    assert not isinstance(p.body[-1], Quote)
+
+def test_constant_fold_module_constants():
+    m = run_mod("""
+    #lang pycket
+    (define k (* 6 7))
+    (define (f) k)
+    (define m 1)
+    (set! m 2)
+    (define (g) m)
+    """)
+    defs = {}
+    for form in m.body:
+        if isinstance(form, DefineValues):
+            defs[form.names[0].utf8value] = form.rhs
+    f = defs["f"].lams[0]
+    assert isinstance(f.body[0], Quote) and f.body[0].w_val.value == 42
+    g = defs["g"].lams[0]
+    assert not isinstance(g.body[0], Quote)
+
+def test_fold_primitive_app():
+    from pycket.constant_fold import fold_primitive_app
+    def fold(name, *args):
+        return fold_primitive_app(prim(name), [Quote(a) for a in args])
+    assert fold("+", W_Fixnum(1), W_Fixnum(2), W_Fixnum(3)).w_val.value == 6
+    assert fold("<", W_Fixnum(1), W_Fixnum(2), W_Fixnum(0)).w_val is w_false
+    assert fold("not", w_false).w_val is w_true
+    assert fold("add1", W_Fixnum(1)).w_val.value == 2
+    assert fold("+", W_Fixnum(1), w_true) is None
+    assert fold("cons", W_Fixnum(1), W_Fixnum(2)) is None
+    assert fold_primitive_app(prim("add1"), [LexicalVar(W_Symbol.make("x"))]) is None
+
 def test_remove_simple_begin():
     p = expr_ast("(begin #f #t)")
     assert isinstance(p, Quote) and p.w_val is w_true
@@ -263,7 +372,7 @@ def test_simple_prim_calls_are_simple_expressions():
     assert isinstance(p, SimplePrimApp1)
 
 def test_nested_lets():
-    p = expr_ast("(let ([x (let ([y (equal? 1 2)]) y)]) (equal? #t x))")
+    p = expr_ast("(let ([x (let ([y (cons 1 2)]) y)]) (cons #t x))")
     assert isinstance(p, Let)
     assert isinstance(p.rhss[0], App)
     let_body = p.body[0]
@@ -272,7 +381,7 @@ def test_nested_lets():
     assert isinstance(let_body, App)
 
 def test_nontrivial_with_continuation_mark():
-    p = expr_ast("(with-continuation-mark 'key 'val (equal? (equal? 1 2) 3))")
+    p = expr_ast("(with-continuation-mark 'key 'val (cons (cons 1 2) 3))")
     assert isinstance(p, WithContinuationMark)
     body = p.body
     assert isinstance(body, Let)
@@ -296,7 +405,7 @@ def test_flatten_nested_begins():
     assert isinstance(val, W_Fixnum) and val.value == 7
 
 def test_anf_setbang():
-    p = expr_ast("(let ([x 0]) (set! x (+ 1 (+ x 3))))")
+    p = expr_ast("(let ([x 0]) (set! x (+ 1 (+ x 3))) (lambda () x))")
     assert isinstance(p, Let)
     p = p.body[0]
     assert isinstance(p, Let)
@@ -306,3 +415,65 @@ def test_anf_setbang():
     assert isinstance(p, SetBang)
     assert p.rhs.simple
 
+
+def test_uncaptured_assignments_need_no_cells():
+    from pycket.assign_convert import assign_convert
+    from pycket.interpreter import CellRef, make_lambda
+    x = W_Symbol.make("x")
+    y = W_Symbol.make("y")
+    add1 = prim("add1")
+    def lam(*body):
+        return CaseLambda([make_lambda([x], None, list(body))])
+    # (lambda (x) (set! x (add1 x)) x)
+    p = assign_convert(lam(SetBang(CellRef(x), App.make(add1, [LexicalVar(x)])),
+                           LexicalVar(x)))
+    body = p.lams[0].body
+    assert p.lams[0]._mutable_var_flags is None
+    assert isinstance(body[0], Let) and body[0].body[0].sym is body[0].args.elems[0]
+    # (lambda (x) (set! x (add1 x)) (lambda (y) x))
+    p = assign_convert(lam(SetBang(CellRef(x), App.make(add1, [LexicalVar(x)])),
+                           CaseLambda([make_lambda([y], None, [LexicalVar(x)])])))
+    assert p.lams[0]._mutable_var_flags[0]
+    # (lambda (x) (y) (set! x 1) x): y may capture the continuation
+    call = App.make(LexicalVar(y), [])
+    p = assign_convert(lam(call, SetBang(CellRef(x), Quote(W_Fixnum(1))),
+                           LexicalVar(x)))
+    assert p.lams[0]._mutable_var_flags[0]
+
+def test_loop_accumulators_need_no_cells():
+    from pycket.assign_convert import assign_convert
+    from pycket.interpreter import CellRef, Loop, make_lambda, make_let
+    from pycket.loops import make_loop
+    x = W_Symbol.make("x")
+    i = W_Symbol.make("i")
+    j = W_Symbol.make("j")
+    lp = W_Symbol.make("lp")
+    def cells(ast):
+        binders = nodes(ast, Lambda) + nodes(ast, Let)
+        return ([b for b in binders if b._mutable_var_flags is not None] +
+                nodes(ast, CellRef))
+    # (lambda (x)
+    #   (let lp ([i 3])
+    #     (if (zero? i) (void) (let ([j (sub1 i)]) (set! x (add1 x)) (lp j))))
+    #   x)
+    step = make_let([[j]], [App.make(prim("sub1"), [LexicalVar(i)])],
+                    [SetBang(CellRef(x), App.make(prim("add1"), [LexicalVar(x)])),
+                     App.make(LexicalVar(lp), [LexicalVar(j)])])
+    body = If(App.make(prim("zero?"), [LexicalVar(i)]),
+              App.make(prim("void"), []), step)
+    caselam = CaseLambda([make_lambda([i], None, [body])], recursive_sym=lp)
+    loop = make_loop(caselam, [Quote(W_Fixnum(3))])
+    assert isinstance(loop, Loop)
+    p = assign_convert(CaseLambda([make_lambda([x], None, [loop, LexicalVar(x)])]))
+    assert cells(p) == []
+    loop = p.lams[0].body[0].rhss[0]
+    assert isinstance(loop, Loop)
+    assert len(loop.rands) == 2 and loop.rands[1].sym is x
+    # (lambda (x) (if x (set! x 1) (void)) x)
+    tst = If(LexicalVar(x), SetBang(CellRef(x), Quote(W_Fixnum(1))),
+             App.make(prim("void"), []))
+    p = assign_convert(CaseLambda([make_lambda([x], None, [tst, LexicalVar(x)])]))
+    assert cells(p) == []
+    join = p.lams[0].body[0]
+    assert isinstance(join, Let) and isinstance(join.rhss[0], If)
+    assert join.body[0].sym is join.args.elems[0]
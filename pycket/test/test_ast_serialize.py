@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the binary AST cache
+#
+import os
+import pytest
+from pycket.expand import expand_string, parse_module, JsonLoader, _binary_ast_name
+from pycket.ast_serialize import (serialize_module, deserialize_module,
+                                  DeserializationError)
+from pycket.values import W_Symbol
+from pycket.error import SchemeException
+from pycket.interpreter import DefineValues, CaseLambda
+from pycket.test.testhelper import format_pycket_mod, run_ast
+
+prog = """
+(define (fact n) (if (= n 0) 1 (* n (fact (- n 1)))))
+(define (unused n) (lambda (k) (+ n k)))
+(define x (fact 10))
+(define y (let loop ([i 0] [acc 0]) (if (< i 100) (loop (+ i 1) (+ acc i)) acc)))
+(define z (let ([a 1]) (set! a (+ a 5)) a))
+(define q '(1 2.5 "s" sym #\\a #(1 2) 123456789012345678901234567890 1/3))
+(define cl (case-lambda [(a) a] [(a b) (+ a b)]))
+(define v (cl 3 4))
+(define w (with-continuation-mark 'k 1 (let-values ([(a b) (values 1 2)]) (+ a b))))
+"""
+
+def make_module():
+    return parse_module(expand_string(format_pycket_mod(prog)))
+
+def lookup(mod, name):
+    return mod.defs[W_Symbol.make(name)]
+
+def test_roundtrip():
+    data = serialize_module(make_module(), 0)
+    mod = deserialize_module(data, JsonLoader(), 0)
+    run_ast(mod)
+    assert lookup(mod, "x").value == 3628800
+    assert lookup(mod, "y").value == 4950
+    assert lookup(mod, "z").value == 6
+    assert lookup(mod, "v").value == 7
+    assert lookup(mod, "w").value == 3
+    expected = run_ast(make_module())
+    assert lookup(mod, "q").equal(lookup(expected, "q"))
+
+def test_roundtrip_is_stable():
+    data = serialize_module(make_module(), 0)
+    mod = deserialize_module(data, JsonLoader(), 0)
+    assert serialize_module(mod, 0) == data
+
+def test_stale_flags():
+    data = serialize_module(make_module(), 0)
+    with pytest.raises(DeserializationError):
+        deserialize_module(data, JsonLoader(), 1)
+    with pytest.raises(DeserializationError):
+        deserialize_module(data[:len(data) // 2], JsonLoader(), 0)
+    with pytest.raises(DeserializationError):
+        deserialize_module("garbage", JsonLoader(), 0)
+
+def lambda_of(mod, name):
+    for form in mod.body:
+        if isinstance(form, DefineValues) and form.names[0] is W_Symbol.make(name):
+            assert isinstance(form.rhs, CaseLambda)
+            return form.rhs.lams[0]
+    assert False
+
+def test_lazy_bodies():
+    data = serialize_module(make_module(), 0)
+    mod = deserialize_module(data, JsonLoader(), 0, lazy=True)
+    assert lambda_of(mod, "fact").lazy_body is not None
+    assert lambda_of(mod, "unused").lazy_body is not None
+    run_ast(mod)
+    assert lookup(mod, "x").value == 3628800
+    assert lookup(mod, "v").value == 7
+    assert lambda_of(mod, "fact").lazy_body is None
+    assert lambda_of(mod, "unused").lazy_body is not None
+    # forcing the remaining bodies gives back the same module
+    assert serialize_module(mod, 0) == data
+
+def test_load_json_ast_cached(tmpdir):
+    rkt_file = str(tmpdir.join("mod.rkt"))
+    json_file = rkt_file + ".json"
+    with open(json_file, "w") as f:
+        f.write(expand_string(format_pycket_mod(prog)))
+    ast_file = _binary_ast_name(json_file)
+    assert ast_file == rkt_file + ".ast"
+
+    mod = JsonLoader().load_json_ast_cached(rkt_file, json_file)
+    assert os.path.exists(ast_file)
+    run_ast(mod)
+    assert lookup(mod, "x").value == 3628800
+
+    # The second load must come from the cache, even if the JSON is unreadable
+    os.utime(ast_file, (os.stat(json_file).st_mtime + 10,) * 2)
+    with open(json_file, "w") as f:
+        f.write("not json")
+    os.utime(json_file, (os.stat(ast_file).st_mtime - 10,) * 2)
+    mod = JsonLoader().load_json_ast_cached(rkt_file, json_file)
+    run_ast(mod)
+    assert lookup(mod, "y").value == 4950
+
+def test_inlined_modules_make_cache_stale(tmpdir):
+    from pycket.interpreter import Module
+    rkt_file = str(tmpdir.join("mod.rkt"))
+    dep_file = str(tmpdir.join("dep.rkt"))
+    json_file = rkt_file + ".json"
+    for name in [json_file, dep_file]:
+        with open(name, "w") as f:
+            f.write("not json")
+    mod = Module(rkt_file, [], {})
+    mod.inlined_from = [dep_file]
+    ast_file = _binary_ast_name(json_file)
+    JsonLoader().save_binary_ast(mod, ast_file)
+    mtime = os.stat(ast_file).st_mtime
+    os.utime(json_file, (mtime - 10,) * 2)
+    os.utime(dep_file, (mtime - 10,) * 2)
+    mod = JsonLoader().load_json_ast_cached(rkt_file, json_file)
+    assert mod.inlined_from == [dep_file]
+
+    # once the inlined module changes, the module is loaded from the JSON
+    os.utime(dep_file, (mtime + 10,) * 2)
+    with pytest.raises(ValueError):
+        JsonLoader().load_json_ast_cached(rkt_file, json_file)
+
+def test_image(tmpdir):
+    rkt_file = str(tmpdir.join("mod.rkt"))
+    json_file = rkt_file + ".json"
+    with open(rkt_file, "w") as f:
+        f.write(prog)
+    with open(json_file, "w") as f:
+        f.write(expand_string(format_pycket_mod(prog)))
+    loader = JsonLoader()
+    main = loader.load_json_ast_cached(rkt_file, json_file)
+    image_file = str(tmpdir.join("prog.image"))
+    loader.save_image(image_file, rkt_file, main)
+
+    loader = JsonLoader()
+    name, mod = loader.load_image(image_file)
+    assert name == rkt_file
+    assert loader.modtable.lookup(rkt_file) is mod
+    run_ast(mod)
+    assert lookup(mod, "x").value == 3628800
+    assert lookup(mod, "w").value == 3
+
+    # an image is stale once one of its sources changes
+    os.utime(rkt_file, (os.stat(image_file).st_mtime + 10,) * 2)
+    with pytest.raises(SchemeException):
+        JsonLoader().load_image(image_file)
+
+def test_base_bundle(tmpdir):
+    rkt_file = str(tmpdir.join("mod.rkt"))
+    json_file = rkt_file + ".json"
+    with open(rkt_file, "w") as f:
+        f.write(prog)
+    with open(json_file, "w") as f:
+        f.write(expand_string(format_pycket_mod(prog)))
+    loader = JsonLoader()
+    main = loader.load_json_ast_cached(rkt_file, json_file)
+    bundle_file = str(tmpdir.join("base.image"))
+    loader.save_image(bundle_file, str(tmpdir.join("stub.rkt")), main)
+    os.remove(json_file)
+
+    loader = JsonLoader()
+    assert not loader.load_base_bundle(str(tmpdir.join("missing.image")))
+    assert loader.load_base_bundle(bundle_file)
+    assert loader.modtable.lookup(rkt_file) is None
+    mod = loader.lazy_load(rkt_file)
+    assert loader.modtable.lookup(rkt_file) is mod
+    run_ast(mod)
+    assert lookup(mod, "x").value == 3628800
+
+    os.utime(rkt_file, (os.stat(bundle_file).st_mtime + 10,) * 2)
+    assert JsonLoader().load_base_bundle(bundle_file)
+    loader = JsonLoader()
+    loader.load_base_bundle(bundle_file)
+    assert loader.load_from_bundle(rkt_file) is None
@@ -477,6 +477,78 @@ def test_with_continuation_mark3():
     sym = W_Symbol.make("valid")
     assert m.defs[sym] is w_true
 
+def test_marks_skip_unmarked_frames():
+    from pycket.cont import NilCont, Prompt, call_cont
+    from pycket.prims.continuation_marks import get_marks_all
+    key, other = W_Symbol.make("key"), W_Symbol.make("other")
+    tag = W_ContinuationPromptTag(W_Symbol.make("tag"))
+    cont = NilCont()
+    cont.update_cm(key, W_Fixnum(0))
+    cont = Prompt(tag, None, None, cont)
+    marked = cont = call_cont(None, None, cont)
+    cont.update_cm(key, W_Fixnum(1))
+    cont.update_cm(other, W_Fixnum(2))
+    for i in range(100):
+        cont = call_cont(None, None, cont)
+    assert cont.next_marked() is marked
+    assert marked.next_marked() is marked.prev
+    assert cont.get_marks(key).tostring() == "(1 0)"
+    assert cont.get_marks(key, upto=[tag]).tostring() == "(1)"
+    assert cont.get_mark_first(other) is marked.find_cm(other)[0]
+    result = get_marks_all(cont, [other, key], w_false, upto=[tag])
+    assert result.tostring() == "(#(2 1))"
+
+def test_marks_of_reinstated_continuation():
+    from pycket.cont import NilCont, Prompt, call_cont
+    from pycket.prims.continuation_marks import get_marks_all
+    key = W_Symbol.make("key")
+    tag = W_ContinuationPromptTag(W_Symbol.make("tag"))
+    base = NilCont()
+    base.update_cm(key, W_Fixnum(1))
+    cont = call_cont(None, None, Prompt(tag, None, None, base))
+    cont = call_cont(None, None, cont)
+    tail = NilCont()
+    tail.update_cm(key, W_Fixnum(2))
+    cont = cont.append(tail, upto=tag)
+    assert cont.get_marks(key).tostring() == "(2)"
+    assert cont.get_mark_first(key).value == 2
+    assert get_marks_all(cont, [key], w_false).tostring() == "(#(2))"
+
+def test_marks_in_composable_continuation():
+    m = run_mod(
+    """
+    #lang pycket
+    (define tag (make-continuation-prompt-tag))
+    (define (marks) (continuation-mark-set->list (current-continuation-marks) 'x))
+    (define k
+      (with-continuation-mark 'x 'dead
+        (car (car (call-with-continuation-prompt
+               (lambda ()
+                 (list (with-continuation-mark 'x 'old
+                         (list ((call-with-composable-continuation (lambda (k) (lambda () k)) tag))))))
+               tag)))))
+    (define result
+      (with-continuation-mark 'x 'new (list (k marks))))
+    """)
+    sym = W_Symbol.make("result")
+    assert m.defs[sym].tostring() == "((((old new))))"
+
+def test_continuation_mark_set_first_of_other_continuation():
+    m = run_mod(
+    """
+    #lang pycket
+    (define (deep n) (if (= n 0) (current-continuation-marks) (with-continuation-mark 'x n (cons 1 (deep (- n 1))))))
+    (define (tail l) (if (pair? l) (tail (cdr l)) l))
+    (define marks (with-continuation-mark 'x 'outer (tail (deep 50))))
+    (define result
+      (list (continuation-mark-set-first marks 'x)
+            (length (continuation-mark-set->list marks 'x))
+            (continuation-mark-set-first #f 'x)
+            (with-continuation-mark 'x 'here (continuation-mark-set-first marks 'x))))
+    """)
+    sym = W_Symbol.make("result")
+    assert m.defs[sym].tostring() == "(1 51 #f 1)"
+
 def test_with_continuation_mark_impersonator():
     m = run_mod(
     """
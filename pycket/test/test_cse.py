@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the elimination of common subexpressions
+#
+from pycket.cse import CSEVisitor, Available, PURE, READS_MUTABLE, primitive_kind
+from pycket.interpreter import (App, DefineValues, Let, LexicalVar, Quote,
+                                make_let)
+from pycket.values import W_Symbol, W_Fixnum
+from pycket.test.testhelper import apps, prim, run_mod
+
+def app(name, *rands):
+    return App.make(prim(name), list(rands))
+
+def test_primitive_kind():
+    x = LexicalVar(W_Symbol.make("x"))
+    assert primitive_kind(app("car", x)) == PURE
+    assert primitive_kind(app("vector-length", x)) == PURE
+    assert primitive_kind(app("unsafe-vector*-ref", x, Quote(W_Fixnum(0)))) == READS_MUTABLE
+    assert not primitive_kind(app("vector-set!", x, Quote(W_Fixnum(0)), x))
+    assert not primitive_kind(app("cons", x, x))
+
+def test_repeated_operands_are_bound_once():
+    x = W_Symbol.make("x")
+    ast = app("+", app("car", LexicalVar(x)), app("car", LexicalVar(x)))
+    result = ast.visit(CSEVisitor(), Available())
+    assert isinstance(result, Let)
+    assert len(apps(result, "car")) == 1
+    add = result.body[0]
+    assert add.rands[0].sym is add.rands[1].sym is result.args.elems[0]
+
+def test_mutation_kills_reads():
+    v, a, b = W_Symbol.make("v"), W_Symbol.make("a"), W_Symbol.make("b")
+    zero = Quote(W_Fixnum(0))
+    read = lambda: app("unsafe-vector*-ref", LexicalVar(v), zero)
+    body = [app("vector-set!", LexicalVar(v), zero, zero),
+            app("list", LexicalVar(a), read())]
+    ast = make_let([[a]], [read()], body)
+    result = ast.visit(CSEVisitor(), Available())
+    assert len(apps(result, "unsafe-vector*-ref")) == 2
+    # without the mutation the read is shared
+    ast = make_let([[a]], [read()], [app("list", LexicalVar(b), read())])
+    result = ast.visit(CSEVisitor(), Available())
+    assert len(apps(result, "unsafe-vector*-ref")) == 1
+
+def test_common_subexpressions():
+    m = run_mod("""
+    #lang pycket
+    (define (last v) (if (zero? (vector-length v)) #f (vector-ref v (sub1 (vector-length v)))))
+    (define (sum p) (+ (car (car p)) (cdr (car p))))
+    (define (swap! v) (let ([a (unsafe-vector*-ref v 0)]) (vector-set! v 0 (unsafe-vector*-ref v 1)) (vector-set! v 1 a) (unsafe-vector*-ref v 0)))
+    (define r (list (last (vector 1 2 3)) (sum (cons (cons 1 2) 3)) (swap! (vector 1 2))))
+    """)
+    defs = {}
+    for form in m.body:
+        if isinstance(form, DefineValues):
+            defs[form.names[0].utf8value] = form.rhs
+    assert len(apps(defs["last"], "vector-length")) == 1
+    assert len(apps(defs["sum"], "car")) == 1
+    assert len(apps(defs["swap!"], "unsafe-vector*-ref")) == 3
+    r = m.defs[W_Symbol.make("r")]
+    assert r.tostring() == "(3 3 2)"
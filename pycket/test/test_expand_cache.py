@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the content-addressed expansion cache
+#
+import json
+import os
+import pytest
+from pycket import expand
+from pycket.expand_cache import ExpansionCache, Manifest
+
+FLAGS = "-l pycket/expand --"
+
+def fake_module(requires):
+    return json.dumps({"module-name": "m",
+                       "body-forms": [{"require": [[r] for r in requires]}]})
+
+@pytest.fixture
+def sources(tmpdir):
+    files = {}
+    src = tmpdir.mkdir("src")
+    for name in ["a", "b", "c"]:
+        files[name] = str(src.join(name + ".rkt"))
+        with open(files[name], "w") as f:
+            f.write("#lang racket/base\n(define %s 1)\n" % name)
+    return files
+
+def make_cache(tmpdir, max_size=1 << 30):
+    return ExpansionCache(str(tmpdir.join("cache")), max_size)
+
+def modify(fname, text):
+    with open(fname, "a") as f:
+        f.write(text)
+
+def test_manifest_roundtrip():
+    manifest = Manifest("/x/a.rkt", ["k1", "-"], ["/x/b.rkt", "/x/c d.rkt"])
+    parsed = Manifest.fromstring(manifest.tostring())
+    assert parsed.source == "/x/a.rkt"
+    assert parsed.dep_keys == ["k1", "-"]
+    assert parsed.dep_paths == ["/x/b.rkt", "/x/c d.rkt"]
+    assert Manifest.fromstring("truncated") is None
+
+def test_store_and_lookup(tmpdir, sources):
+    cache = make_cache(tmpdir)
+    a = sources["a"]
+    assert cache.lookup(a, FLAGS) is None
+    json_file = cache.store(a, FLAGS, fake_module([]))
+    assert json_file.startswith(cache.directory)
+    assert open(json_file).read() == fake_module([])
+    assert make_cache(tmpdir).lookup(a, FLAGS) == json_file
+    # the key depends on the flags and the contents, not the mtime
+    assert make_cache(tmpdir).lookup(a, "-l pycket/zo-expand --") is None
+    os.utime(a, None)
+    assert make_cache(tmpdir).lookup(a, FLAGS) == json_file
+    modify(a, "(define a2 2)\n")
+    assert make_cache(tmpdir).lookup(a, FLAGS) is None
+
+def test_changed_require_invalidates(tmpdir, sources):
+    # a -> b -> c
+    cache = make_cache(tmpdir)
+    cache.store(sources["a"], FLAGS, fake_module([sources["b"]]))
+    cache.store(sources["b"], FLAGS, fake_module([sources["c"]]))
+    cache.store(sources["c"], FLAGS, fake_module([]))
+    assert make_cache(tmpdir).lookup(sources["a"], FLAGS) is not None
+    modify(sources["c"], "(define c2 2)\n")
+    cache = make_cache(tmpdir)
+    assert cache.lookup(sources["b"], FLAGS) is None
+    assert cache.lookup(sources["a"], FLAGS) is None
+
+def test_replaced_entry_invalidates_dependents(tmpdir, sources):
+    cache = make_cache(tmpdir)
+    cache.store(sources["a"], FLAGS, fake_module([sources["b"]]))
+    cache.store(sources["b"], FLAGS, fake_module([sources["c"]]))
+    cache.store(sources["c"], FLAGS, fake_module([]))
+    # b is expanded again, e.g. because some other program found it stale
+    cache = make_cache(tmpdir)
+    cache.store(sources["b"], FLAGS, fake_module([sources["c"]]))
+    cache = make_cache(tmpdir)
+    assert cache.lookup(sources["a"], FLAGS) is None
+    assert cache.lookup(sources["b"], FLAGS) is not None
+    assert cache.lookup(sources["c"], FLAGS) is not None
+
+def test_eviction(tmpdir, sources):
+    cache = make_cache(tmpdir)
+    padding = " " * 1000
+    cache.store(sources["a"], FLAGS, fake_module([]) + padding)
+    cache.store(sources["b"], FLAGS, fake_module([]) + padding)
+    old = cache.json_file(cache.key(sources["a"], FLAGS))
+    os.utime(old, (0, 0))
+    cache.max_size = 2500
+    cache.store(sources["c"], FLAGS, fake_module([]) + padding)
+    cache = make_cache(tmpdir)
+    assert cache.lookup(sources["a"], FLAGS) is None
+    assert not os.path.exists(old)
+    assert cache.lookup(sources["b"], FLAGS) is not None
+    assert cache.lookup(sources["c"], FLAGS) is not None
+
+def test_expand_file_to_cache(tmpdir, sources, monkeypatch):
+    calls = []
+    def fake_expand(rkt_file, lib):
+        calls.append(rkt_file)
+        return fake_module([])
+    monkeypatch.setattr(expand, "expand_file_rpython", fake_expand)
+    src = os.path.dirname(sources["a"])
+    os.chmod(src, 0o555) # a read-only source tree
+    try:
+        json_file = expand.expand_file_to_cache(make_cache(tmpdir), sources["a"])
+        assert expand.expand_file_to_cache(make_cache(tmpdir), sources["a"]) == json_file
+    finally:
+        os.chmod(src, 0o755)
+    assert calls == [sources["a"]]
+
+def test_expand_file_to_cache_fallback(tmpdir, sources, monkeypatch):
+    calls = []
+    def fake_expand(rkt_file, lib):
+        calls.append(rkt_file)
+        return "not a module"
+    monkeypatch.setattr(expand, "expand_file_rpython", fake_expand)
+    # the cache cannot store an expansion it cannot read the requires of
+    fallback = sources["a"] + ".json"
+    json_file = expand.expand_file_to_cache(make_cache(tmpdir), sources["a"],
+                                            fallback=fallback)
+    assert json_file == fallback
+    assert open(fallback).read() == "not a module"
+    assert calls == [sources["a"]]
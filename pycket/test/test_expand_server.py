@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the client of the expansion server
+#
+import os
+import socket
+import threading
+import pytest
+from pycket.expand import ExpanderClient, ExpandException
+
+def serve_once(path, answer):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    requests = []
+    def run():
+        conn, _ = listener.accept()
+        data = ""
+        while not data.endswith("\n"):
+            data += conn.recv(1024)
+        requests.append(data)
+        conn.sendall(answer)
+        conn.close()
+        listener.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, requests
+
+def make_client(monkeypatch, path):
+    monkeypatch.setenv("PYCKET_EXPAND_SOCKET", path)
+    return ExpanderClient()
+
+def test_expand_ok(tmpdir, monkeypatch):
+    path = str(tmpdir.join("expand.sock"))
+    thread, requests = serve_once(path, "ok 12\n{\"json\": 42}")
+    client = make_client(monkeypatch, path)
+    assert client.expand("/some/file.rkt") == "{\"json\": 42}"
+    thread.join()
+    assert requests == ["expand - /some/file.rkt\n"]
+    assert client.available
+
+def test_expand_error(tmpdir, monkeypatch):
+    path = str(tmpdir.join("expand.sock"))
+    thread, requests = serve_once(path, "error 4\nboom")
+    client = make_client(monkeypatch, path)
+    with pytest.raises(ExpandException):
+        client.expand("/some/file.rkt")
+    thread.join()
+
+def test_expand_truncated(tmpdir, monkeypatch):
+    path = str(tmpdir.join("expand.sock"))
+    thread, requests = serve_once(path, "ok 100\n{}")
+    client = make_client(monkeypatch, path)
+    with pytest.raises(ExpandException):
+        client.expand("/some/file.rkt")
+    thread.join()
+
+def test_no_server(tmpdir, monkeypatch):
+    client = make_client(monkeypatch, str(tmpdir.join("missing.sock")))
+    assert client.expand("/some/file.rkt") is None
+    assert not client.available
+    # disabled by an empty socket path
+    client = make_client(monkeypatch, "")
+    assert client.expand("/some/file.rkt") is None
+
+def test_untrusted_socket(tmpdir, monkeypatch):
+    # a file planted at the socket path is not used
+    path = str(tmpdir.join("expand.sock"))
+    with open(path, "w") as f:
+        f.write("ok 2\n{}")
+    client = make_client(monkeypatch, path)
+    assert client.expand("/some/file.rkt") is None
+    assert not client.available
+    assert client.trusted_socket(str(tmpdir)) is False
+
+def test_default_socket_path(monkeypatch):
+    monkeypatch.delenv("PYCKET_EXPAND_SOCKET", raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/run/user/1000")
+    assert ExpanderClient().socket_path() == "/run/user/1000/pycket-expand.sock"
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    path = ExpanderClient().socket_path()
+    assert path == "/tmp/pycket-expand-%d/expand.sock" % os.getuid()
@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the inlining of small module-level procedures
+#
+from pycket.expand import ModTable
+from pycket.interpreter import (App, CaseLambda, DefineValues,
+                                LexicalVar, Module, Quote, make_lambda)
+from pycket.inline import InlineVisitor, RenameVisitor, INLINE_SIZE_LIMIT, ast_size
+from pycket.values import W_Symbol, W_Fixnum
+from pycket.test.testhelper import apps, run_mod
+
+def definitions(m):
+    defs = {}
+    for form in m.body:
+        if isinstance(form, DefineValues):
+            defs[form.names[0].utf8value] = form.rhs
+    return defs
+
+def test_inline_small_procedure():
+    m = run_mod("""
+    #lang pycket
+    (define (sq x) (* x x))
+    (define (sum-sq a b) (+ (sq a) (sq b)))
+    (define r (sum-sq 3 4))
+    """)
+    defs = definitions(m)
+    assert apps(defs["sum-sq"], "sq") == []
+    assert m.defs[W_Symbol.make("r")].value == 25
+
+def test_no_inline_of_mutated_or_recursive():
+    m = run_mod("""
+    #lang pycket
+    (define (f x) x)
+    (set! f (lambda (x) (+ x 1)))
+    (define (count n) (if (zero? n) 0 (count (sub1 n))))
+    (define (g y) (+ (f y) (count y)))
+    (define r (g 2))
+    """)
+    defs = definitions(m)
+    assert len(apps(defs["g"], "f")) == 1
+    assert len(apps(defs["count"], "count")) == 1
+    assert m.defs[W_Symbol.make("r")].value == 3
+
+def test_no_inline_of_large_procedure():
+    body = "(+ x %s)" % " ".join(["(* x %d)" % i for i in range(INLINE_SIZE_LIMIT)])
+    m = run_mod("""
+    #lang pycket
+    (define (big x) %s)
+    (define (h y) (big y))
+    """ % body)
+    assert len(apps(definitions(m)["h"], "big")) == 1
+
+def test_inlined_from():
+    dep = Module("/dep.rkt", [], {})
+    dep.inlined_from = ["/base.rkt", "/main.rkt"]
+    modtable = ModTable()
+    modtable.add_module("/dep.rkt", dep)
+    visitor = InlineVisitor(Module("/main.rkt", [], {}), "/main.rkt", modtable)
+    for name in ["/dep.rkt", "/main.rkt", None, "/dep.rkt", "/other.rkt"]:
+        visitor.record_inlined_from(name)
+    # the modules inlined into a module are inlined along with it
+    assert visitor.inlined_from == ["/dep.rkt", "/base.rkt", "/other.rkt"]
+
+def test_rename_body():
+    x = W_Symbol.make("x")
+    y = W_Symbol.make("y")
+    inner = make_lambda([y], None, [LexicalVar(x)])
+    lam = make_lambda([x], None, [CaseLambda([inner])])
+    copy = lam.visit(RenameVisitor(None, None), {})
+    new_inner = copy.body[0].lams[0]
+    assert copy.formals[0] is not x
+    assert new_inner.formals[0] is not y
+    assert new_inner.body[0].sym is copy.formals[0]
+    assert new_inner.sourceinfo is inner.sourceinfo
+
+def test_ast_size():
+    assert ast_size(Quote(W_Fixnum(1)), 10) == 1
+    app = App.make(Quote(W_Fixnum(0)), [Quote(W_Fixnum(i)) for i in range(20)])
+    assert ast_size(make_lambda([], None, [app]), 100) == 23
+    assert ast_size(make_lambda([], None, [app]), 5) == 6
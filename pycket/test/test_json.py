@@ -1,6 +1,7 @@
 
 import pytest
-from pycket.pycket_json import loads
+from pycket.pycket_json import loads, loads_pull, JsonPullParser
+from pycket.pycket_json import EV_START_OBJECT, EV_START_ARRAY, EV_INT, EV_STRING
 import json as pyjson
 
 def _compare(string, expected):
@@ -44,3 +45,43 @@ def test_bug():
             [{"quote" : { "string": "\\" }},{"quote" : { "string": "Hi" }}])
 
     _compare(r'{"string" : "\\\\"}', {"string": "\\\\"})
+
+def _compare_pull(string):
+    assert loads_pull(string)._unpack_deep() == loads(string)._unpack_deep()
+
+def test_pull_matches_loads():
+    _compare_pull("1")
+    _compare_pull("-12")
+    _compare_pull("1.5e3")
+    _compare_pull("[]")
+    _compare_pull("{}")
+    _compare_pull(" [1, [2, {\"a\": [true, false, null]}], \"s\"] ")
+    _compare_pull("{\"a\": 1, \"123\": \"ab\", \"subobj\": {\"d\": 12.0}, \"subarr\": [1]}")
+    _compare_pull('"\\n\\t\\b\\f\\r\\\\\\"\\/"')
+    _compare_pull(r'[{ "quote": { "string": "\\" } },{ "quote": { "string": "Hi" } }]')
+
+def test_pull_unicode_escapes():
+    assert loads_pull('"\\u00e9"').value_string() == u"\xe9".encode("utf-8")
+    assert loads_pull('"\\ud83d\\ude00"').value_string() == "\xf0\x9f\x98\x80"
+
+def test_pull_errors():
+    for bad in ['[1,', '[1 2]', '{"a" 1}', '{1: 2}', '"abc', '1 2', 'tru', '', '[1,]', '{"a": 1,}']:
+        with pytest.raises(ValueError):
+            loads_pull(bad)
+
+def test_pull_events():
+    p = JsonPullParser('{"a": [1, {"b": [2, 3]}, 4], "c": "d"}')
+    p.expect(EV_START_OBJECT)
+    assert p.next_key() and p.string_value == "a"
+    p.expect(EV_START_ARRAY)
+    assert p.next_element()
+    assert p.next_event() == EV_INT and p.int_value == 1
+    assert p.next_element()
+    p.skip_value()
+    assert p.next_element()
+    assert p.read_value().value_int() == 4
+    assert not p.next_element()
+    assert p.next_key() and p.string_value == "c"
+    assert p.next_event() == EV_STRING and p.string_value == "d"
+    assert not p.next_key()
+    p.finish()
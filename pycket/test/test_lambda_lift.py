@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the lifting of local procedures to module level
+#
+from pycket.interpreter import (App, CaseLambda, DefineValues, Lambda,
+                                LexicalVar, Quote, make_lambda,
+                                make_let)
+from pycket.lambda_lift import LiftVisitor, only_called
+from pycket.values import W_Symbol, W_Fixnum
+from pycket.test.testhelper import prim, run_mod
+
+def adder(x, y):
+    add = App.make(prim("+"), [LexicalVar(x), LexicalVar(y)])
+    return CaseLambda([make_lambda([y], None, [add])])
+
+def test_lift_local_procedure():
+    x, y, f = W_Symbol.make("x"), W_Symbol.make("y"), W_Symbol.make("f")
+    call = App.make(LexicalVar(f), [Quote(W_Fixnum(1))])
+    lam = CaseLambda([make_lambda([x], None,
+                                  [make_let([[f]], [adder(x, y)], [call])])])
+    visitor = LiftVisitor()
+    new_lam = lam.visit(visitor, {})
+    assert len(visitor.lifted) == 1
+    define = visitor.lifted[0]
+    assert define.rhs.lams[0].formals == [x, y]
+    body = new_lam.lams[0].body[0]
+    assert isinstance(body, App)
+    assert body.rator.srcsym is define.names[0]
+    assert body.rands[0].sym is x
+
+def test_no_lift_of_escaping_procedure():
+    x, y, f = W_Symbol.make("x"), W_Symbol.make("y"), W_Symbol.make("f")
+    lam = CaseLambda([make_lambda([x], None,
+                                  [make_let([[f]], [adder(x, y)], [LexicalVar(f)])])])
+    visitor = LiftVisitor()
+    lam.visit(visitor, {})
+    assert visitor.lifted == []
+    call = App.make(LexicalVar(f), [])
+    assert not only_called([call], f, adder(x, y))
+
+def test_lambda_lifting():
+    m = run_mod("""
+    #lang pycket
+    (define (a x) (let ([f (lambda (y) (+ x y))]) (list (f 1) (f 2))))
+    (define (b n)
+      (letrec ([ev? (lambda (k) (if (= k 0) #t (od? (- k 1))))]
+               [od? (lambda (k) (if (= k 0) #f (ev? (- k 1))))])
+        (list (ev? n) (od? n))))
+    (define (c x) (let ([f (lambda (y) (+ x y))]) (map f (list 1 2))))
+    (define (d x) (let ([f (lambda (y) (set! x y) x)]) (f 3)))
+    (define r (list (a 10) (b 5) (c 10) (d 1)))
+    """)
+    lifted = 0
+    for form in m.body:
+        if isinstance(form, DefineValues) and form.names[0].unreadable:
+            lifted += 1
+    assert lifted == 3
+    r = m.defs[W_Symbol.make("r")]
+    assert r.tostring() == "((11 12) (#f #t) (11 12) 3)"
@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the recognition of named let loops
+#
+from pycket.interpreter import (App, CaseLambda, CellRef, DefineValues, If,
+                                LexicalVar, Loop, Quote, Recur, make_lambda)
+from pycket.loops import make_loop
+from pycket.values import W_Symbol, W_Fixnum
+from pycket.test.testhelper import nodes, prim, run_mod
+
+def countdown(call):
+    i = W_Symbol.make("i")
+    lp = W_Symbol.make("lp")
+    tst = App.make(prim("zero?"), [LexicalVar(i)])
+    rec = App.make(LexicalVar(lp), [App.make(prim("sub1"), [LexicalVar(i)])])
+    body = If(tst, LexicalVar(i), call(rec))
+    return CaseLambda([make_lambda([i], None, [body])], recursive_sym=lp)
+
+def test_make_loop():
+    loop = make_loop(countdown(lambda rec: rec), [Quote(W_Fixnum(3))])
+    assert isinstance(loop, Loop)
+    assert len(nodes(loop, Recur)) == 1
+    assert loop.rator.lams[0].body[0].should_enter
+
+def test_no_loop_for_non_tail_call():
+    add1 = lambda rec: App.make(prim("add1"), [rec])
+    assert make_loop(countdown(add1), [Quote(W_Fixnum(3))]) is None
+    # wrong number of arguments
+    assert make_loop(countdown(lambda rec: rec), []) is None
+
+def test_named_let_loops():
+    m = run_mod("""
+    #lang pycket
+    (define (pairs n)
+      (let outer ([i 0] [acc '()])
+        (if (= i n)
+            acc
+            (let inner ([j 0] [acc acc])
+              (if (= j i)
+                  (outer (add1 i) acc)
+                  (inner (add1 j) (cons (cons i j) acc)))))))
+    (define (thunks n)
+      (let lp ([i 0] [fs '()])
+        (if (= i n) (map (lambda (f) (f)) fs) (lp (add1 i) (cons (lambda () i) fs)))))
+    (define (fib n) (let f ([n n]) (if (< n 2) n (+ (f (- n 1)) (f (- n 2))))))
+    (define (odds n)
+      (let ([c 0])
+        (let lp ([i 0])
+          (when (< i n)
+            (when (odd? i) (set! c (add1 c)))
+            (lp (add1 i))))
+        c))
+    (define r (list (pairs 3) (thunks 3) (fib 10) (odds 7)))
+    """)
+    defs = {}
+    for form in m.body:
+        if isinstance(form, DefineValues):
+            defs[form.names[0].utf8value] = form.rhs
+    assert len(nodes(defs["pairs"], Loop)) == 2
+    assert len(nodes(defs["pairs"], Recur)) == 2
+    assert len(nodes(defs["thunks"], Loop)) == 1
+    assert nodes(defs["fib"], Loop) == []
+    # not in tail position, with the counter passed along by the loop
+    assert len(nodes(defs["odds"], Loop)) == 1
+    assert nodes(defs["odds"], CellRef) == []
+    r = m.defs[W_Symbol.make("r")]
+    assert r.tostring() == "(((2 . 1) (2 . 0) (1 . 0)) (2 1 0) 55 3)"
@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the specialization of arithmetic on inferred numeric types
+#
+from pycket.interpreter import (App, DefineValues, LexicalVar, Quote,
+                                SimplePrimApp2)
+from pycket.numeric_types import (FIXNUM, FLONUM, INTEGER, UNKNOWN,
+                                  FIXNUM_OPS, FLONUM_OPS, RESULT_TYPES,
+                                  specialize_app, type_of)
+from pycket.prims.expose import prim_env
+from pycket.values import W_Symbol, W_Fixnum, W_Flonum
+from pycket.test.testhelper import apps, prim, run_mod
+
+def test_primitives_exist():
+    names = RESULT_TYPES.keys() + FLONUM_OPS.values() + FIXNUM_OPS.values()
+    for name in names:
+        assert W_Symbol.make(name) in prim_env, name
+
+def test_type_of():
+    x = W_Symbol.make("x")
+    types = {x: FIXNUM}
+    assert type_of(Quote(W_Flonum(1.5)), {}) == FLONUM
+    assert type_of(Quote(W_Fixnum(1)), {}) == FIXNUM
+    assert type_of(LexicalVar(x), types) == FIXNUM
+    assert type_of(LexicalVar(x), {}) == UNKNOWN
+    add = App.make(prim("+"), [LexicalVar(x), Quote(W_Fixnum(1))])
+    assert type_of(add, types) == INTEGER
+    assert type_of(App.make(prim("exact->inexact"), [add]), types) == FLONUM
+    assert type_of(App.make(prim("exact->inexact"), [add]), {}) == UNKNOWN
+
+def test_specialize_app():
+    x = W_Symbol.make("x")
+    rands = [LexicalVar(x), Quote(W_Flonum(2.0))]
+    rator = specialize_app(prim("*"), rands, {x: FLONUM})
+    assert rator.srcsym is W_Symbol.make("unsafe-fl*")
+    assert isinstance(App.make(rator, rands), SimplePrimApp2)
+    rator = specialize_app(prim("<"), [LexicalVar(x), Quote(W_Fixnum(2))],
+                           {x: FIXNUM})
+    assert rator.srcsym is W_Symbol.make("unsafe-fx<")
+    # mixed and unknown operands keep the generic operation
+    assert specialize_app(prim("*"), rands, {x: FIXNUM}) is None
+    assert specialize_app(prim("*"), rands, {}) is None
+    assert specialize_app(prim("*"), rands, {x: INTEGER}) is None
+
+def test_specialized_arithmetic():
+    m = run_mod("""
+    #lang pycket
+    (define (dot n)
+      (let lp ([i 0] [acc 0.0])
+        (if (= i n)
+            acc
+            (let ([x (exact->inexact i)]) (lp (+ i 1) (+ acc (* x x)))))))
+    (define (sq y) (if (flonum? y) (* y y) y))
+    (define (mixed n)
+      (let lp ([i 0] [acc 0]) (if (= i n) acc (lp (+ i 1) (+ acc 0.5)))))
+    (define r (list (dot 4) (sq 3.0) (sq 3) (mixed 3)))
+    """)
+    defs = {}
+    for form in m.body:
+        if isinstance(form, DefineValues):
+            defs[form.names[0].utf8value] = form.rhs
+    assert len(apps(defs["dot"], "unsafe-fl+")) == 1
+    assert len(apps(defs["dot"], "unsafe-fl*")) == 1
+    assert len(apps(defs["sq"], "unsafe-fl*")) == 1
+    assert apps(defs["mixed"], "unsafe-fl+") == []
+    r = m.defs[W_Symbol.make("r")]
+    assert r.tostring() == "(14.0 9.0 3 1.5)"
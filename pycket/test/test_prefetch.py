@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the parallel expansion of required modules
+#
+import json
+import os
+import pytest
+from pycket import prefetch, expand_cache
+from pycket.prefetch import module_requires, Prefetcher
+
+def fake_module(requires, lang=None, submodules=[]):
+    mod = {"module-name": "m",
+           "body-forms": [{"require": [[r] for r in requires]},
+                          {"module": submodules}]}
+    if lang is not None:
+        mod["language"] = [lang]
+    return mod
+
+def test_module_requires(tmpdir):
+    a = str(tmpdir.join("a.rkt"))
+    b = str(tmpdir.join("b.rkt"))
+    c = str(tmpdir.join("c.rkt"))
+    data = json.dumps(fake_module([a, "#%kernel", "."], lang=b,
+                                  submodules=[fake_module([c, a, ".."])]))
+    assert sorted(module_requires(data)) == sorted([a, b, c])
+    assert module_requires(json.dumps(fake_module([]))) == []
+
+@pytest.fixture
+def no_expansion_cache(monkeypatch):
+    monkeypatch.setenv("PYCKET_CACHE_DIR", "")
+    monkeypatch.setattr(expand_cache, "_holder", expand_cache.CacheHolder())
+
+def test_prefetch(tmpdir, monkeypatch, no_expansion_cache):
+    # main -> {a, d}, a -> {b, c}, d -> a; c fails to expand
+    files = dict((name, str(tmpdir.join(name + ".rkt")))
+                 for name in ["main", "a", "b", "c", "d"])
+    deps = {"a": ["b", "c"], "b": [], "d": []}
+    for name, rkt_file in files.items():
+        with open(rkt_file, "w") as f:
+            f.write("#lang racket/base\n")
+
+    def fake_expand(rkt_file, json_file):
+        name = os.path.basename(rkt_file)[:-len(".rkt")]
+        if name not in deps:
+            with open(json_file, "w") as f:
+                f.write("{\"trunc")
+            raise ValueError("expansion failed")
+        with open(json_file, "w") as f:
+            json.dump(fake_module([files[d] for d in deps[name]]), f)
+        return json_file
+    monkeypatch.setattr(prefetch, "_expand_module",
+                        lambda rkt_file, flag: fake_expand(rkt_file, rkt_file + ".json"))
+
+    main_json = files["main"] + ".json"
+    # an up to date module is not expanded again, but its requires are
+    with open(files["d"] + ".json", "w") as f:
+        json.dump(fake_module([files["a"]]), f)
+    with open(main_json, "w") as f:
+        json.dump(fake_module([files["a"], files["d"]]), f)
+    os.utime(files["d"], (0, 0))
+
+    prefetcher = Prefetcher(2)
+    prefetcher.prefetch(main_json)
+    assert os.path.exists(files["a"] + ".json")
+    assert os.path.exists(files["b"] + ".json")
+    assert not os.path.exists(files["c"] + ".json")
+    assert json.load(open(files["d"] + ".json")) == fake_module([files["a"]])
+    assert sorted(prefetcher.seen) == sorted(files[n] for n in "abcd")
+    assert not prefetcher.running
@@ -8,6 +8,7 @@ import pytest
 import os
 import sys
 from pycket        import values
+from pycket.error  import SchemeException
 from pycket.values import w_true
 from pycket.test.testhelper import check_all, check_none, check_equal, run_flo, run_fix, run, run_mod, run_mod_expr
 
@@ -793,6 +794,139 @@ def test_dynamic_wind3():
     val = m.defs[values.W_Symbol.make("val")]
     assert val is values.W_Symbol.make("cancel-canceled")
 
+def test_find_escape():
+    from pycket.cont import NilCont, call_cont
+    from pycket.prims.control import DynamicWindValueCont, find_escape
+    target = call_cont(None, None, NilCont())
+    cont = target
+    for i in range(10):
+        cont = call_cont(None, None, cont)
+    assert find_escape(cont, None, target) == (True, False)
+    assert find_escape(cont, None, target, escape=True) == (True, False)
+    wind = DynamicWindValueCont(None, None, None, cont)
+    assert find_escape(call_cont(None, None, wind), None, target) == (True, True)
+    assert find_escape(target, None, cont) == (False, False)
+
+def test_escapes():
+    m = run_mod(
+    """
+    #lang pycket
+    (define l null)
+    (define (add x) (set! l (cons x l)))
+    (define (find-first p v)
+      (let/ec k
+        (for-each (lambda (x) (when (p x) (k x))) v)
+        #f))
+    (define (deep n k) (if (= n 0) (k 'out) (+ 1 (deep (- n 1) k))))
+    (define val
+      (list (find-first even? '(1 3 4 5 6))
+            (find-first even? '(1 3))
+            (call/cc (lambda (k) (deep 1000 k)))
+            (let/ec k (dynamic-wind (lambda () (add 'in)) (lambda () (deep 10 k)) (lambda () (add 'post))))
+            (reverse l)))
+    """)
+    val = m.defs[values.W_Symbol.make("val")]
+    assert val.tostring() == "(4 #f out out (in post))"
+
+def test_coroutine_base_marks():
+    from pycket.cont import NilCont, call_cont
+    key = values.W_Symbol.make("key")
+    co = values.W_Coroutine(None)
+    cont = call_cont(None, None, co.base)
+    for val in [1, 2]:
+        resumer = NilCont()
+        resumer.update_cm(key, values.W_Fixnum(val))
+        co.resumer = resumer
+        co.base.relink(resumer)
+        assert cont.get_mark_first(key).value == val
+        assert cont.get_marks(key).tostring() == "(%s)" % val
+    assert co.base.clone() is co.base
+
+def test_coroutine_base_resumer():
+    from pycket.cont import NilCont, Prompt, call_cont
+    key = values.W_Symbol.make("key")
+    tag = values.W_ContinuationPromptTag(values.W_Symbol.make("tag"))
+    co = values.W_Coroutine(None)
+    root = NilCont()
+    root.update_cm(key, values.W_Fixnum(1))
+    co.resumer = call_cont(None, None, Prompt(tag, None, None, root))
+    co.base.relink(co.resumer)
+    cont = call_cont(None, None, co.base)
+    cont.update_cm(key, values.W_Fixnum(2))
+    assert cont.get_marks(key).tostring() == "(2 1)"
+    # cloning the base leaves the marks of the current resume alone
+    marks = co.base.marks
+    assert co.base.clone() is co.base
+    assert co.base.marks is marks
+    # a copy of the frames continues with a copy of the resumer side
+    tail = NilCont()
+    tail.update_cm(key, values.W_Fixnum(3))
+    copy = cont.append(tail, upto=tag)
+    assert copy.prev is not co.base
+    assert copy.prev.prev is tail
+    assert copy.get_marks(key).tostring() == "(2 3)"
+
+def test_coroutine_left_for_good():
+    m = run_mod(
+    """
+    #lang pycket
+    (define (stuck) (letrec ([co (make-coroutine (lambda (leave) (leave) (coroutine-yield co 1)))]) co))
+    (define tag (make-continuation-prompt-tag))
+    (define escaped (stuck))
+    (define aborted (stuck))
+    (define raised (stuck))
+    (define val
+      (list (let/ec k (coroutine-resume escaped (lambda () (k 'escaped))))
+            (call-with-continuation-prompt
+              (lambda () (coroutine-resume aborted (lambda () (abort-current-continuation tag 'aborted))))
+              tag
+              (lambda (v) v))
+            (with-handlers ([symbol? (lambda (e) e)])
+              (coroutine-resume raised (lambda () (raise 'raised))))
+            (coroutine-state escaped)
+            (coroutine-state aborted)
+            (coroutine-state raised)))
+    """)
+    val = m.defs[values.W_Symbol.make("val")]
+    assert val.tostring() == "(escaped aborted raised done done done)"
+
+def test_coroutines():
+    m = run_mod(
+    """
+    #lang pycket
+    (define (list->coroutine l)
+      (letrec ([co (make-coroutine
+                     (lambda () (for-each (lambda (x) (coroutine-yield co x)) l) 'end))])
+        co))
+    (define g (list->coroutine '(1 2)))
+    (define s0 (coroutine-state g))
+    (define a (coroutine-resume g))
+    (define s1 (coroutine-state g))
+    (define b (coroutine-resume g))
+    (define c (coroutine-resume g))
+    (define echo
+      (letrec ([co (make-coroutine
+                     (lambda (x) (let loop ([x x]) (loop (coroutine-yield co (* x 2))))))])
+        co))
+    (define p (make-parameter 0))
+    (define pc (letrec ([co (make-coroutine (lambda () (coroutine-yield co (p)) (p)))]) co))
+    (define val
+      (list s0 a s1 b c (coroutine-state g) (coroutine? g)
+            (coroutine-resume echo 1) (coroutine-resume echo 5)
+            (parameterize ([p 1]) (coroutine-resume pc))
+            (parameterize ([p 2]) (coroutine-resume pc))))
+    """)
+    val = m.defs[values.W_Symbol.make("val")]
+    assert val.tostring() == "(fresh 1 suspended 2 end done #t 2 10 1 2)"
+    with pytest.raises(SchemeException):
+        run_mod(
+        """
+        #lang pycket
+        (define co (make-coroutine (lambda () 1)))
+        (coroutine-resume co)
+        (coroutine-resume co)
+        """)
+
 def test_dynamic_wind4():
     m = run_mod(
     """
@@ -822,6 +956,40 @@ def test_dynamic_wind4():
     equal = m.defs[values.W_Symbol.make("equal")]
     assert equal is values.w_true
 
+def test_parameterization_cache():
+    from pycket.cont import NilCont
+    from pycket.values_parameter import (W_Parameter, current_parameterization,
+                                         param_set_cont, paramz_cache,
+                                         top_level_config)
+    x = W_Parameter(values.W_Fixnum(0))
+    root = NilCont()
+    root.update_cm(values.parameterization_key, top_level_config)
+    cont = param_set_cont(None, None, param_set_cont(None, None, root))
+    assert current_parameterization(cont) is top_level_config
+    assert paramz_cache.cont is cont
+    # installing a parameterization empties the cache
+    paramz = top_level_config.extend([x], [values.W_Fixnum(1)])
+    cont.update_cm(values.parameterization_key, paramz)
+    assert paramz_cache.cont is None
+    assert current_parameterization(cont) is paramz
+    assert x.get(cont).value == 1
+    assert x.get(root).value == 0
+    assert current_parameterization(param_set_cont(None, None, cont)) is paramz
+
+def test_parameterize_in_loop():
+    m = run_mod(
+    """
+    #lang pycket
+    (define p (make-parameter 0))
+    (define (sum n acc) (if (= n 0) acc (sum (- n 1) (+ acc (p)))))
+    (define val
+      (list (sum 3 0)
+            (parameterize ([p 2]) (list (sum 3 0) (parameterize ([p 5]) (sum 3 0)) (sum 3 0)))
+            (sum 3 0)))
+    """)
+    val = m.defs[values.W_Symbol.make("val")]
+    assert val.tostring() == "(0 (6 15 6) 0)"
+
 def test_bytes_conversions():
     m = run_mod(
     """
@@ -1039,6 +1207,91 @@ def test_raise_exception(doctest):
     13
     """
 
+def test_find_exception_handler():
+    from pycket.cont import Barrier, NilCont, call_cont
+    from pycket.prims.control import find_exception_handler, handler_cache
+    h1, h2 = values.W_Fixnum(1), values.W_Fixnum(2)
+    root = NilCont()
+    root.update_cm(values.exn_handler_key, h1)
+    frame = call_cont(None, None, root)
+    cont = frame
+    for i in range(50):
+        cont = call_cont(None, None, cont)
+    assert find_exception_handler(cont) == (h1, root)
+    assert handler_cache.frame is root
+    # installing a handler in another frame leaves the cache alone
+    frame.update_cm(values.exn_handler_key, h2)
+    assert handler_cache.frame is root
+    inner = call_cont(None, None, frame)
+    assert find_exception_handler(inner) == (h2, frame)
+    assert find_exception_handler(call_cont(None, None, inner)) == (h2, frame)
+    # changing the handler of the cached frame empties the cache
+    frame.update_cm(values.exn_handler_key, h1)
+    assert handler_cache.frame is None
+    assert find_exception_handler(inner) == (h1, frame)
+    # handlers are not found beyond a barrier
+    barrier = Barrier(None, root)
+    assert find_exception_handler(call_cont(None, None, barrier)) == (None, None)
+
+def test_exception_handler_cache_in_loop():
+    from pycket.cont import NilCont, call_cont
+    from pycket.prims.control import find_exception_handler, handler_cache
+    h1, h2 = values.W_Fixnum(1), values.W_Fixnum(2)
+    root = NilCont()
+    root.update_cm(values.exn_handler_key, h1)
+    outer = call_cont(None, None, root)
+    outer.update_cm(values.W_Symbol.make("key"), values.w_true)
+    assert find_exception_handler(call_cont(None, None, outer)) == (h1, root)
+    def find_cm(key):
+        assert False, "the cached handler frame is visited again"
+    root.find_cm = find_cm
+    for i in range(10):
+        # like with-handlers, each iteration installs a handler in a copy
+        # of the frame it is entered from
+        body = call_cont(None, None, outer).clone()
+        body.update_cm(values.exn_handler_key, h2)
+        raising = call_cont(None, None, call_cont(None, None, outer))
+        assert find_exception_handler(raising) == (h1, root)
+        assert handler_cache.frame is root
+    del root.find_cm
+    handler_cache.clear()
+
+def test_exception_handler_of_reinstated_continuation():
+    from pycket.cont import NilCont, Prompt, call_cont
+    from pycket.prims.control import find_exception_handler
+    h1, h2 = values.W_Fixnum(1), values.W_Fixnum(2)
+    tag = values.W_ContinuationPromptTag(values.W_Symbol.make("tag"))
+    base = NilCont()
+    base.update_cm(values.exn_handler_key, h1)
+    frame = call_cont(None, None, Prompt(tag, None, None, base))
+    frame.update_cm(values.W_Symbol.make("key"), values.w_true)
+    cont = call_cont(None, None, frame)
+    assert find_exception_handler(cont) == (h1, base)
+    tail = NilCont()
+    tail.update_cm(values.exn_handler_key, h2)
+    cont = cont.append(tail, upto=tag)
+    assert find_exception_handler(cont) == (h2, tail)
+
+def test_raise_under_same_handler(doctest):
+    u"""
+    ! (require racket/base)
+    ! (define (parse l) (map (lambda (s) (with-handlers ([exn:fail? (lambda (e) #f)]) (string->symbol s))) l))
+    > (parse (list "a" 1 "b" 2))
+    '(a #f b #f)
+    > (with-handlers ([number? (lambda (n) n)]) (let loop ([i 0]) (if (= i 100) (raise i) (loop (add1 i)))))
+    100
+    """
+
+def test_raise_in_composable_continuation(doctest):
+    u"""
+    ! (require racket/base)
+    ! (define tag (make-continuation-prompt-tag))
+    ! (define (capture) (list (with-continuation-mark 'x 1 (list ((call-with-composable-continuation (lambda (k) (lambda () k)) tag))))))
+    ! (define k (with-handlers ([symbol? (lambda (e) 'old)]) (car (car (call-with-continuation-prompt capture tag)))))
+    > (with-handlers ([symbol? (lambda (e) 'new)]) (k (lambda () (raise 'boom))))
+    'new
+    """
+
 def test_ctype_basetype(doctest):
     u"""
     ! (require '#%foreign)
@@ -1426,3 +1679,20 @@ def test_procedure_specialize(doctest):
     > ((procedure-specialize f) 1)
     6
     """
+
+def test_fixed_arity_primitive_entry():
+    from pycket.prims.expose import _make_arg_unwrapper, prim_env
+    def f(a, b, env, cont):
+        return a.value - b.value, env, cont
+    _, _, _, _, _, fixed = _make_arg_unwrapper(
+        f, [values.W_Fixnum, values.W_Fixnum], "f", fixed=True)
+    one, two = values.W_Fixnum(1), values.W_Fixnum(2)
+    assert fixed(2, two, one, None, None, "env", "cont") == (1, "env", "cont")
+    with pytest.raises(SchemeException):
+        fixed(1, two, None, None, None, "env", "cont")
+    with pytest.raises(SchemeException):
+        fixed(2, two, w_true, None, None, "env", "cont")
+    # non-simple primitives with a fixed number of arguments get the entry
+    w_prim = prim_env[values.W_Symbol.make("call-with-values")]
+    assert w_prim.fixed is not None
+    assert prim_env[values.W_Symbol.make("+")].fixed is None
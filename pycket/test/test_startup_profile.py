@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the startup profiler
+#
+import json
+import time
+from pycket import startup_profile
+from pycket.startup_profile import StartupProfiler, json_string
+
+def sleep_in(profiler, phase, module, seconds):
+    profiler.start(phase, module)
+    time.sleep(seconds)
+
+def test_nested_phases():
+    profiler = StartupProfiler()
+    profiler.enable()
+    sleep_in(profiler, "instantiate", "main", 0.01)
+    sleep_in(profiler, "expand", "lib", 0.05)
+    profiler.stop()
+    sleep_in(profiler, "instantiate", "lib", 0.02)
+    profiler.stop()
+    profiler.stop()
+    records = profiler.module_records()
+    assert [(r.phase, r.module) for r in records] == [
+        ("expand", "lib"), ("instantiate", "lib"), ("instantiate", "main")]
+    main = records[2]
+    assert main.total_time >= 0.08
+    assert 0.01 <= main.self_time < main.total_time - 0.06
+    phases = profiler.phase_totals()
+    assert [p.phase for p in phases] == ["expand", "instantiate"]
+    assert phases[1].count == 2
+
+def test_report_and_json():
+    profiler = StartupProfiler()
+    profiler.enable()
+    sleep_in(profiler, "read file", "/some/\"odd\"\tmodule.rkt", 0.001)
+    profiler.stop()
+    report = profiler.report()
+    assert "read file" in report
+    data = json.loads(profiler.to_json())
+    assert data["phases"][0]["phase"] == "read file"
+    assert data["modules"][0]["module"] == "/some/\"odd\"\tmodule.rkt"
+    assert float(data["modules"][0]["self_ms"]) >= 1.0
+
+def test_disabled_by_default():
+    assert not startup_profile.profiler.enabled
+    startup_profile.start(startup_profile.PHASE_EXPAND, "x")
+    startup_profile.stop()
+    assert startup_profile.profiler.order == []
+    assert json.loads(json_string("a\\b\n")) == "a\\b\n"
@@ -0,0 +1,43 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the fused if and let nodes
+#
+from pycket.env import SymList
+from pycket.interpreter import (App, If, IfPrimTest1, IfPrimTest2, Let,
+                                LetPrim1, LetPrim2, LexicalVar, Quote)
+from pycket.values import W_Symbol, W_Fixnum
+from pycket.test.testhelper import prim, run_mod
+
+def test_if_prim_test():
+    x = LexicalVar(W_Symbol.make("x"))
+    one, two = Quote(W_Fixnum(1)), Quote(W_Fixnum(2))
+    tst = App.make(prim("pair?"), [x])
+    assert isinstance(If.make(tst, one, two), IfPrimTest1)
+    tst = App.make(prim("eq?"), [x, one])
+    assert isinstance(If.make(tst, one, two), IfPrimTest2)
+    assert type(If.make(x, one, two)) is If
+
+def test_let_prim():
+    x, y = W_Symbol.make("x"), W_Symbol.make("y")
+    car = App.make(prim("car"), [LexicalVar(x)])
+    cdr = App.make(prim("cdr"), [LexicalVar(x)])
+    body = [If.make(LexicalVar(y), Quote(W_Fixnum(1)), LexicalVar(y))]
+    let = Let.make(SymList([y]), [1], [car], body)
+    assert isinstance(let, LetPrim1)
+    assert let.test_if is body[0]
+    let = Let.make(SymList([x, y]), [1, 1], [car, cdr], body)
+    assert isinstance(let, LetPrim2)
+    call = App.make(LexicalVar(x), [])
+    assert type(Let.make(SymList([y]), [1], [call], body)) is Let
+
+def test_superinstructions():
+    m = run_mod("""
+    #lang pycket
+    (define (f x) (if (pair? x) (car x) 0))
+    (define (g x) (let ([a (car x)] [b (cdr x)]) (if (eq? a b) a (list a b))))
+    (define (h v i) (if (fx< i (vector-length v)) (vector-ref v i) #f))
+    (define r (list (f (cons 1 2)) (f 1) (g (cons 3 3)) (g (cons 3 4)) (h (vector 5) 0) (h (vector) 0)))
+    """)
+    r = m.defs[W_Symbol.make("r")]
+    assert r.tostring() == "(1 0 3 (3 4) 5 #f)"
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the removal of unused module-level definitions
+#
+import pytest
+from pycket import values
+from pycket.expand import JsonLoader
+from pycket.interpreter import (interpret_module, ToplevelEnv, DefineValues,
+                                App, LexicalVar, ModuleVar, Quote)
+from pycket.tree_shake import shake_program, is_pure_definition
+from pycket.test.testhelper import format_pycket_mod, prim
+
+lib = """
+(provide used run)
+(define (helper x) (* x 2))
+(define (used x) (helper x))
+(define (unused) (helper 1))
+(define unused-list (list 1 2 unused))
+(define counter 0)
+(define (count!) (set! counter (add1 counter)) counter)
+(define effect (count!))
+(struct point (x y))
+(define-values (prop:counted counted? counted-ref)
+  (make-struct-type-property 'counted (lambda (v info) (count!) v)))
+(struct counted-point (x) #:property prop:counted 1)
+(define (run) counter)
+"""
+
+main = """
+(require "lib.rkt")
+(define x (used 21))
+(define y (run))
+"""
+
+def unused_names(module):
+    names = []
+    for define in module.unused_defs:
+        assert isinstance(define, DefineValues)
+        names.extend([name.utf8value for name in define.names])
+    return sorted(names)
+
+def test_tree_shake(tmpdir):
+    lib_file = str(tmpdir.join("lib.rkt"))
+    main_file = str(tmpdir.join("main.rkt"))
+    with open(lib_file, "w") as f:
+        f.write(format_pycket_mod(lib))
+    with open(main_file, "w") as f:
+        f.write(format_pycket_mod(main))
+    loader = JsonLoader()
+    ast = loader.expand_to_ast(main_file)
+    assert shake_program(ast, loader) > 0
+    lib_module = loader.modtable.lookup(lib_file)
+    names = unused_names(lib_module)
+    assert "unused" in names
+    assert "unused-list" in names
+    for name in ["helper", "used", "counter", "count!", "effect", "run",
+                 "counted-point"]:
+        assert name not in names
+    # the main module keeps all its definitions
+    assert unused_names(ast) == []
+
+    env = ToplevelEnv()
+    env.globalconfig.load(ast)
+    env.module_env.add_module(main_file, ast)
+    interpret_module(ast, env)
+    assert ast.defs[values.W_Symbol.make("x")].value == 42
+    # effect and the guard of prop:counted, which ran when counted-point
+    # was defined
+    assert ast.defs[values.W_Symbol.make("y")].value == 2
+    assert lib_module.defs[values.W_Symbol.make("unused")] is None
+
+def test_is_pure_definition():
+    assert is_pure_definition(Quote(values.W_Fixnum(1)))
+    # only primitives and earlier definitions of the module are certainly
+    # defined
+    f = values.W_Symbol.make("f")
+    assert is_pure_definition(prim("car"))
+    assert not is_pure_definition(ModuleVar(f, None, f))
+    assert is_pure_definition(ModuleVar(f, None, f), {f: None})
+    assert not is_pure_definition(ModuleVar(f, "other.rkt", f), {f: None})
+
+def test_struct_type_with_guarded_property():
+    def make_struct_type(props, guard):
+        rands = [Quote(values.W_Symbol.make("point")), Quote(values.w_false),
+                 Quote(values.W_Fixnum(2)), Quote(values.W_Fixnum(0)),
+                 Quote(values.w_false), props,
+                 App.make(prim("current-inspector"), []),
+                 Quote(values.w_false), Quote(values.w_null), guard,
+                 Quote(values.W_Symbol.make("point"))]
+        return App.make(prim("make-struct-type"), rands)
+    assert is_pure_definition(make_struct_type(prim("null"), Quote(values.w_false)))
+    assert is_pure_definition(make_struct_type(Quote(values.w_null),
+                                               Quote(values.w_false)))
+    # the guard of a property runs when the struct type is created, the
+    # guard of the struct type may have been defined by an impure expression
+    props = LexicalVar(values.W_Symbol.make("props"))
+    guard = LexicalVar(values.W_Symbol.make("guard"))
+    assert not is_pure_definition(make_struct_type(props, Quote(values.w_false)))
+    assert not is_pure_definition(make_struct_type(prim("null"), guard))
@@ -77,6 +77,36 @@ def run_mod_expr(e, v=None, stdlib=False, wrap=False, extra="", srcloc=False):
         assert ov.equal(v)
     return ov
 
+#
+# building and searching ASTs
+#
+
+def prim(name):
+    """ A reference to the primitive |name|. """
+    sym = values.W_Symbol.make(name)
+    return ModuleVar(sym, "#%kernel", sym)
+
+def nodes(ast, cls):
+    """ The nodes of class |cls| in |ast|, including those in the bodies of
+    lambdas. """
+    found = []
+    todo = [ast]
+    while todo:
+        ast = todo.pop()
+        if isinstance(ast, Lambda):
+            ast.force_body()
+        if isinstance(ast, cls):
+            found.append(ast)
+        todo.extend(ast.direct_children())
+    return found
+
+def apps(ast, name):
+    """ The applications of the module-level variable or primitive |name| in
+    |ast|. """
+    sym = values.W_Symbol.make(name)
+    return [app for app in nodes(ast, App)
+            if isinstance(app.rator, ModuleVar) and app.rator.srcsym is sym]
+
 def execute(p, stdlib=False, extra=""):
     return run_mod_expr(p, stdlib=stdlib, extra=extra)
 
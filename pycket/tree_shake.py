@@ -0,0 +1,255 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Whole-program removal of unused module-level definitions.
+#
+# Libraries define many more functions, structs and constants than a program
+# uses, and instantiating a module evaluates all of them. Once the module
+# graph of a program is loaded, this pass marks every module-level binding
+# that can be reached from code which has to run anyway: the expressions and
+# the impure definitions of all the modules, and everything the main module
+# defines. Definitions which are not marked and whose right hand side only
+# allocates (lambdas, quoted data, struct types without properties or guards,
+# references to primitives and earlier definitions of the same module) are
+# then not evaluated when their module is instantiated.
+#
+# Bindings can also be reached dynamically, through eval, namespaces or
+# dynamic-require of a module that was not loaded here; such a use of a
+# removed definition fails as a use before definition. The pass is therefore
+# only enabled by --tree-shake.
+#
+from pycket import values
+from pycket.interpreter import (
+    App,
+    CaseLambda,
+    DefineValues,
+    Lambda,
+    LexicalVar,
+    CellRef,
+    Module,
+    ModuleVar,
+    Quote,
+    QuoteSyntax,
+    Require,
+    VariableReference,
+    Let,
+    Letrec,
+    Begin,
+    Cell,
+)
+
+# Primitives that only allocate, so applying them to pure arguments in a
+# definition can be skipped when the definition is unused.
+ALLOCATING_PRIMITIVES = [
+    "make-struct-type", "make-struct-field-accessor",
+    "make-struct-field-mutator", "make-struct-type-property",
+    "current-inspector", "values", "cons", "list", "list*", "vector",
+    "vector-immutable", "box", "box-immutable", "gensym", "string->symbol",
+]
+
+_allocating = {}
+for _name in ALLOCATING_PRIMITIVES:
+    _allocating[_name] = None
+
+# The operands of make-struct-type that can run code when the struct type is
+# created: the guards of the properties and the guard of the struct type.
+STRUCT_PROPS_INDEX = 5
+STRUCT_GUARD_INDEX = 9
+
+def _is_empty_operand(rand):
+    """ Whether |rand| is #f or null, which make-struct-type takes for no
+    properties and no guard. """
+    if isinstance(rand, Quote):
+        return rand.w_val is values.w_false or rand.w_val is values.w_null
+    return (isinstance(rand, ModuleVar) and rand.is_primitive() and
+            rand.srcsym.utf8value == "null")
+
+def _is_pure_module_var(var, defined):
+    if var.is_primitive():
+        return True
+    return (defined is not None and var.srcmod is None and var.path is None
+            and var.srcsym in defined)
+
+def is_pure_definition(rhs, defined=None):
+    """ Whether evaluating |rhs| has no effect besides allocating. |defined|
+    holds the names the module defines before |rhs|, the only module-level
+    variables that are certainly defined when |rhs| is evaluated. """
+    if isinstance(rhs, Quote) or isinstance(rhs, QuoteSyntax):
+        return True
+    if isinstance(rhs, Lambda) or isinstance(rhs, CaseLambda):
+        return True
+    if isinstance(rhs, LexicalVar) or isinstance(rhs, CellRef):
+        return True
+    if isinstance(rhs, ModuleVar):
+        return _is_pure_module_var(rhs, defined)
+    if isinstance(rhs, App):
+        rator = rhs.rator
+        if not (isinstance(rator, ModuleVar) and rator.is_primitive() and
+                rator.srcsym.utf8value in _allocating):
+            return False
+        rands = rhs.rands
+        if rator.srcsym.utf8value == "make-struct-type":
+            for i in [STRUCT_PROPS_INDEX, STRUCT_GUARD_INDEX]:
+                if i < len(rands) and not _is_empty_operand(rands[i]):
+                    return False
+        for rand in rands:
+            if not is_pure_definition(rand, defined):
+                return False
+        return True
+    if (isinstance(rhs, Let) or isinstance(rhs, Letrec) or
+            isinstance(rhs, Begin) or isinstance(rhs, Cell)):
+        for child in rhs.direct_children():
+            if not is_pure_definition(child, defined):
+                return False
+        return True
+    return False
+
+def _resolve_submodule(module, path):
+    if path is None:
+        return module
+    for name in path:
+        module = module.find_submodule(name)
+        if module is None:
+            return None
+    return module
+
+class TreeShaker(object):
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.modules = []        # the instantiated modules, in load order
+        self.known = {}          # Module -> None, for |modules|
+        self.marked = {}         # Module -> {W_Symbol -> None}
+        self.pure_defs = {}      # Module -> {W_Symbol -> DefineValues}
+        self.scanned = {}        # DefineValues -> None
+
+    # ____________________________________________________________
+    # loading the module graph
+
+    def required_module(self, module, require):
+        if require.loader is None:
+            base = module
+        else:
+            base = require.loader.lazy_load(require.fname)
+        return _resolve_submodule(base, require.path)
+
+    def add_module(self, module):
+        todo = [module]
+        while todo:
+            module = todo.pop()
+            if module is None or module in self.known:
+                continue
+            self.known[module] = None
+            self.modules.append(module)
+            todo.append(module.parent)
+            if isinstance(module.lang, Require): # builtin languages are not
+                todo.append(self.required_module(module, module.lang))
+            for require in module.requires:
+                assert isinstance(require, Require)
+                todo.append(self.required_module(module, require))
+
+    # ____________________________________________________________
+    # reachability
+
+    def target_module(self, module, var):
+        if var.srcmod is None:
+            base = module
+        else:
+            base = self.loader.modtable.lookup(var.srcmod)
+            if base is None:
+                return None
+        return _resolve_submodule(base, var.path)
+
+    def mark(self, module, sym):
+        syms = self.marked.get(module, None)
+        if syms is None:
+            syms = {}
+            self.marked[module] = syms
+        if sym in syms:
+            return
+        syms[sym] = None
+        defs = self.pure_defs.get(module, None)
+        if defs is None:
+            return
+        define = defs.get(sym, None)
+        if define is not None and define not in self.scanned:
+            self.scanned[define] = None
+            self.scan(module, define.rhs)
+
+    def scan(self, module, ast):
+        todo = [ast]
+        while todo:
+            ast = todo.pop()
+            if isinstance(ast, Module):
+                continue # submodules are handled on their own
+            if isinstance(ast, ModuleVar):
+                if not ast.is_primitive():
+                    target = self.target_module(module, ast)
+                    if target is not None:
+                        self.mark(target, ast.srcsym)
+                continue
+            if isinstance(ast, VariableReference):
+                if ast.var is not None:
+                    todo.append(ast.var)
+                continue
+            todo.extend(ast.direct_children())
+
+    def all_submodules(self):
+        result = []
+        todo = self.modules[:]
+        while todo:
+            module = todo.pop()
+            for sub in module.submodules:
+                assert isinstance(sub, Module)
+                if sub not in self.known:
+                    result.append(sub)
+                todo.append(sub)
+        return result
+
+    def shake(self, main):
+        """ Loads the module graph of |main| and marks the definitions of
+        its modules that are never used. Returns the number of them. """
+        self.add_module(main)
+        roots = []
+        for module in self.modules:
+            defs = {}
+            defined = {}
+            for form in module.body:
+                if (isinstance(form, DefineValues) and
+                        is_pure_definition(form.rhs, defined) and
+                        module is not main):
+                    for name in form.names:
+                        defs[name] = form
+                else:
+                    roots.append((module, form))
+                if isinstance(form, DefineValues):
+                    for name in form.names:
+                        defined[name] = None
+            self.pure_defs[module] = defs
+        # submodules which are not instantiated now may be later
+        for module in self.all_submodules():
+            for form in module.body:
+                roots.append((module, form))
+        for module, form in roots:
+            self.scan(module, form)
+
+        removed = 0
+        for module in self.modules:
+            marked = self.marked.get(module, {})
+            unused = {}
+            for form in module.body:
+                if not isinstance(form, DefineValues):
+                    continue
+                if self.pure_defs[module].get(form.names[0], None) is not form:
+                    continue
+                for name in form.names:
+                    if name in marked:
+                        break
+                else:
+                    unused[form] = None
+                    removed += 1
+            module.unused_defs = unused
+        return removed
+
+def shake_program(main, loader):
+    return TreeShaker(loader).shake(main)
@@ -3,8 +3,9 @@
 
 from pycket                   import config
 from pycket.arity             import Arity
-from pycket.base              import W_Object, W_ProtoObject, UnhashableType
-from pycket.cont              import continuation, label, NilCont
+from pycket.base              import (W_Object, W_ProtoObject, UnhashableType,
+                                       fixed_args_list)
+from pycket.cont              import continuation, label, CoroutineBase, NilCont
 from pycket.env               import ConsEnv
 from pycket.error             import SchemeException
 from pycket.prims.expose      import make_call_method
@@ -1266,9 +1267,9 @@ class W_ThunkProcCMK(W_Procedure):
 
 
 class W_Prim(W_Procedure):
-    _attrs_ = _immutable_fields_ = ["name", "code", "arity", "result_arity", "simple1", "simple2"]
+    _attrs_ = _immutable_fields_ = ["name", "code", "arity", "result_arity", "simple1", "simple2", "simple3", "fixed", "pure", "reads_mutable"]
 
-    def __init__ (self, name, code, arity=Arity.unknown, result_arity=None, simple1=None, simple2=None):
+    def __init__ (self, name, code, arity=Arity.unknown, result_arity=None, simple1=None, simple2=None, simple3=None, fixed=None, pure=False, reads_mutable=False):
         self.name = W_Symbol.make(name)
         self.code = code
         assert isinstance(arity, Arity)
@@ -1276,6 +1277,10 @@ class W_Prim(W_Procedure):
         self.result_arity = result_arity
         self.simple1 = simple1
         self.simple2 = simple2
+        self.simple3 = simple3
+        self.fixed = fixed
+        self.pure = pure
+        self.reads_mutable = reads_mutable
 
     def get_arity(self, promote=False):
         if promote:
@@ -1289,6 +1294,16 @@ class W_Prim(W_Procedure):
         jit.promote(self)
         return self.code(args, env, cont, extra_call_info)
 
+    def call_fixed(self, argc, w_arg1, w_arg2, w_arg3, w_arg4, env, cont,
+                   calling_app):
+        jit.promote(self)
+        fixed = self.fixed
+        if fixed is None:
+            args = fixed_args_list(argc, w_arg1, w_arg2, w_arg3, w_arg4)
+            return self.code(args, env, cont, calling_app)
+        return fixed(argc, w_arg1, w_arg2, w_arg3, w_arg4, env, cont,
+                     calling_app)
+
     def tostring(self):
         return "#<procedure:%s>" % self.name.variable_name()
 
@@ -1415,6 +1430,86 @@ class W_ComposableContinuation(W_Procedure):
     def tostring(self):
         return "#<continuation>"
 
+@continuation
+def coroutine_body_cont(env, cont, _vals):
+    # Receives the result of the body of a coroutine. Continuation marks in
+    # tail position of the body end up here and not on the coroutine base.
+    from pycket.interpreter import return_multi_vals
+    return return_multi_vals(_vals, env, cont)
+
+class W_Coroutine(W_Object):
+    """ A coroutine runs its procedure in a continuation segment of its own,
+    delimited by a CoroutineBase frame. Resuming it links the segment to the
+    continuation of the resume, yielding unlinks it again; both take
+    constant time. dynamic-wind thunks are not run when switching. A
+    coroutine left by an escape, an abort or a raise is done. """
+    errorname = "coroutine"
+
+    _attrs_ = ["proc", "base", "resumer", "suspended", "state"]
+
+    FRESH     = 0
+    RUNNING   = 1
+    SUSPENDED = 2
+    DONE      = 3
+
+    def __init__(self, proc):
+        self.proc      = proc
+        self.base      = CoroutineBase(self)
+        self.resumer   = None
+        self.suspended = None
+        self.state     = W_Coroutine.FRESH
+
+    def resume(self, args, env, cont):
+        from pycket.interpreter import return_multi_vals
+        from pycket.prims.control import CoroutineResumeCont
+        state = self.state
+        if state == W_Coroutine.RUNNING:
+            raise SchemeException("coroutine-resume: coroutine is already running")
+        if state == W_Coroutine.DONE:
+            raise SchemeException("coroutine-resume: coroutine is done")
+        cont = CoroutineResumeCont(self, env, cont)
+        self.resumer = cont
+        self.base.relink(cont)
+        self.state = W_Coroutine.RUNNING
+        if state == W_Coroutine.FRESH:
+            body = coroutine_body_cont(env, self.base)
+            return self.proc.call(args, env, body)
+        suspended = self.suspended
+        self.suspended = None
+        return return_multi_vals(Values.make(args), env, suspended)
+
+    def yield_(self, args, env, cont):
+        from pycket.interpreter import return_multi_vals
+        if self.state != W_Coroutine.RUNNING:
+            raise SchemeException("coroutine-yield: coroutine is not running")
+        self.suspended = cont
+        self.state = W_Coroutine.SUSPENDED
+        return return_multi_vals(Values.make(args), env, self.resumer)
+
+    def finish(self, vals, env):
+        from pycket.interpreter import return_multi_vals
+        self.state = W_Coroutine.DONE
+        return return_multi_vals(vals, env, self.resumer)
+
+    def abandon(self):
+        """ Control left the running coroutine other than by yielding or
+        returning, it cannot be resumed. """
+        self.state = W_Coroutine.DONE
+        self.suspended = None
+
+    def state_name(self):
+        state = self.state
+        if state == W_Coroutine.FRESH:
+            return W_Symbol.make("fresh")
+        if state == W_Coroutine.RUNNING:
+            return W_Symbol.make("running")
+        if state == W_Coroutine.SUSPENDED:
+            return W_Symbol.make("suspended")
+        return W_Symbol.make("done")
+
+    def tostring(self):
+        return "#<coroutine>"
+
 @inline_small_list(immutable=True, attrname="envs", factoryname="_make")
 class W_Closure(W_Procedure):
     _immutable_ = True
@@ -1466,26 +1561,57 @@ class W_Closure(W_Procedure):
             single_lambda.raise_nice_error(args)
         raise SchemeException("No matching arity in case-lambda")
 
+    @jit.unroll_safe
+    def _find_lam_fixed(self, argc):
+        """ The index of the case a call with |argc| arguments runs, if that
+        case takes exactly |argc| arguments, otherwise -1. """
+        jit.promote(self.caselam)
+        for i, lam in enumerate(self.caselam.lams):
+            if lam.rest is None:
+                if len(lam.formals) == argc:
+                    return i
+            elif len(lam.formals) <= argc:
+                return -1
+        return -1
+
     def call_with_extra_info(self, args, env, cont, calling_app):
-        env_structure = None
-        if calling_app is not None:
-            env_structure = calling_app.env_structure
         jit.promote(self.caselam)
-        jit.promote(env_structure)
         (actuals, frees, lam) = self._find_lam(args)
-        if not jit.we_are_jitted() and env.pycketconfig().callgraph:
-            env.toplevel_env().callgraph.register_call(lam, calling_app, cont, env)
-        # specialize on the fact that often we end up executing in the
-        # same environment.
-        prev = lam.env_structure.prev.find_env_in_chain_speculate(
-                frees, env_structure, env)
+        prev = enter_lambda(lam, frees, env, cont, calling_app)
         return lam.make_begin_cont(
             ConsEnv.make(actuals, prev),
             cont)
 
+    def call_fixed(self, argc, w_arg1, w_arg2, w_arg3, w_arg4, env, cont,
+                   calling_app):
+        i = self._find_lam_fixed(argc)
+        if i < 0:
+            args = fixed_args_list(argc, w_arg1, w_arg2, w_arg3, w_arg4)
+            return self.call_with_extra_info(args, env, cont, calling_app)
+        lam = self.caselam.lams[i]
+        prev = enter_lambda(lam, self._get_list(i), env, cont, calling_app)
+        return lam.make_begin_cont(
+            lam.make_fixed_args_env(argc, w_arg1, w_arg2, w_arg3, w_arg4, prev),
+            cont)
+
     def call(self, args, env, cont):
         return self.call_with_extra_info(args, env, cont, None)
 
+def enter_lambda(lam, frees, env, cont, calling_app):
+    """ Returns the environment the arguments of a call of |lam| extend. """
+    env_structure = None
+    if calling_app is not None:
+        env_structure = calling_app.env_structure
+    jit.promote(env_structure)
+    if not jit.we_are_jitted() and env.pycketconfig().callgraph:
+        env.toplevel_env().callgraph.register_call(lam, calling_app, cont, env)
+    # specialize on the fact that often we end up executing in the
+    # same environment.
+    prev = lam.env_structure.prev.find_env_in_chain_speculate(
+            frees, env_structure, env)
+    lam.force_body()
+    return prev
+
 @inline_small_list(immutable=True, attrname="vals", factoryname="_make", unbox_num=True, nonull=True)
 class W_Closure1AsEnv(ConsEnv):
     _immutable_ = True
@@ -1523,25 +1649,27 @@ class W_Closure1AsEnv(ConsEnv):
         return caselam.get_arity()
 
     def call_with_extra_info(self, args, env, cont, calling_app):
-        env_structure = None
-        if calling_app is not None:
-            env_structure = calling_app.env_structure
         jit.promote(self.caselam)
-        jit.promote(env_structure)
         lam = self.caselam.lams[0]
-        if not jit.we_are_jitted() and env.pycketconfig().callgraph:
-            env.toplevel_env().callgraph.register_call(lam, calling_app, cont, env)
         actuals = lam.match_args(args)
         if actuals is None:
             lam.raise_nice_error(args)
-        # specialize on the fact that often we end up executing in the
-        # same environment.
-        prev = lam.env_structure.prev.find_env_in_chain_speculate(
-                self, env_structure, env)
+        prev = enter_lambda(lam, self, env, cont, calling_app)
         return lam.make_begin_cont(
             ConsEnv.make(actuals, prev),
             cont)
 
+    def call_fixed(self, argc, w_arg1, w_arg2, w_arg3, w_arg4, env, cont,
+                   calling_app):
+        lam = jit.promote(self.caselam).lams[0]
+        if lam.rest is not None or len(lam.formals) != argc:
+            args = fixed_args_list(argc, w_arg1, w_arg2, w_arg3, w_arg4)
+            return self.call_with_extra_info(args, env, cont, calling_app)
+        prev = enter_lambda(lam, self, env, cont, calling_app)
+        return lam.make_begin_cont(
+            lam.make_fixed_args_env(argc, w_arg1, w_arg2, w_arg3, w_arg4, prev),
+            cont)
+
     def call(self, args, env, cont):
         return self.call_with_extra_info(args, env, cont, None)
 
@@ -1597,6 +1725,12 @@ class W_PromotableClosure(W_Procedure):
         jit.promote(self)
         return self.closure.call_with_extra_info(args, env, cont, calling_app)
 
+    def call_fixed(self, argc, w_arg1, w_arg2, w_arg3, w_arg4, env, cont,
+                   calling_app):
+        jit.promote(self)
+        return self.closure.call_fixed(argc, w_arg1, w_arg2, w_arg3, w_arg4,
+                                       env, cont, calling_app)
+
     def get_arity(self, promote=False):
         if promote:
             self = jit.promote(self)
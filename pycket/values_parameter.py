@@ -69,10 +69,48 @@ class W_Parameterization(W_Object):
 # This will need to be thread-specific
 top_level_config = W_Parameterization(RootParameterization(), ParameterizationHashTable.EMPTY)
 
-def find_param_cell(cont, param):
+# Remembers the parameterization of the continuation of the last lookup.
+# Parameters are mostly read over and over from the same continuation (think
+# of a loop calling |display|), and a lookup that reaches the remembered
+# continuation can stop there instead of walking the rest of the marks.
+# The marks of a frame only change in |BaseCont.update_cm|, which empties the
+# cache whenever a parameterization is installed.
+class ParameterizationCache(object):
+    _attrs_ = ["cont", "paramz"]
+    def __init__(self):
+        self.cont   = None
+        self.paramz = None
+
+    def clear(self):
+        self.cont   = None
+        self.paramz = None
+
+# This will need to be thread-specific as well
+paramz_cache = ParameterizationCache()
+
+@jit.unroll_safe
+def current_parameterization(cont):
     assert isinstance(cont, BaseCont)
-    p = cont.get_mark_first(values.parameterization_key)
-    assert isinstance(p, W_Parameterization)
+    cache = paramz_cache
+    cached = cache.cont
+    if cont is cached:
+        return cache.paramz
+    paramz = None
+    p = cont
+    while p is not None:
+        if p is cached:
+            paramz = cache.paramz
+            break
+        paramz, p = p.find_cm(values.parameterization_key)
+        if paramz is not None:
+            break
+    assert isinstance(paramz, W_Parameterization)
+    cache.cont   = cont
+    cache.paramz = paramz
+    return paramz
+
+def find_param_cell(cont, param):
+    p = current_parameterization(cont)
     assert isinstance(param, W_Parameter)
     v = p.get(param)
     assert isinstance(v, values.W_ThreadCell)
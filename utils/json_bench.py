@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compares the tree-building JSON parser (pycket_json.loads) with the pull
+# parser used by the module loader, on expanded Racket modules.
+#
+# usage: python utils/json_bench.py [--repeat N] [file.rkt | file.json ...]
+#
+# Without arguments the expanded stdlib and all the .rkt benchmark programs
+# in pycket/test are used. Needs racket on the PATH to expand .rkt files.
+#
+import glob
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pycket import pycket_json
+from pycket.expand import JsonLoader, expand_file, expand_string
+
+TEST_DIR = os.path.join(os.path.dirname(__file__), "..", "pycket", "test")
+
+def load_inputs(args):
+    inputs = []
+    if not args:
+        inputs.append(("stdlib", expand_string("#lang pycket #:stdlib\n")))
+        args = sorted(glob.glob(os.path.join(TEST_DIR, "*.rkt")))
+    for fname in args:
+        if fname.endswith(".json"):
+            with open(fname) as f:
+                data = f.read()
+        else:
+            try:
+                data = expand_file(fname)
+            except Exception as e:
+                print >> sys.stderr, "skipping %s: %s" % (fname, e)
+                continue
+        inputs.append((os.path.basename(fname), data))
+    return inputs
+
+def tree_parse(data):
+    pycket_json.loads(data)
+
+def tree_to_module(data):
+    JsonLoader().to_module(pycket_json.loads(data))
+
+def pull_scan(data):
+    parser = pycket_json.JsonPullParser(data)
+    parser.skip_value()
+    parser.finish()
+
+def pull_parse(data):
+    pycket_json.loads_pull(data)
+
+def pull_to_module(data):
+    JsonLoader().to_module_from_string(data)
+
+MODES = [
+    ("tree parse", tree_parse),
+    ("pull scan", pull_scan),
+    ("pull parse", pull_parse),
+    ("tree to_module", tree_to_module),
+    ("pull to_module", pull_to_module),
+]
+
+def measure(func, data, repeat):
+    """ Runs func in a child process and returns (best time, peak rss in kB
+    above the baseline of the child). """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        best = float("inf")
+        for i in range(repeat):
+            start = time.time()
+            func(data)
+            best = min(best, time.time() - start)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+        os.write(wfd, "%r %d" % (best, peak))
+        os._exit(0)
+    os.close(wfd)
+    result = os.read(rfd, 1024)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    best, peak = result.split()
+    return float(best), int(peak)
+
+def main(args):
+    repeat = 3
+    if args[:1] == ["--repeat"]:
+        repeat = int(args[1])
+        args = args[2:]
+    inputs = load_inputs(args)
+    header = "%-28s %9s" % ("module", "size kB")
+    for name, _ in MODES:
+        header += " | %16s" % name
+    print header
+    print " " * 39 + " | %16s" % "time s / peak kB" * len(MODES)
+    totals = [0.0] * len(MODES)
+    for name, data in inputs:
+        line = "%-28s %9d" % (name[:28], len(data) // 1024)
+        for i, (_, func) in enumerate(MODES):
+            best, peak = measure(func, data, repeat)
+            totals[i] += best
+            line += " | %7.3f %8d" % (best, peak)
+        print line
+    line = "%-28s %9s" % ("total", "")
+    for total in totals:
+        line += " | %7.3f %8s" % (total, "")
+    print line
+
+if __name__ == '__main__':
+    main(sys.argv[1:])